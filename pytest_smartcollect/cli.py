@@ -0,0 +1,328 @@
+import os
+import ast
+import sys
+import glob
+import json
+import shlex
+import typing
+import fnmatch
+import logging
+import argparse
+import configparser
+from git import Repo
+from pytest_smartcollect.helpers import SmartCollector, FUNCTION_DEFINITIONS
+from pytest_smartcollect.dependencies import TOML_SECTION, TOML_KEY, QUOTED_STRING, strip_toml_comment
+from pytest_smartcollect.ignore import IgnoreMatcher
+from pytest_smartcollect.daemon import DaemonClient, ItemDescriptor, get_socket_path
+
+# pytest's defaults for python_files, python_classes and python_functions
+TEST_FILE_PATTERNS = ('test_*.py', '*_test.py')
+TEST_CLASS_PREFIX = 'Test'
+TEST_FUNCTION_PREFIX = 'test'
+
+# the files that pytest reads its ini options from, in the order it looks for them in each folder, with the section it reads
+# them from. pytest.ini is used even if it has no [pytest] section
+INI_FILES = (('pytest.ini', 'pytest'), ('pyproject.toml', 'tool.pytest.ini_options'), ('tox.ini', 'pytest'), ('setup.cfg', 'tool:pytest'))
+
+# exit codes
+AFFECTED = 0
+NOTHING_AFFECTED = 1
+ERROR = 2
+
+
+class DirectoryCache(object):
+    # reads and writes values in the same layout as the pytest cache (config.cache), so that the indexes and classifications
+    # that pytest runs have cached are used here, and the other way around
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, 'v', *key.split('/'))
+
+    def get(self, key, default):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+
+        except (IOError, OSError, ValueError):
+            return default
+
+    def set(self, key, value):
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            with open(path, 'w') as f:
+                json.dump(value, f, indent=2, sort_keys=True)
+
+        except (IOError, OSError):  # e.g. a read only checkout -- the cache only saves time
+            pass
+
+
+def read_toml_section(text: str, section: str) -> typing.Union[dict, None]:
+    # the string and array of strings values of a toml table, without a toml parser
+    values = None
+    current = None
+    key = None
+
+    for line in text.splitlines():
+        stripped = strip_toml_comment(line).strip()
+        match = TOML_SECTION.match(stripped) if key is None else None
+        if match is not None:
+            current = match.group(1)
+            if current == section:
+                values = {}
+
+            continue
+
+        if current != section:
+            continue
+
+        if key is None:
+            match = TOML_KEY.match(stripped)
+            if match is None:
+                continue
+
+            key, stripped = match.group(1), match.group(2)
+            values[key] = [] if stripped.startswith('[') else None
+
+        strings = [m.group(1) if m.group(1) is not None else m.group(2) for m in QUOTED_STRING.finditer(stripped)]
+        if values[key] is None:
+            values[key] = strings[0] if strings else stripped
+            key = None
+
+        else:
+            values[key].extend(strings)
+            if ']' in stripped:
+                key = None
+
+    return values
+
+
+def read_ini(rootdir: str) -> typing.Tuple[typing.Union[str, None], dict]:
+    # the folder of the ini file that pytest would use for rootdir, and the ini options in it. like pytest, the first folder
+    # from rootdir up that has one of INI_FILES (with its section) wins
+    d = os.path.abspath(rootdir)
+    while True:
+        for filename, section in INI_FILES:
+            path = os.path.join(d, filename)
+            if not os.path.isfile(path):
+                continue
+
+            with open(path) as f:
+                text = f.read()
+
+            if filename == 'pyproject.toml':
+                values = read_toml_section(text, section)
+
+            else:
+                parser = configparser.ConfigParser(interpolation=None)
+                parser.read_string(text, path)
+                values = dict(parser.items(section)) if parser.has_section(section) else None
+
+            if values is not None or filename == 'pytest.ini':
+                return d, values or {}
+
+        if os.path.dirname(d) == d:
+            return None, {}
+
+        d = os.path.dirname(d)
+
+
+def get_ini_lines(ini: dict, name: str) -> typing.List[str]:
+    # a linelist option: one value per line in an ini file, or an array in pyproject.toml
+    value = ini.get(name, [])
+    lines = value if isinstance(value, list) else value.splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def get_ini_args(ini: dict, name: str, default: typing.Sequence[str]) -> typing.List[str]:
+    # an args option: whitespace separated values (quoted as in a shell) in an ini file, or an array in pyproject.toml
+    if name not in ini:
+        return list(default)
+
+    value = ini[name]
+    return value if isinstance(value, list) else shlex.split(value)
+
+
+def matches_name(name: str, patterns: typing.Sequence[str]) -> bool:
+    # python_classes and python_functions are prefixes, or glob patterns if they have wildcards
+    for pattern in patterns:
+        if name.startswith(pattern) or (any(c in pattern for c in '*?[') and fnmatch.fnmatch(name, pattern)):
+            return True
+
+    return False
+
+
+def matches_file(path: str, patterns: typing.Sequence[str]) -> bool:
+    # python_files match the file name, or the end of the path if they have a slash
+    for pattern in patterns:
+        if '/' in pattern or os.sep in pattern:
+            if fnmatch.fnmatch(path.replace(os.sep, '/'), '*/' + pattern.replace(os.sep, '/').lstrip('/')):
+                return True
+
+        elif fnmatch.fnmatch(os.path.basename(path), pattern):
+            return True
+
+    return False
+
+
+def find_markers(node) -> typing.List[str]:
+    # the names of the @pytest.mark.<name> decorators of node
+    markers = []
+    for dec in node.decorator_list:
+        if isinstance(dec, ast.Call):
+            dec = dec.func
+
+        if isinstance(dec, ast.Attribute) and isinstance(dec.value, ast.Attribute) and dec.value.attr == 'mark':
+            markers.append(dec.attr)
+
+    return markers
+
+
+def is_skipped(node) -> bool:
+    # @pytest.mark.skip or @skip, with or without arguments
+    for dec in node.decorator_list:
+        if isinstance(dec, ast.Call):
+            dec = dec.func
+
+        if (isinstance(dec, ast.Attribute) and dec.attr == 'skip') or (isinstance(dec, ast.Name) and dec.id == 'skip'):
+            return True
+
+    return False
+
+
+def find_test_items(path: str, rootdir: str, python_classes: typing.Sequence[str]=(TEST_CLASS_PREFIX,), python_functions: typing.Sequence[str]=(TEST_FUNCTION_PREFIX,)) -> typing.List[ItemDescriptor]:
+    # the tests that pytest would collect from a test file with the given naming rules, found in its source instead of by
+    # importing it. parametrized tests appear once, without their parameters
+    try:
+        with open(path, 'rb') as f:
+            module_ast = ast.parse(f.read())
+
+    except (IOError, OSError, SyntaxError, ValueError):
+        return []
+
+    relpath = os.path.relpath(path, rootdir).replace(os.sep, '/')
+    items = []
+
+    for node in module_ast.body:
+        if isinstance(node, FUNCTION_DEFINITIONS) and matches_name(node.name, python_functions):
+            items.append(ItemDescriptor("%s::%s" % (relpath, node.name), path, node.name, is_skipped(node), find_markers(node)))
+
+        elif isinstance(node, ast.ClassDef) and matches_name(node.name, python_classes):
+            # pytest doesn't collect test classes with a constructor
+            if any(isinstance(child, FUNCTION_DEFINITIONS) and child.name == '__init__' for child in node.body):
+                continue
+
+            for child in node.body:
+                if isinstance(child, FUNCTION_DEFINITIONS) and matches_name(child.name, python_functions):
+                    items.append(ItemDescriptor(
+                        "%s::%s::%s" % (relpath, node.name, child.name), path, child.name, is_skipped(node) or is_skipped(child),
+                        find_markers(node) + find_markers(child)
+                    ))
+
+    return items
+
+
+def discover_tests(paths: typing.List[str], rootdir: str, ignore_matcher: IgnoreMatcher, python_files: typing.Sequence[str]=TEST_FILE_PATTERNS, python_classes: typing.Sequence[str]=(TEST_CLASS_PREFIX,), python_functions: typing.Sequence[str]=(TEST_FUNCTION_PREFIX,)) -> typing.List[ItemDescriptor]:
+    items = []
+
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isfile(path):
+            items.extend(find_test_items(path, rootdir, python_classes, python_functions))
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d != '__pycache__')
+            ignore_matcher.prune(dirpath, dirnames)
+
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                if matches_file(filepath, python_files) and not ignore_matcher.matches(filepath):
+                    items.extend(find_test_items(filepath, rootdir, python_classes, python_functions))
+
+    return items
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='pytest-smartcollect',
+        description='Print the tests affected by the changes in a git repository, without running pytest or importing any tests.  '
+                    'Exits with 0 if any test is affected, 1 if none is, and 2 on errors.'
+    )
+    parser.add_argument('paths', nargs='*', help='Test files or folders to look for tests in.  Default is the testpaths ini option, or the rootdir.')
+    parser.add_argument('--rootdir', default=os.getcwd(), help='The pytest rootdir, which node ids are relative to.  Default is the current working directory.')
+    parser.add_argument('--commit-range', type=int, default=0, help='The number of commits before the HEAD commit of the diffed branch to use when calculating diffs.  Default is 0.')
+    parser.add_argument('--diff-current-head-with-branch', default='master', help='The branch to diff the currently checked out head with.  Default is "master".')
+    parser.add_argument('--ignore-source', action='append', default=[], metavar='path', help='Source code file or folder to ignore, in addition to those in the smart_collect_ignore ini option.  Multiple instances of this flag are supported.')
+    parser.add_argument('--data-map', action='append', default=[], metavar='"glob = target ..."', help='Tests to run when files matching a glob change, in addition to those in the smart_collect_data_map ini option.  Multiple instances of this flag are supported.')
+    parser.add_argument('--max-depth', type=int, default=None, help='The maximum number of dependency hops to follow from each test.  Default is unlimited.')
+    parser.add_argument('--cache-dir', default=None, help='The pytest cache directory.  Default is .pytest_cache in the rootdir.')
+    parser.add_argument('--files', action='store_true', default=False, help='Print the affected test files instead of the node ids of the affected tests.')
+    parser.add_argument('--no-daemon', action='store_true', default=False, help="Don't ask a running selection daemon for the selection.")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stderr)
+    logger = logging.getLogger('pytest_smartcollect')
+
+    rootdir = os.path.abspath(args.rootdir)
+    cache = DirectoryCache(args.cache_dir or os.path.join(rootdir, '.pytest_cache'))
+
+    try:
+        # the ini options that the plugin reads, from the same files as pytest
+        ini_dir, ini = read_ini(rootdir)
+        test_paths = args.paths
+        if not test_paths and ini_dir is not None:
+            test_paths = [p for testpath in get_ini_args(ini, 'testpaths', []) for p in sorted(glob.glob(os.path.join(ini_dir, testpath)))]
+
+        repo_root = Repo(rootdir, search_parent_directories=True).working_tree_dir
+        smart_collector = SmartCollector(
+            rootdir,
+            cache.get("cache/lastfailed", {}),
+            args.ignore_source + get_ini_lines(ini, 'smart_collect_ignore'),
+            args.commit_range,
+            args.diff_current_head_with_branch,
+            False,
+            logger,
+            cache=cache,
+            max_depth=args.max_depth,
+            data_map=get_ini_lines(ini, 'smart_collect_data_map') + args.data_map,
+            daemon=None if args.no_daemon else DaemonClient(get_socket_path(repo_root), logger)
+        )
+
+        try:
+            items = discover_tests(
+                test_paths or [rootdir], rootdir, smart_collector.get_ignore_matcher(), get_ini_args(ini, 'python_files', TEST_FILE_PATTERNS),
+                get_ini_args(ini, 'python_classes', [TEST_CLASS_PREFIX]), get_ini_args(ini, 'python_functions', [TEST_FUNCTION_PREFIX])
+            )
+            log_records = smart_collector.query_or_select(items)
+
+        finally:
+            smart_collector.close()
+
+    except Exception as e:
+        logger.error("Couldn't compute the smart collection selection -- %s", e)
+        return ERROR
+
+    affected = [nodeid for action, nodeid, _ in log_records if action == 'RUN']
+    paths = dict((item.nodeid, item.fspath) for item in items)
+
+    if args.files:
+        files = []
+        for nodeid in affected:
+            relpath = os.path.relpath(paths[nodeid], rootdir)
+            if relpath not in files:
+                files.append(relpath)
+
+        affected = files
+
+    for line in affected:
+        print(line)
+
+    return AFFECTED if affected else NOTHING_AFFECTED
+
+
+if __name__ == '__main__':
+    sys.exit(main())
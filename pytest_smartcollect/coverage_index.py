@@ -0,0 +1,416 @@
+import os
+import abc
+import sys
+import mmap
+import struct
+import typing
+from bisect import bisect_left, bisect_right
+
+DictOfLines = typing.Dict[str, typing.Set[int]]
+ListOfInterval = typing.List[typing.Tuple[int, int]]
+ListOfTestInterval = typing.List[typing.Tuple[int, int, int]]
+SetOfString = typing.Set[str]
+
+
+def lines_to_intervals(lines: typing.Iterable[int]) -> ListOfInterval:
+    intervals = []
+
+    for line in sorted(lines):
+        if intervals and intervals[-1][1] == line - 1:
+            intervals[-1][1] = line
+
+        else:
+            intervals.append([line, line])
+
+    return [tuple(i) for i in intervals]
+
+
+class LineTracer(object):
+    # records the lines executed in files under root between start() and stop()
+    def __init__(self, root: str):
+        self.root = os.path.normcase(os.path.abspath(root))
+        self.lines = {}
+        self._in_root = {}
+
+    def start(self) -> bool:
+        # there is only one trace function, and another tracer that is already installed (e.g. the one of pytest-cov) would
+        # silently stop recording if it were replaced, so nothing is recorded then
+        self.lines = {}
+        if sys.gettrace() is not None:
+            return False
+
+        sys.settrace(self._trace_call)
+        return True
+
+    def stop(self) -> DictOfLines:
+        sys.settrace(None)
+        return self.lines
+
+    def _get_lines(self, filename: str) -> typing.Union[typing.Set[int], None]:
+        try:
+            in_root = self._in_root[filename]
+
+        except KeyError:
+            path = os.path.normcase(os.path.abspath(filename))
+            in_root = os.path.commonpath([path, self.root]) == self.root if os.path.isabs(filename) else False
+            self._in_root[filename] = in_root
+
+        if not in_root:
+            return None
+
+        try:
+            return self.lines[filename]
+
+        except KeyError:
+            lines = self.lines[filename] = set()
+            return lines
+
+    def _trace_call(self, frame, event, arg):
+        lines = self._get_lines(frame.f_code.co_filename)
+        if lines is None:  # don't trace the lines of anything outside of the project
+            return None
+
+        lines.add(frame.f_lineno)
+
+        def trace_line(frame, event, arg):
+            if event == 'line':
+                lines.add(frame.f_lineno)
+
+            return trace_line
+
+        return trace_line
+
+
+class MonitoringLineTracer(LineTracer):
+    # sys.monitoring (python 3.12+) can disable events per code location, which is much cheaper than sys.settrace
+    def __init__(self, root: str):
+        super(MonitoringLineTracer, self).__init__(root)
+        self.tool_id = None
+
+    def start(self) -> bool:
+        # every tool has its own events, so this records alongside any other tracer
+        monitoring = sys.monitoring
+        self.lines = {}
+
+        for tool_id in range(6):
+            if monitoring.get_tool(tool_id) is None:
+                self.tool_id = tool_id
+                break
+
+        else:
+            raise Exception("No free sys.monitoring tool id is available for recording coverage")
+
+        monitoring.use_tool_id(self.tool_id, 'pytest-smartcollect')
+        monitoring.register_callback(self.tool_id, monitoring.events.LINE, self._trace_line)
+        monitoring.set_events(self.tool_id, monitoring.events.LINE)
+        monitoring.restart_events()
+        return True
+
+    def stop(self) -> DictOfLines:
+        monitoring = sys.monitoring
+        monitoring.set_events(self.tool_id, 0)
+        monitoring.register_callback(self.tool_id, monitoring.events.LINE, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+        return self.lines
+
+    def _trace_line(self, code, line_number):
+        lines = self._get_lines(code.co_filename)
+        if lines is not None:
+            lines.add(line_number)
+
+        # every location only needs to be seen once per test, and locations outside of the project never
+        return sys.monitoring.DISABLE
+
+
+def make_line_tracer(root: str) -> LineTracer:
+    if hasattr(sys, 'monitoring'):
+        return MonitoringLineTracer(root)
+
+    return LineTracer(root)
+
+
+# The on-disk format of the coverage index (all integers little endian):
+#
+#   header    magic, format version, commit, test/file counts and the offsets of the sections below
+#   strings   every test node id and file path, utf-8 encoded and stored once
+#   tests     (offset, length) into strings for each test id
+#   files     (path offset, path length, intervals offset, intervals length, interval count) for each file, sorted by path
+#   intervals per file, the (start, end, test id) triples sorted by start, stored as varints of
+#             (start - previous start, end - start, test id)
+#
+# Only the header is read up front.  Files are found by bisecting the files table, and only the intervals of the files
+# that are actually queried are decoded.
+MAGIC = b'SCIX'
+HEADER = struct.Struct('<4sH40sIIQQQ')
+TEST_ENTRY = struct.Struct('<II')
+FILE_ENTRY = struct.Struct('<IIQII')
+
+
+def encode_varint(value: int, out: bytearray):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def decode_varints(data: bytes) -> typing.List[int]:
+    values = []
+    value = 0
+    shift = 0
+
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+
+    return values
+
+
+class BaseCoverageIndex(abc.ABC):
+    VERSION = 2
+
+    def __init__(self, root: str, commit: typing.Union[str, None]=None):
+        self.root = root
+        self.commit = commit
+        self._intervals = {}
+        self._starts = {}
+        self._max_ends = {}
+
+    def relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    @abc.abstractmethod
+    def _load_intervals(self, relpath: str) -> ListOfTestInterval:
+        pass
+
+    @abc.abstractmethod
+    def _nodeid(self, test_id: int) -> str:
+        pass
+
+    def _prepare(self, relpath: str) -> ListOfTestInterval:
+        try:
+            return self._intervals[relpath]
+
+        except KeyError:
+            pass
+
+        intervals = sorted(self._load_intervals(relpath))
+
+        # the running maximum of the interval ends is non-decreasing, so it can be bisected to skip intervals that end too early
+        max_ends = []
+        max_end = 0
+        for _, end, _ in intervals:
+            max_end = max(max_end, end)
+            max_ends.append(max_end)
+
+        self._intervals[relpath] = intervals
+        self._starts[relpath] = [start for start, _, _ in intervals]
+        self._max_ends[relpath] = max_ends
+        return intervals
+
+    def _invalidate(self):
+        self._intervals.clear()
+        self._starts.clear()
+        self._max_ends.clear()
+
+    def tests_touching(self, relpath: str, first_line: int, last_line: int) -> SetOfString:
+        intervals = self._prepare(relpath)
+        hi = bisect_right(self._starts[relpath], last_line)
+        lo = bisect_left(self._max_ends[relpath], first_line)
+
+        return set(self._nodeid(test_id) for start, end, test_id in intervals[lo:hi] if end >= first_line)
+
+    def tests_for_file(self, relpath: str) -> SetOfString:
+        return set(self._nodeid(test_id) for _, _, test_id in self._prepare(relpath))
+
+
+class CoverageIndex(BaseCoverageIndex):
+    # an index that is being recorded, held entirely in memory
+    def __init__(self, root: str, commit: typing.Union[str, None]=None):
+        super(CoverageIndex, self).__init__(root, commit)
+        self.tests = []
+        self.test_ids = {}
+        self.files = {}
+
+    def add(self, nodeid: str, lines: DictOfLines):
+        try:
+            test_id = self.test_ids[nodeid]
+
+        except KeyError:
+            test_id = self.test_ids[nodeid] = len(self.tests)
+            self.tests.append(nodeid)
+
+        for path, file_lines in lines.items():
+            intervals = self.files.setdefault(self.relpath(path), [])
+            intervals.extend((start, end, test_id) for start, end in lines_to_intervals(file_lines))
+
+        self._invalidate()
+
+    def __contains__(self, nodeid: str) -> bool:
+        return nodeid in self.test_ids
+
+    def _load_intervals(self, relpath: str) -> ListOfTestInterval:
+        return self.files.get(relpath, [])
+
+    def _nodeid(self, test_id: int) -> str:
+        return self.tests[test_id]
+
+    def write(self, path: str):
+        strings = bytearray()
+        tests_table = bytearray()
+        files_table = bytearray()
+        intervals_data = bytearray()
+
+        for nodeid in self.tests:
+            encoded = nodeid.encode('utf-8')
+            tests_table += TEST_ENTRY.pack(len(strings), len(encoded))
+            strings += encoded
+
+        file_entries = []
+        for relpath in sorted(self.files.keys()):
+            encoded = relpath.encode('utf-8')
+            path_offset = len(strings)
+            strings += encoded
+
+            section = bytearray()
+            previous_start = 0
+            intervals = sorted(self.files[relpath])
+            for start, end, test_id in intervals:
+                encode_varint(start - previous_start, section)
+                encode_varint(end - start, section)
+                encode_varint(test_id, section)
+                previous_start = start
+
+            file_entries.append((path_offset, len(encoded), len(intervals_data), len(section), len(intervals)))
+            intervals_data += section
+
+        strings_offset = HEADER.size
+        tests_offset = strings_offset + len(strings)
+        files_offset = tests_offset + len(tests_table)
+        intervals_offset = files_offset + FILE_ENTRY.size * len(file_entries)
+
+        for path_offset, path_length, section_offset, section_length, count in file_entries:
+            files_table += FILE_ENTRY.pack(path_offset, path_length, intervals_offset + section_offset, section_length, count)
+
+        header = HEADER.pack(MAGIC, self.VERSION, (self.commit or '').encode('ascii'), len(self.tests), len(file_entries), strings_offset, tests_offset, files_offset)
+
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(strings)
+            f.write(tests_table)
+            f.write(files_table)
+            f.write(intervals_data)
+
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read(root: str, path: str) -> 'MappedCoverageIndex':
+        return MappedCoverageIndex(root, path)
+
+
+class MappedCoverageIndex(BaseCoverageIndex):
+    # a recorded index, memory mapped so that only the parts that are queried are ever read
+    def __init__(self, root: str, path: str):
+        super(MappedCoverageIndex, self).__init__(root)
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, commit, self.test_count, self.file_count, self._strings_offset, self._tests_offset, self._files_offset = HEADER.unpack_from(self._data, 0)
+        if magic != MAGIC or version != self.VERSION:
+            self.close()
+            raise Exception("Unsupported coverage index '%s' (version %s)" % (path, version))
+
+        self.commit = commit.rstrip(b'\0').decode('ascii') or None
+        self._nodeids = {}
+        self._test_ids = None
+
+    def close(self):
+        self._data.close()
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings_offset + offset
+        return self._data[start:start + length].decode('utf-8')
+
+    def _nodeid(self, test_id: int) -> str:
+        try:
+            return self._nodeids[test_id]
+
+        except KeyError:
+            nodeid = self._nodeids[test_id] = self._string(*TEST_ENTRY.unpack_from(self._data, self._tests_offset + TEST_ENTRY.size * test_id))
+            return nodeid
+
+    @property
+    def tests(self) -> typing.List[str]:
+        return [self._nodeid(test_id) for test_id in range(self.test_count)]
+
+    def __contains__(self, nodeid: str) -> bool:
+        if self._test_ids is None:
+            self._test_ids = set(self.tests)
+
+        return nodeid in self._test_ids
+
+    def _find_file(self, relpath: str) -> typing.Union[typing.Tuple[int, int, int, int, int], None]:
+        encoded = relpath.encode('utf-8')
+        lo, hi = 0, self.file_count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = FILE_ENTRY.unpack_from(self._data, self._files_offset + FILE_ENTRY.size * mid)
+            start = self._strings_offset + entry[0]
+            candidate = self._data[start:start + entry[1]]
+
+            if candidate == encoded:
+                return entry
+
+            elif candidate < encoded:
+                lo = mid + 1
+
+            else:
+                hi = mid
+
+        return None
+
+    def _load_intervals(self, relpath: str) -> ListOfTestInterval:
+        entry = self._find_file(relpath)
+        if entry is None:
+            return []
+
+        _, _, section_offset, section_length, _ = entry
+        values = decode_varints(self._data[section_offset:section_offset + section_length])
+
+        intervals = []
+        start = 0
+        for i in range(0, len(values), 3):
+            start += values[i]
+            intervals.append((start, start + values[i + 1], values[i + 2]))
+
+        return intervals
+
+
+class CoverageIndexShards(object):
+    # the shards recorded by separate processes (e.g. xdist workers), queried together
+    def __init__(self, shards: typing.List[BaseCoverageIndex]):
+        self.shards = shards
+        self.commit = shards[0].commit
+
+    def relpath(self, path: str) -> str:
+        return self.shards[0].relpath(path)
+
+    def __contains__(self, nodeid: str) -> bool:
+        return any(nodeid in shard for shard in self.shards)
+
+    def tests_touching(self, relpath: str, first_line: int, last_line: int) -> SetOfString:
+        return set().union(*[shard.tests_touching(relpath, first_line, last_line) for shard in self.shards])
+
+    def tests_for_file(self, relpath: str) -> SetOfString:
+        return set().union(*[shard.tests_for_file(relpath) for shard in self.shards])
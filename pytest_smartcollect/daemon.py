@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import socket
+import typing
+import hashlib
+import logging
+import argparse
+import tempfile
+import socketserver
+import pytest
+from git import Repo
+from pytest_smartcollect.helpers import SmartCollector, ListOfTestItem
+from pytest_smartcollect.watch import make_watcher
+from pytest_smartcollect.ignore import IgnoreMatcher, IGNORE_FILE_NAME
+from pytest_smartcollect.records import dump_records
+
+# the daemon speaks JSON lines over a unix socket: one request per connection, answered by one response
+#
+#   {"command": "ping"}  ->  {"pid": ..., "requests": <number of selections answered>}
+#   {"command": "select", "rootdir": ..., "options": {...}, "lastfailed": [...], "sys_path": [...], "tests": [[nodeid, path, name, skipped, [marker, ...]], ...]}
+#       ->  {"head": ..., "base": ..., "tree": ..., "records": [[action, nodeid, reason], ...]}
+#   {"command": "shutdown"}  ->  {}
+#
+# any request can be answered with {"error": ...} instead
+
+
+def get_socket_path(repo_root: str) -> str:
+    # the path has to be the same for the daemon and for every pytest run in the repository, and short enough for a unix socket
+    key = hashlib.sha1(os.path.realpath(repo_root).encode('utf-8')).hexdigest()[:16]
+    user = str(os.getuid()) if hasattr(os, 'getuid') else os.environ.get('USERNAME', '')
+    return os.path.join(tempfile.gettempdir(), "pytest-smartcollect-%s-%s.sock" % (user, key))
+
+
+class MemoryCache(object):
+    # the part of the pytest cache that SmartCollector uses, kept in memory for as long as the daemon lives
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, default):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+
+class ItemDescriptor(object):
+    # what selection needs to know about a pytest item, so that items can be sent to the daemon
+    def __init__(self, nodeid: str, path: str, name: str, skipped: bool, markers: typing.Iterable[str]=()):
+        self.nodeid = nodeid
+        self.fspath = path
+        self.name = name
+        self.skipped = skipped
+        self.markers = set(markers)  # only those the data map selects tests by
+
+    def get_marker(self, name):
+        if name == 'skip':
+            return pytest.mark.skip.mark if self.skipped else None
+
+        return getattr(pytest.mark, name).mark if name in self.markers else None
+
+
+class DaemonClient(object):
+    # a daemon that takes longer than this to answer (e.g. stuck, or still analysing a large repository for the first time) is
+    # skipped, and the analysis runs in process
+    def __init__(self, socket_path: str, logger: logging.Logger, timeout: float=10.0):
+        self.socket_path = socket_path
+        self.logger = logger
+        self.timeout = timeout
+
+    def request(self, request: dict) -> typing.Union[dict, None]:
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.socket_path):
+            return None
+
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+                with sock.makefile('rb') as f:
+                    response = json.loads(f.readline().decode('utf-8'))
+
+            finally:
+                sock.close()
+
+        except (OSError, ValueError) as e:
+            self.logger.info("Couldn't reach the smart collection daemon at '%s' -- %s", self.socket_path, e)
+            return None
+
+        if 'error' in response:
+            self.logger.warning("The smart collection daemon couldn't compute the selection -- %s", response['error'])
+            return None
+
+        return response
+
+    def select(self, smart_collector: SmartCollector, items: ListOfTestItem) -> typing.Union[dict, None]:
+        markers = smart_collector.get_data_map().markers
+        response = self.request({
+            'command': 'select',
+            'rootdir': smart_collector.rootdir,
+            'options': {
+                'ignore_source': smart_collector.ignore_source,
+                'commit_range': smart_collector.commit_range,
+                'diff_current_head_with_branch': smart_collector.diff_current_head_with_branch,
+                'allow_preemptive_failures': smart_collector.allow_preemptive_failures,
+                'max_depth': smart_collector.max_depth,
+                'data_map': smart_collector.data_map
+            },
+            'lastfailed': list(smart_collector.lastfailed),
+            'sys_path': list(sys.path),
+            'tests': [
+                [test.nodeid, str(test.fspath), test.name, SmartCollector.has_skip_marker(test), [m for m in markers if test.get_marker(m)]] for test in items
+            ]
+        })
+
+        if response is not None:
+            self.logger.info("The smart collection selection was computed by the daemon at '%s'", self.socket_path)
+
+        return response
+
+
+class SelectionDaemon(socketserver.UnixStreamServer):
+    # keeps a SmartCollector per set of options alive, and everything they have analysed warm between pytest runs. files that
+    # change on disk (including by checkouts) are forgotten before the next selection
+    def __init__(self, repo_root: str, socket_path: str, logger: logging.Logger):
+        self.repo_root = repo_root
+        self.logger = logger
+        self.requests = 0
+        self.stopping = False
+        self.cache = MemoryCache()
+        self.smart_collectors = {}
+        # only the ignore file applies to every selection, whatever the options of the run asking for it
+        self.watcher = make_watcher(repo_root, IgnoreMatcher.from_rules([], repo_root, [os.path.join(repo_root, IGNORE_FILE_NAME)]))
+        socketserver.UnixStreamServer.__init__(self, socket_path, SelectionRequestHandler)
+
+    def get_smart_collector(self, rootdir: str, options: dict) -> SmartCollector:
+        key = json.dumps([rootdir, options], sort_keys=True)
+        if key not in self.smart_collectors:
+            self.smart_collectors[key] = SmartCollector(
+                rootdir,
+                [],
+                options['ignore_source'],
+                options['commit_range'],
+                options['diff_current_head_with_branch'],
+                options['allow_preemptive_failures'],
+                self.logger,
+                cache=self.cache,
+                max_depth=options['max_depth'],
+                data_map=options.get('data_map')
+            )
+            self.smart_collectors[key].keep_project_index = True
+
+        return self.smart_collectors[key]
+
+    def select(self, request: dict) -> dict:
+        changed = self.watcher.wait(timeout=0)
+        for smart_collector in self.smart_collectors.values():
+            smart_collector.forget(changed)
+
+        smart_collector = self.get_smart_collector(request['rootdir'], request['options'])
+        smart_collector.lastfailed = set(request['lastfailed'])
+
+        # modules outside of the project are looked for where the pytest run would find them (e.g. on the rootdir pytest added)
+        smart_collector.search_path = request['sys_path']
+        log_records = smart_collector.select([ItemDescriptor(*test) for test in request['tests']])
+        self.requests += 1
+
+        return {
+            'head': smart_collector.head_commit,
+            'base': smart_collector.base_commit,
+            'tree': smart_collector.head_tree,
+            'records': dump_records(log_records)
+        }
+
+    def handle(self, request: dict) -> dict:
+        command = request.get('command')
+
+        if command == 'ping':
+            return {'pid': os.getpid(), 'requests': self.requests}
+
+        elif command == 'select':
+            return self.select(request)
+
+        elif command == 'shutdown':
+            self.stopping = True
+            return {}
+
+        raise Exception("Unknown command '%s'" % command)
+
+    def serve(self):
+        while not self.stopping:
+            self.handle_request()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.watcher.close()
+        for smart_collector in self.smart_collectors.values():
+            smart_collector.close()
+
+        try:
+            os.remove(self.server_address)
+
+        except OSError:
+            pass
+
+
+class SelectionRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            response = self.server.handle(json.loads(self.rfile.readline().decode('utf-8')))
+
+        except Exception as e:
+            response = {'error': str(e)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m pytest_smartcollect.daemon', description='Keep the smart collection analysis of a git repository warm between pytest runs.')
+    parser.add_argument('--rootdir', default=os.getcwd(), help='A directory in the git repository to serve.  Default is the current working directory.')
+    parser.add_argument('--socket', default=None, help='The unix socket to listen on.  Default is derived from the repository path, which is where pytest looks for it.')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+    logger = logging.getLogger('pytest_smartcollect.daemon')
+
+    repo_root = Repo(args.rootdir, search_parent_directories=True).working_tree_dir
+    socket_path = args.socket or get_socket_path(repo_root)
+
+    if os.path.exists(socket_path):
+        if DaemonClient(socket_path, logger, timeout=5.0).request({'command': 'ping'}) is not None:
+            logger.warning("A smart collection daemon is already serving '%s' at '%s'", repo_root, socket_path)
+            return 1
+
+        os.remove(socket_path)  # left behind by a daemon that didn't exit cleanly
+
+    daemon = SelectionDaemon(repo_root, socket_path, logger)
+    logger.warning("Serving smart collection selections for '%s' at '%s'", repo_root, socket_path)
+
+    try:
+        daemon.serve()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        daemon.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
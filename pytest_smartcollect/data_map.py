@@ -0,0 +1,144 @@
+import os
+import sys
+import re
+import ast
+import typing
+from pytest_smartcollect.ignore import translate_glob
+
+# python 3.8 parses every literal into ast.Constant, and deprecates ast.Str
+STRING_NODES = (ast.Constant,) if sys.version_info >= (3, 8) else (ast.Str,)
+FUNCTION_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+ListOfString = typing.List[str]
+SetOfString = typing.Set[str]
+
+# a target of the data map that selects the tests with a marker, rather than the tests under a path
+MARKER_PREFIX = 'marker:'
+
+# string literals that could be paths of data files: no whitespace, and a file extension
+DATA_FILE_LITERAL = re.compile(r'^[^\s]*\.[A-Za-z0-9_]+$')
+
+
+class DataMap(object):
+    # which tests a change to a non-python file (e.g. a JSON fixture, an SQL migration or a template) affects, from ini lines of
+    # the form `glob = target [target ...]`. globs are relative to the rootdir (or match a file name anywhere if they have no
+    # slash), and targets are test paths or node ids relative to the rootdir, or `marker:name`
+    def __init__(self, rootdir: str):
+        self.rootdir = rootdir
+        self.rules = []  # (compiled glob, [path targets], [markers])
+
+    @classmethod
+    def parse(cls, lines: typing.Iterable[str], rootdir: str) -> 'DataMap':
+        data_map = cls(rootdir)
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            if '=' not in line:
+                raise Exception("Invalid smart collection data map line '%s' -- expected 'glob = target [target ...]'" % line)
+
+            pattern, targets = line.split('=', 1)
+            data_map.add(pattern.strip(), targets.split())
+
+        return data_map
+
+    def add(self, pattern: str, targets: ListOfString):
+        pattern = pattern.replace(os.sep, '/')
+        regex = translate_glob(pattern.lstrip('/')) if '/' in pattern else '(?:.*/)?' + translate_glob(pattern)
+        paths = [t.replace(os.sep, '/').rstrip('/') for t in targets if not t.startswith(MARKER_PREFIX)]
+        markers = [t[len(MARKER_PREFIX):] for t in targets if t.startswith(MARKER_PREFIX)]
+        self.rules.append((re.compile(regex + '\\Z'), paths, markers))
+
+    def find_targets(self, path: str) -> typing.Tuple[SetOfString, SetOfString]:
+        # the test paths and markers that a change to path selects
+        relpath = os.path.relpath(path, self.rootdir).replace(os.sep, '/')
+        paths = set()
+        markers = set()
+
+        for regex, rule_paths, rule_markers in self.rules:
+            if regex.match(relpath):
+                paths.update(rule_paths)
+                markers.update(rule_markers)
+
+        return paths, markers
+
+    @property
+    def markers(self) -> SetOfString:
+        return set(marker for _, _, markers in self.rules for marker in markers)
+
+    @staticmethod
+    def matches_path(nodeid: str, target: str) -> bool:
+        return nodeid == target or nodeid.startswith(target + '/') or nodeid.startswith(target + '::')
+
+
+def find_string_literals(node) -> SetOfString:
+    # the string literals in node that look like paths of data files, with forward slashes and without a leading ./
+    literals = set()
+    for child in ast.walk(node):
+        value = (child.value if hasattr(child, 'value') else child.s) if isinstance(child, STRING_NODES) else None
+        if isinstance(value, str) and len(value) < 256 and DATA_FILE_LITERAL.match(value):
+            literal = value.replace('\\', '/')
+            while literal.startswith('./'):
+                literal = literal[2:]
+
+            literals.add(literal)
+
+    return literals
+
+
+def find_path_suffixes(relpath: str) -> SetOfString:
+    # every way that a literal could refer to a file, e.g. `c.json`, `b/c.json` and `a/b/c.json` for a/b/c.json
+    parts = relpath.replace(os.sep, '/').split('/')
+    return set('/'.join(parts[i:]) for i in range(len(parts)))
+
+
+class DataReferenceIndex(object):
+    # the data file literals that each test of a test file can see: its own, those at module level, those in the rest of its
+    # class (e.g. setup methods and helpers) and those in the fixtures of the module that it requests
+    def __init__(self, module_ast: ast.Module):
+        self.module_literals = set()
+        self.literals = {}
+
+        fixtures = {}
+        functions = []
+        for node in module_ast.body:
+            if isinstance(node, FUNCTION_DEFINITIONS):
+                if self._is_fixture(node):
+                    fixtures[node.name] = find_string_literals(node)
+
+                else:
+                    functions.append(('', node, set()))
+
+            elif isinstance(node, ast.ClassDef):
+                methods = [child for child in node.body if isinstance(child, FUNCTION_DEFINITIONS)]
+                shared = set()
+                for child in node.body:
+                    if child not in methods or not child.name.startswith('test'):
+                        shared.update(find_string_literals(child))
+
+                functions.extend((node.name + '.', method, shared) for method in methods)
+
+            else:
+                self.module_literals.update(find_string_literals(node))
+
+        for prefix, node, shared in functions:
+            literals = find_string_literals(node) | shared
+            for arg in node.args.args:
+                literals.update(fixtures.get(arg.arg, set()))
+
+            self.literals[prefix + node.name] = literals
+
+    @staticmethod
+    def _is_fixture(node) -> bool:
+        for dec in node.decorator_list:
+            if isinstance(dec, ast.Call):
+                dec = dec.func
+
+            if (isinstance(dec, ast.Attribute) and dec.attr == 'fixture') or (isinstance(dec, ast.Name) and dec.id == 'fixture'):
+                return True
+
+        return False
+
+    def find_literals(self, test_name: str) -> SetOfString:
+        return self.literals.get(test_name, set()) | self.module_literals
@@ -0,0 +1,311 @@
+import os
+import re
+import ast
+import json
+import typing
+import fnmatch
+import configparser
+from pytest_smartcollect.data_map import STRING_NODES
+
+SetOfString = typing.Set[str]
+DictOfString = typing.Dict[str, str]
+
+# stands for every distribution, e.g. when an index url, a constraints file or an included requirements file changed
+ALL_DISTRIBUTIONS = '*'
+
+REQUIREMENT_FILE_PATTERNS = ('requirements*.txt', 'requirements*.in', 'constraints*.txt', '*-requirements.txt', '*_requirements.txt')
+LOCK_FILE_NAMES = ('poetry.lock', 'pdm.lock', 'uv.lock')
+
+REQUIREMENT_NAME = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+TOML_SECTION = re.compile(r'^\s*\[+\s*([^\]]+?)\s*\]+\s*$')
+TOML_KEY = re.compile(r'^\s*"?([A-Za-z0-9][A-Za-z0-9._-]*)"?\s*=\s*(.*)$')
+QUOTED_STRING = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+COMMENT = re.compile(r'(^|\s)#.*$')
+REQUIREMENT_OPTIONS = re.compile(r'\s(--?[A-Za-z].*)$')  # the options of a requirement line, e.g. --hash, follow its specifier
+
+# the keywords of setup() and the keys of setup.cfg and pyproject.toml that list requirements
+REQUIREMENT_KEYS = ('install_requires', 'extras_require', 'tests_require', 'setup_requires', 'dependencies', 'optional-dependencies', 'requires')
+
+
+def canonicalize_name(name: str) -> str:
+    # distribution names are compared as pip compares them (PEP 503), e.g. Foo_Bar and foo-bar are the same distribution
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def is_dependency_file(path: str) -> bool:
+    filename = os.path.basename(path)
+    if filename in LOCK_FILE_NAMES or filename in ('Pipfile', 'Pipfile.lock', 'setup.py', 'setup.cfg', 'pyproject.toml'):
+        return True
+
+    if os.path.basename(os.path.dirname(path)) == 'requirements' and os.path.splitext(filename)[-1] in ('.txt', '.in'):
+        return True
+
+    return any(fnmatch.fnmatch(filename, pattern) for pattern in REQUIREMENT_FILE_PATTERNS)
+
+
+def is_lock_file(path: str) -> bool:
+    # lock files pin every distribution that is installed, including the ones that are only required by other distributions
+    return os.path.basename(path) in LOCK_FILE_NAMES + ('Pipfile.lock',)
+
+
+def strip_toml_comment(line: str) -> str:
+    # a # starts a comment unless it is in a string, e.g. the fragment of a url requirement
+    quote = None
+    for i, c in enumerate(line):
+        if quote is None and c == '#':
+            return line[:i]
+
+        if c in '"\'' and quote in (None, c):
+            quote = c if quote is None else None
+
+    return line
+
+
+def join_lines(lines: typing.Iterable[str]) -> typing.Iterator[str]:
+    # the logical lines of a requirements file, where a line that ends with a backslash continues on the next one
+    joined = ''
+    for line in lines:
+        stripped = line.rstrip()
+        if stripped.endswith('\\'):
+            joined += stripped[:-1] + ' '
+            continue
+
+        yield joined + line
+        joined = ''
+
+    if joined:
+        yield joined
+
+
+def parse_requirements(lines: typing.Iterable[str]) -> DictOfString:
+    # requirement specifiers by distribution name, along with their options (e.g. --hash). global options (e.g. --index-url,
+    # or -r to include another file) and requirements that aren't named (e.g. urls and editable checkouts) might change any
+    # distribution
+    requirements = {}
+    for line in join_lines(lines):
+        line = COMMENT.sub('', line).strip()
+        if not line:
+            continue
+
+        match = REQUIREMENT_NAME.match(line)
+        if line.startswith('-') or '://' in line or match is None:
+            requirements[ALL_DISTRIBUTIONS] = requirements.get(ALL_DISTRIBUTIONS, '') + ' '.join(line.split()) + '\n'
+            continue
+
+        name = canonicalize_name(match.group(1))
+        spec = line[match.end():]
+        options = ''
+
+        match = REQUIREMENT_OPTIONS.search(spec)
+        if match is not None:
+            spec, options = spec[:match.start()], ' ' + ' '.join(sorted(re.split(r'\s+(?=-)', match.group(1))))
+
+        requirements[name] = requirements.get(name, '') + re.sub(r'\s+', '', spec) + options + '\n'
+
+    return requirements
+
+
+def parse_lock_file(text: str) -> DictOfString:
+    # the [[package]] tables of a lock file (poetry, pdm, uv), by the name of the distribution they pin
+    packages = {}
+    name = None
+    block = []
+
+    def add():
+        if name is not None:
+            packages[canonicalize_name(name)] = packages.get(canonicalize_name(name), '') + '\n'.join(block)
+
+    for line in text.splitlines():
+        section = TOML_SECTION.match(line)
+        if section is not None and not section.group(1).startswith('package.'):
+            add()
+            name = None
+            block = []
+            if line.strip() != '[[package]]':  # e.g. [metadata], which only changes along with the packages
+                block = None
+
+            continue
+
+        if block is None:
+            continue
+
+        block.append(line)
+        key = TOML_KEY.match(line)
+        if key is not None and key.group(1) == 'name' and name is None:
+            name = key.group(2).strip().strip('"\'')
+
+    add()
+    return packages
+
+
+def parse_pipfile_lock(text: str) -> DictOfString:
+    packages = {}
+    lock = json.loads(text) if text.strip() else {}
+    for section in ('default', 'develop'):
+        for name, spec in lock.get(section, {}).items():
+            packages[canonicalize_name(name)] = json.dumps(spec, sort_keys=True)
+
+    return packages
+
+
+def parse_setup_py(text: str) -> DictOfString:
+    # the requirements passed to setup() as literals. anything computed (e.g. read from a file) is only found if that file is
+    # a dependency file as well
+    requirements = []
+    for node in ast.walk(ast.parse(text)):
+        if isinstance(node, ast.keyword) and node.arg in REQUIREMENT_KEYS:
+            for child in ast.walk(node.value):
+                value = (child.value if hasattr(child, 'value') else child.s) if isinstance(child, STRING_NODES) else None
+                if isinstance(value, str):
+                    requirements.append(value)
+
+    return parse_requirements(requirements)
+
+
+def parse_setup_cfg(text: str) -> DictOfString:
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text)
+    requirements = []
+
+    for section in parser.sections():
+        for key, value in parser.items(section):
+            if key in REQUIREMENT_KEYS or section == 'options.extras_require':
+                requirements.extend(value.splitlines())
+
+    return parse_requirements(requirements)
+
+
+def parse_toml_requirements(text: str) -> DictOfString:
+    # pyproject.toml and Pipfile, without a toml parser: the `name = spec` lines of dependency tables (poetry, Pipfile), and
+    # the requirement strings of dependency arrays (PEP 621, build-system.requires)
+    requirements = {}
+    section = ''
+    in_array = False
+
+    for line in text.splitlines():
+        stripped = strip_toml_comment(line).strip()
+        match = TOML_SECTION.match(stripped) if not in_array else None
+        if match is not None:
+            section = match.group(1)
+            continue
+
+        key = TOML_KEY.match(stripped) if not in_array else None
+        is_dependency_table = section.split('.')[-1] in ('dependencies', 'dev-dependencies', 'packages', 'dev-packages')
+
+        if key is not None and (key.group(1) in REQUIREMENT_KEYS or section.endswith('optional-dependencies')):
+            values = key.group(2)
+            in_array = values.startswith('[') and ']' not in values
+
+        elif key is not None and is_dependency_table:
+            requirements[canonicalize_name(key.group(1))] = re.sub(r'\s+', '', key.group(2))
+            continue
+
+        elif in_array:
+            values = stripped
+            in_array = ']' not in values
+
+        else:
+            continue
+
+        strings = [m.group(1) if m.group(1) is not None else m.group(2) for m in QUOTED_STRING.finditer(values)]
+        for name, spec in parse_requirements(strings).items():
+            requirements[name] = requirements.get(name, '') + spec
+
+    return requirements
+
+
+def parse_dependency_file(path: str, text: str) -> DictOfString:
+    filename = os.path.basename(path)
+    if filename in LOCK_FILE_NAMES:
+        return parse_lock_file(text)
+
+    elif filename == 'Pipfile.lock':
+        return parse_pipfile_lock(text)
+
+    elif filename == 'setup.py':
+        return parse_setup_py(text)
+
+    elif filename == 'setup.cfg':
+        return parse_setup_cfg(text)
+
+    elif filename in ('pyproject.toml', 'Pipfile'):
+        return parse_toml_requirements(text)
+
+    return parse_requirements(text.splitlines())
+
+
+def find_changed_distributions(path: str, old_text: str, new_text: str) -> SetOfString:
+    # the distributions that were added, removed or pinned differently, by canonical name
+    try:
+        old = parse_dependency_file(path, old_text)
+        new = parse_dependency_file(path, new_text)
+
+    except (SyntaxError, ValueError, configparser.Error):  # a file that can't be parsed might have changed anything
+        return {ALL_DISTRIBUTIONS}
+
+    return set(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+
+def find_top_level_names(files: typing.Iterable[str]) -> SetOfString:
+    # the importable top level names of the files installed by a distribution (its RECORD)
+    names = set()
+    for f in files:
+        parts = f.replace('\\', '/').split('/')
+        top = parts[0]
+        if top in ('..', '__pycache__') or top.endswith(('.dist-info', '.egg-info', '.data', '.pth')):
+            continue
+
+        if len(parts) > 1:
+            names.add(top)
+
+        elif top.endswith('.py'):
+            names.add(top[:-3])
+
+        elif re.search(r'\.(so|pyd)$', top):
+            names.add(top.split('.')[0])
+
+    return names
+
+
+def find_distribution_import_names(search_path: typing.List[str]) -> typing.Dict[str, SetOfString]:
+    # the top level import names of each distribution installed on the search path, by canonical name. the metadata is only
+    # read, nothing is imported
+    import_names = {}
+
+    try:
+        from importlib import metadata
+
+    except ImportError:  # python < 3.8
+        metadata = None
+
+    if metadata is not None:
+        for dist in metadata.distributions(path=search_path):
+            name = dist.metadata['Name']
+            if not name:
+                continue
+
+            top_level = dist.read_text('top_level.txt')
+            names = set(top_level.split()) if top_level else find_top_level_names(str(f) for f in dist.files or [])
+            import_names.setdefault(canonicalize_name(name), set()).update(names)
+
+        return import_names
+
+    import pkg_resources
+    for dist in pkg_resources.WorkingSet(search_path):
+        if dist.has_metadata('top_level.txt'):
+            names = set(dist.get_metadata_lines('top_level.txt'))
+
+        elif dist.has_metadata('RECORD'):
+            names = find_top_level_names(line.split(',')[0] for line in dist.get_metadata_lines('RECORD'))
+
+        else:
+            names = set()
+
+        import_names.setdefault(canonicalize_name(dist.project_name), set()).update(names)
+
+    return import_names
+
+
+def guess_import_names(distribution: str) -> SetOfString:
+    # for distributions that aren't installed (e.g. ones that were just added or removed), the name they are usually imported by
+    return {distribution.replace('-', '_')} if distribution != ALL_DISTRIBUTIONS else set()
@@ -2,12 +2,26 @@ import re
 import os
 import sys
 import ast
+import time
 import pytest
 import typing
+import difflib
+import hashlib
 import logging
+import sysconfig
+import subprocess
+from collections import deque, namedtuple, OrderedDict
 from git import Repo
-from importlib import import_module
+from importlib.machinery import PathFinder, FrozenImporter
 from chardet import UniversalDetector
+from pytest_smartcollect.selection import SharedSelection, SelectionArtifact
+from pytest_smartcollect.coverage_index import CoverageIndex, lines_to_intervals
+from pytest_smartcollect.history import RunHistory
+from pytest_smartcollect.ignore import IgnoreMatcher, IGNORE_FILE_NAME
+from pytest_smartcollect.report import SelectionReport
+from pytest_smartcollect.data_map import DataMap, DataReferenceIndex, find_path_suffixes
+from pytest_smartcollect.dependencies import ALL_DISTRIBUTIONS, is_dependency_file, is_lock_file, find_changed_distributions, find_distribution_import_names, guess_import_names
+from pytest_smartcollect.records import Reason, DependencyChain, LogRecord, ListOfLogRecord, load_records
 
 ListOrNone = typing.Union[list, None]
 StrOrNone = typing.Union[str, None]
@@ -15,18 +29,49 @@ ListOfString = typing.List[str]
 DictOfListOfString = typing.Dict[str, ListOfString]
 DictOfString = typing.Dict[str, str]
 ListOfTestItem = typing.List[pytest.Item]
+ListOfHunk = typing.List[typing.Tuple[int, int, int, int]]
 
 
 class ChangedFile(object):
-    def __init__(self, change_type: str, current_filepath: str, old_filepath: StrOrNone=None, changed_lines: ListOrNone=None):
+    def __init__(self, change_type: str, current_filepath: str, old_filepath: StrOrNone=None, changed_lines: ListOrNone=None, hunks: ListOrNone=None, unchanged_members: typing.Optional[typing.Set[str]]=None, removed_members: typing.Optional[typing.Set[str]]=None):
         self.change_type = change_type
         self.old_filepath = old_filepath
         self.current_filepath = current_filepath
         self.changed_lines = changed_lines
+        self.hunks = hunks
+        self.unchanged_members = unchanged_members or set()
+        self.removed_members = removed_members or set()  # definitions of the base version that are gone, which no changed line points at
 
 
 DictOfChangedFile = typing.Dict[str, ChangedFile]
 
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', re.MULTILINE)
+
+# the hash of the tree with nothing in it, which git knows of in every repository
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+FINGERPRINTS_CACHE_KEY = 'smartcollect/fingerprints'
+
+SKIP_REASON = "This test doesn't touch new or modified code"
+
+BUDGET_SKIP_REASON = "This test doesn't fit into the smart collection time budget"
+
+# files that mark the root of a subproject, e.g. one service in a monorepo
+SUBPROJECT_MARKERS = ('setup.py', 'setup.cfg', 'pyproject.toml')
+
+ModuleInfo = namedtuple('ModuleInfo', ['ast', 'definitions', 'qualified_names', 'assigned_names', 'imported_names_and_modules', 'imported_modules'])
+
+# what an object uses: names it uses as a whole, and names of which it only uses some attributes (name -> attributes)
+Usage = namedtuple('Usage', ['names', 'attributes', 'self_attributes', 'self_escapes'])
+
+# using any attribute of an instance means that it was constructed first
+CONSTRUCTOR_NAMES = ('__new__', '__init__')
+
+FUNCTION_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef)
+DEFINITIONS = FUNCTION_DEFINITIONS + (ast.ClassDef,)
+# ast.AnnAssign is new in python 3.6
+ASSIGNMENTS = tuple(getattr(ast, name) for name in ('Assign', 'AnnAssign', 'AugAssign') if hasattr(ast, name))
+
 
 class GenericVisitor(ast.NodeVisitor):
     def __init__(self):
@@ -76,11 +121,150 @@ class DefinitionNodeExtractor(GenericVisitor):
     def visit_FunctionDef(self, node):
         self.cache.append(node)
 
+    visit_AsyncFunctionDef = visit_FunctionDef
+
     def visit_ClassDef(self, node):
         self.cache.append(node)
         self.generic_visit(node)
 
 
+class QualifiedDefinitionExtractor(GenericVisitor):
+    # (qualified name, node) of every class and function, e.g. 'Class', 'Class.method' and 'Class.Nested.method' -- functions nested
+    # in functions are part of the function they are nested in, rather than definitions of their own
+    def __init__(self):
+        super(QualifiedDefinitionExtractor, self).__init__()
+        self._prefix = []
+
+    def visit_FunctionDef(self, node):
+        self.cache.append(('.'.join(self._prefix + [node.name]), node))
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self.cache.append(('.'.join(self._prefix + [node.name]), node))
+        self._prefix.append(node.name)
+        self.generic_visit(node)
+        self._prefix.pop()
+
+
+class UsageExtractor(object):
+    # the names used by an object, narrowed down to the attributes it uses wherever that can be told statically: `Name.attr`,
+    # `Name().attr`, `x = Name(); x.attr` and `self.attr`. an instance that escapes (e.g. is passed on or returned) uses all of its class
+    def extract(self, node) -> Usage:
+        parents = {}
+        for parent in ast.walk(node):
+            for child in ast.iter_child_nodes(parent):
+                parents[child] = parent
+
+        # local names bound to exactly one kind of instance, and nothing else
+        instances = {}
+        rebound = set()
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+                class_name = self._instantiated_class(parents.get(child))
+                if class_name is None or instances.setdefault(child.id, class_name) != class_name:
+                    rebound.add(child.id)
+
+        for name in rebound:
+            instances.pop(name, None)
+
+        names = set()
+        attributes = {}
+        self_attributes = set()
+        self_escapes = False
+
+        for child in ast.walk(node):
+            if not isinstance(child, ast.Name) or not isinstance(child.ctx, ast.Load):
+                continue
+
+            parent = parents.get(child)
+            if isinstance(parent, ast.Attribute) and parent.value is child:
+                if child.id in ('self', 'cls'):
+                    self_attributes.add(parent.attr)
+
+                else:
+                    attributes.setdefault(instances.get(child.id, child.id), set()).add(parent.attr)
+
+            elif isinstance(parent, ast.Call) and parent.func is child:
+                grandparent = parents.get(parent)
+                if isinstance(grandparent, ast.Attribute) and grandparent.value is parent:
+                    attributes.setdefault(child.id, set()).update((grandparent.attr,) + CONSTRUCTOR_NAMES)
+
+                elif self._instantiated_class(grandparent) == child.id and grandparent.targets[0].id in instances:
+                    attributes.setdefault(child.id, set()).update(CONSTRUCTOR_NAMES)
+
+                else:
+                    names.add(child.id)
+
+            elif child.id in instances:
+                names.add(instances[child.id])
+
+            else:  # everything else that is read (e.g. passed to a call, returned, compared or used as a decorator) is used as a whole
+                if child.id in ('self', 'cls'):
+                    self_escapes = True
+
+                else:
+                    names.add(child.id)
+
+        return Usage(names, attributes, self_attributes, self_escapes)
+
+    @staticmethod
+    def _instantiated_class(node) -> StrOrNone:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and \
+                isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Name):
+            return node.value.func.id
+
+        return None
+
+
+class DefinitionFingerprinter(ast.NodeVisitor):
+    # a hash of a definition that doesn't change with formatting, comments, docstrings or position in the file
+    VERSION = 3
+
+    def __init__(self):
+        super(DefinitionFingerprinter, self).__init__()
+        self._parts = []
+        self._without_members = None
+
+    def fingerprint(self, node, without_members: bool=False) -> str:
+        # without_members leaves the methods and nested classes out of a class, as they are fingerprinted separately
+        self._parts = []
+        self._without_members = node if without_members else None
+        self.visit(node)
+        return hashlib.sha1('\n'.join(self._parts).encode('utf-8')).hexdigest()
+
+    def generic_visit(self, node):
+        self._parts.append(type(node).__name__)
+
+        for name, value in ast.iter_fields(node):
+            if name == 'body' and isinstance(node, DEFINITIONS) and self._is_docstring(value[0]):
+                value = value[1:]
+
+            if name == 'body' and node is self._without_members:
+                value = [item for item in value if not isinstance(item, DEFINITIONS)]
+
+            if isinstance(value, list):
+                self._parts.append('%s[%d]' % (name, len(value)))
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        self.visit(item)
+
+                    else:
+                        self._parts.append(repr(item))
+
+            elif isinstance(value, ast.AST):
+                self._parts.append(name)
+                self.visit(value)
+
+            else:
+                self._parts.append('%s=%r' % (name, value))
+
+    @staticmethod
+    def _is_docstring(node) -> bool:
+        # string literals are ast.Str before python 3.8 and ast.Constant after
+        return isinstance(node, ast.Expr) and isinstance(getattr(node.value, 'value', getattr(node.value, 's', None)), str)
+
+
 class ImportModuleNameExtractor(GenericVisitor):
     def __init__(self):
         super(ImportModuleNameExtractor, self).__init__()
@@ -93,6 +277,20 @@ class ImportModuleNameExtractor(GenericVisitor):
         self.cache.append((node.module, names, node.level))
 
 
+class ModuleBindingExtractor(GenericVisitor):
+    # (bound name, module name) of every plain import -- `import a.b` binds a, and `import a.b as c` binds c to a.b
+    def __init__(self):
+        super(ModuleBindingExtractor, self).__init__()
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.asname is None:
+                self.cache.append((alias.name.split('.')[0], alias.name.split('.')[0]))
+
+            else:
+                self.cache.append((alias.asname, alias.name))
+
+
 class FixtureExtractor(GenericVisitor):
     def __init__(self):
         super(FixtureExtractor, self).__init__()
@@ -100,6 +298,9 @@ class FixtureExtractor(GenericVisitor):
     def visit_FunctionDef(self, node):
         if len(node.decorator_list) > 0:
             for dec in node.decorator_list:
+                if isinstance(dec, ast.Call):  # e.g. @pytest.fixture(scope='module')
+                    dec = dec.func
+
                 if isinstance(dec, ast.Attribute):
                     if dec.attr == 'fixture':
                         self.cache.append(node)
@@ -108,9 +309,324 @@ class FixtureExtractor(GenericVisitor):
                     if dec.id == 'fixture':
                         self.cache.append(node)
 
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+
+class BlobReader(object):
+    # reads objects through a single long running 'git cat-file --batch' process, keeping the most recently used ones decoded
+    def __init__(self, repo_path: str, cache_size: int=256):
+        self.repo_path = repo_path
+        self.cache_size = cache_size
+        self._contents = OrderedDict()
+        self._process = None
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.repo_path
+        )
+
+    def read(self, obj: str) -> StrOrNone:
+        # obj can be anything that git understands as an object name, e.g. a blob hash or "<commit>:<path>"
+        try:
+            self._contents.move_to_end(obj)
+            return self._contents[obj]
+
+        except KeyError:
+            pass
+
+        if self._process is None:
+            self._start()
+
+        self._process.stdin.write(obj.encode('utf-8') + b'\n')
+        self._process.stdin.flush()
+
+        header = self._process.stdout.readline().decode('utf-8').split()
+        if not header:
+            raise Exception("git cat-file exited unexpectedly while reading '%s'" % obj)
+
+        if header[-1] == 'missing' or header[-1] == 'ambiguous':
+            return None
+
+        size = int(header[2])
+        data = self._process.stdout.read(size)
+        self._process.stdout.read(1)  # the newline that terminates every object
+
+        contents = data.decode('utf-8', 'replace')
+        self._contents[obj] = contents
+        if len(self._contents) > self.cache_size:
+            self._contents.popitem(last=False)
+
+        return contents
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ModuleClassifier(object):
+    BUILTIN = 'builtin'
+    STDLIB = 'stdlib'
+    SITE_PACKAGES = 'site-packages'
+    PROJECT = 'project'
+
+    CACHE_KEY = 'smartcollect/module_classes'
+
+    def __init__(self, project_names: typing.Set[str], cache=None, project_root: StrOrNone=None, search_path: typing.Optional[ListOfString]=None):
+        self.project_names = project_names
+        self.cache = cache
+        self.project_root = os.path.normcase(os.path.abspath(project_root)) if project_root is not None else None
+        self.search_path = search_path  # where modules are looked for, sys.path by default
+
+        # the entries of the search path in the project (e.g. the test folders that pytest added) only ever find project modules,
+        # so only the others tell environments apart
+        external_path = [
+            entry for entry in (search_path if search_path is not None else sys.path)
+            if self.project_root is None or os.path.commonpath([os.path.normcase(os.path.abspath(entry)), self.project_root]) != self.project_root
+        ]
+        self.environment = "%s %s %s %s" % (sys.executable, sys.version, self.project_root, os.pathsep.join(external_path))
+        self.stdlib_dir = os.path.normcase(os.path.abspath(sysconfig.get_paths()['stdlib']))
+        self.classes = {}
+        self._dirty = False
+
+        # classifications of modules outside of the project only depend on the interpreter, so they can be reused across runs
+        if self.cache is not None:
+            persisted = self.cache.get(self.CACHE_KEY, {})
+            if persisted.get('environment') == self.environment:
+                self.classes = persisted.get('modules', {})
+
+    def classify(self, module_name: str) -> str:
+        top_level_name = module_name.split('.')[0]
+
+        # project modules can shadow anything installed in the environment, so they always take precedence
+        if top_level_name in self.project_names:
+            return self.PROJECT
+
+        try:
+            return self.classes[top_level_name]
+
+        except KeyError:
+            module_class = self._find_module_class(top_level_name)
+            if module_class is not None:
+                self.classes[top_level_name] = module_class
+                self._dirty = True
+
+            else:  # modules that can't be found aren't remembered, since they might be installed later
+                module_class = self.SITE_PACKAGES
+
+            return module_class
+
+    def is_project_module(self, module_name: str) -> bool:
+        return self.classify(module_name) == self.PROJECT
+
+    def save(self):
+        if self.cache is not None and self._dirty:
+            self.cache.set(self.CACHE_KEY, {'environment': self.environment, 'modules': self.classes})
+            self._dirty = False
+
+    def _find_module_class(self, top_level_name: str) -> StrOrNone:
+        if top_level_name in sys.builtin_module_names or FrozenImporter.find_spec(top_level_name) is not None:
+            return self.BUILTIN
+
+        # PathFinder only searches the filesystem, so nothing gets imported here
+        spec = PathFinder.find_spec(top_level_name, self.search_path)
+        if spec is None:
+            return None
+
+        if spec.origin is not None and spec.origin not in ('namespace', 'built-in', 'frozen'):
+            location = spec.origin
+
+        elif spec.submodule_search_locations:
+            location = list(spec.submodule_search_locations)[0]
+
+        else:
+            return self.BUILTIN
+
+        location = os.path.normcase(os.path.abspath(location))
+        parts = location.split(os.sep)
+        if 'site-packages' in parts or 'dist-packages' in parts:
+            return self.SITE_PACKAGES
+
+        # e.g. another subproject of a monorepo that is imported by the one under test
+        if self.project_root is not None and os.path.commonpath([location, self.project_root]) == self.project_root:
+            return self.PROJECT
+
+        if os.path.commonpath([location, self.stdlib_dir]) == self.stdlib_dir:
+            return self.STDLIB
+
+        return self.SITE_PACKAGES
+
+
+class ProjectIndex(object):
+    CACHE_KEY = 'smartcollect/project_index'
+
+    # bumped whenever what is indexed changes, so that indexes cached by older versions are rebuilt
+    VERSION = 2
+
+    def __init__(self, root: str):
+        self.root = root
+        self.packages = []
+        self.module_names = {}
+        self.importable_names = set()
+        self._module_paths = None
+
+    def build(self, ignore_matcher: typing.Optional[IgnoreMatcher]=None):
+        self.packages = []
+        self.module_names = {}
+        self.importable_names = set()
+        self._module_paths = None
+        import_roots = {os.path.abspath(self.root), os.path.abspath(os.path.join(self.root, 'src'))}
+        entries = {}
+
+        for root, dirs, files in os.walk(self.root):
+            if '.git' in dirs:
+                dirs.remove('.git')
+
+            if ignore_matcher is not None:
+                ignore_matcher.prune(root, dirs)
+
+            abs_root = os.path.abspath(root)
+            entries[abs_root] = (list(dirs), [os.path.splitext(f)[0] for f in files if os.path.splitext(f)[-1] == '.py'])
+
+            if '__init__.py' in files:
+                self.packages.append(abs_root)
+                parent_name = self.module_names.get(os.path.dirname(abs_root))
+                package_name = os.path.basename(abs_root) if parent_name is None else "%s.%s" % (parent_name, os.path.basename(abs_root))
+                self.module_names[abs_root] = package_name
+
+            else:
+                package_name = None
+
+            for f in files:
+                name, ext = os.path.splitext(f)
+                if ext == '.py':
+                    self.module_names[os.path.join(abs_root, f)] = name if package_name is None else "%s.%s" % (package_name, name)
+
+            # pytest puts the first folder above a test module or conftest.py that isn't a package on sys.path
+            if any(f == 'conftest.py' or f.startswith('test_') or f.endswith('_test.py') for f in files):
+                base = abs_root
+                while base in self.module_names:
+                    base = os.path.dirname(base)
+
+                import_roots.add(base)
+
+        # the top level packages and modules on the import roots. other project modules that are importable (e.g. through a
+        # .pth file) are still classified by where they are found
+        for import_root in import_roots:
+            dirs, modules = entries.get(import_root, ([], []))
+            self.importable_names.update(d for d in dirs if os.path.join(import_root, d) in self.module_names)
+            self.importable_names.update(modules)
+
+    def module_name(self, path: str) -> str:
+        try:
+            return self.module_names[path]
+
+        except KeyError:  # paths outside of the index (or created after it was built) are resolved the slow way
+            name = SmartCollector.find_fully_qualified_module_name(path)
+            self.module_names[path] = name
+            return name
+
+    def find_module_path(self, module_name: str) -> StrOrNone:
+        # the file of a module by name. modules are found by their fully qualified names, and, as long as no other module has
+        # the same name, by their names relative to any package they are in
+        if self._module_paths is None:
+            self._module_paths = {}
+            suffixes = {}
+
+            for path, name in self.module_names.items():
+                if os.path.basename(path) == '__init__.py':  # the package itself is keyed by its directory
+                    continue
+
+                module_path = os.path.join(path, '__init__.py') if os.path.isdir(path) else path
+                self._module_paths.setdefault(name, module_path)
+
+                parts = name.split('.')
+                for i in range(1, len(parts)):
+                    suffixes.setdefault('.'.join(parts[i:]), set()).add(module_path)
+
+            # e.g. a utils module in two packages can't tell which one is meant, so neither is guessed
+            for name, module_paths in suffixes.items():
+                if len(module_paths) == 1:
+                    self._module_paths.setdefault(name, module_paths.pop())
+
+        return self._module_paths.get(module_name)
+
+    def add(self, path: str):
+        # a module created after the index was built
+        self.module_name(path)
+        self._module_paths = None
+
+    def remove(self, path: str):
+        # a module deleted after the index was built
+        self.module_names.pop(path, None)
+        self._module_paths = None
+
+    def has_top_level_name(self, module_name: str) -> bool:
+        self.find_module_path(module_name)
+        return module_name.split('.')[0] in self._module_paths
+
+    @classmethod
+    def merge(cls, root: str, shards: typing.List['ProjectIndex']) -> 'ProjectIndex':
+        index = cls(root)
+        for shard in shards:
+            index.packages.extend(shard.packages)
+            index.module_names.update(shard.module_names)
+            index.importable_names.update(shard.importable_names)
+
+        return index
+
+    def to_dict(self, tree: str, ignore_key: StrOrNone=None) -> dict:
+        return {
+            'version': self.VERSION,
+            'root': self.root,
+            'tree': tree,
+            'ignore': ignore_key,
+            'packages': self.packages,
+            'module_names': self.module_names,
+            'importable_names': sorted(self.importable_names)
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ProjectIndex':
+        index = cls(d['root'])
+        index.packages = d['packages']
+        index.module_names = d['module_names']
+        index.importable_names = set(d['importable_names'])
+        return index
+
+
+class ChangedMembers(dict):
+    # the changed members of changed files by path, which are only worked out when a path is first looked up -- in a big
+    # repository, most of the changed files are never reached from the tests that are run
+    def __init__(self, find_changed_members: typing.Callable[[ChangedFile], ListOfString], changed_files: DictOfChangedFile):
+        super(ChangedMembers, self).__init__()
+        self._find_changed_members = find_changed_members
+        self._pending = dict(changed_files)
+
+    def get(self, path, default=None):
+        if path in self._pending:
+            self[path] = self._find_changed_members(self._pending.pop(path))
+
+        return super(ChangedMembers, self).get(path, default)
+
+    def setdefault(self, path, default=None):
+        self.get(path)
+        return super(ChangedMembers, self).setdefault(path, default)
+
 
 class SmartCollector(object):
-    def __init__(self, rootdir: str, lastfailed: ListOfString, ignore_source: ListOfString, commit_range: int, diff_current_head_with_branch: str, allow_preemptive_failures: bool, logger: logging.Logger):
+    def __init__(self, rootdir: str, lastfailed: ListOfString, ignore_source: ListOfString, commit_range: int, diff_current_head_with_branch: str, allow_preemptive_failures: bool, logger: logging.Logger, cache=None, max_depth: typing.Optional[int]=None, coverage_index: typing.Optional[CoverageIndex]=None, daemon=None, report: typing.Optional[SelectionReport]=None, data_map: typing.Optional[ListOfString]=None):
         self.rootdir = rootdir
         self.lastfailed = lastfailed
         self.ignore_source = ignore_source
@@ -118,7 +634,37 @@ class SmartCollector(object):
         self.diff_current_head_with_branch = diff_current_head_with_branch
         self.allow_preemptive_failures = allow_preemptive_failures
         self.logger = logger
+        self.cache = cache
+        self.max_depth = max_depth
+        self.coverage_index = coverage_index
+        self.daemon = daemon
+        self.report = report
+        self.data_map = data_map
+        self.search_path = None  # where modules outside of the project index are looked for, sys.path by default
+        self.keep_project_index = False  # set by long running owners (the daemon and watch mode), which forget() every file that changes on disk
         self.packages = []
+        self.head_commit = None
+        self.base_commit = None
+        self.head_tree = None
+        self.project_index = None
+        self.module_classifier = None
+        self.changed_data_files = []  # the non-python files in the diff, which the data map and data file literals select tests for
+        self.changed_dependencies = {}  # dependency file (e.g. requirements.txt) -> the distributions whose requirement changed in it
+        self._git_repo_roots = {}
+        self._scope_roots = None
+        self._module_infos = {}
+        self._module_asts = {}
+        self._exported_names = {}
+        self._star_importers = {}
+        self._module_paths = {}
+        self._chains = {}
+        self._blob_reader = None
+        self._ignore_matcher = None
+        self._data_map = None
+        self._data_references = {}
+        self._module_imports = {}
+        self._third_party_imports = {}
+        self._unchanged_objects = (None, set())
         self.encoding_detector = UniversalDetector()
 
     def read_file(self, fpath):
@@ -152,15 +698,93 @@ class SmartCollector(object):
         return contents, linecount
 
     def find_git_repo_root(self, dir: str) -> str:
+        try:
+            return self._git_repo_roots[dir]
+
+        except KeyError:
+            pass
+
         if ".git" in os.listdir(dir):
-            return dir
+            root = dir
 
         else:
             if os.path.dirname(dir) == dir:
                 raise Exception("No git repo found relative to the pytest rootdir")
 
             else:
-                return self.find_git_repo_root(os.path.dirname(dir))
+                root = self.find_git_repo_root(os.path.dirname(dir))
+
+        self._git_repo_roots[dir] = root
+        return root
+
+    @staticmethod
+    def find_worktree_key(repo: Repo, relpath: str='.') -> StrOrNone:
+        # the tree hash of HEAD only describes the working tree if there are no local changes
+        try:
+            if repo.is_dirty(untracked_files=True, path=relpath):
+                return None
+
+            tree = repo.head.commit.tree
+            return tree.hexsha if relpath == '.' else (tree / relpath.replace(os.sep, '/')).hexsha
+
+        except (ValueError, KeyError):  # no commits yet, or nothing committed under relpath
+            return None
+
+    def find_scope_roots(self, items: ListOfTestItem, git_repo_root: str) -> ListOfString:
+        # the subprojects that the collected tests belong to, so that the rest of a monorepo can be left alone. a test that isn't
+        # in a subproject belongs to the whole repository
+        git_repo_root = os.path.abspath(git_repo_root)
+        roots_by_dir = {}
+        roots = set()
+
+        for test_dir in set(os.path.dirname(os.path.abspath(str(test.fspath))) for test in items):
+            d = test_dir
+            visited = []
+
+            while d not in roots_by_dir:
+                visited.append(d)
+                if d == git_repo_root or os.path.dirname(d) == d or any(os.path.exists(os.path.join(d, m)) for m in SUBPROJECT_MARKERS):
+                    roots_by_dir[d] = d
+                    break
+
+                d = os.path.dirname(d)
+
+            for v in visited:
+                roots_by_dir[v] = roots_by_dir[d]
+
+            roots.add(roots_by_dir[d])
+
+        if not roots or git_repo_root in roots:
+            return [git_repo_root]
+
+        # a subproject nested in another one is covered by the outer one
+        return sorted(r for r in roots if not any(r != other and os.path.commonpath([r, other]) == other for other in roots))
+
+    def load_project_index(self, repo: Repo, repo_path: str, roots: typing.Optional[ListOfString]=None) -> ProjectIndex:
+        # every root (subproject) is indexed and cached on its own, so that running the tests of one subproject doesn't pay for
+        # the others, and a change to one doesn't invalidate the index of the others
+        shards = []
+        ignore_matcher = self.get_ignore_matcher()
+
+        for root in roots or [repo_path]:
+            relpath = os.path.relpath(root, repo_path)
+            cache_key = "%s/%s" % (ProjectIndex.CACHE_KEY, hashlib.sha1(relpath.encode('utf-8')).hexdigest()[:16])
+            tree = self.find_worktree_key(repo, relpath)
+
+            if tree is not None and self.cache is not None:
+                persisted = self.cache.get(cache_key, {})
+                if persisted.get('version') == ProjectIndex.VERSION and persisted.get('root') == root and persisted.get('tree') == tree and persisted.get('ignore') == ignore_matcher.key:
+                    shards.append(ProjectIndex.from_dict(persisted))
+                    continue
+
+            shard = ProjectIndex(root)
+            shard.build(ignore_matcher)
+            shards.append(shard)
+
+            if tree is not None and self.cache is not None:
+                self.cache.set(cache_key, shard.to_dict(tree, ignore_matcher.key))
+
+        return shards[0] if len(shards) == 1 else ProjectIndex.merge(repo_path, shards)
 
     @staticmethod
     def find_packages(dir: str) -> ListOfString:
@@ -175,22 +799,149 @@ class SmartCollector(object):
 
         return packages
 
-    def find_all_files(self, repo_path: str) -> DictOfChangedFile:
+    def find_all_files(self, repo_path: str, roots: typing.Optional[ListOfString]=None) -> DictOfChangedFile:
         all_files = {}
-        for root, _, files in os.walk(repo_path):
-            for f in files:
-                fpath = os.path.join(root, f)
-                if os.path.splitext(f)[-1] == ".py" and not self.should_ignore_source_file(fpath):
-                    contents, linecount = self.read_file(fpath)
-                    all_files[fpath] = ChangedFile(
-                        change_type='A',
-                        old_filepath=None,
-                        current_filepath=fpath,
-                        changed_lines=[range(1, linecount)]
-                    )
+        ignore_matcher = self.get_ignore_matcher()
+
+        for scope_root in roots or [repo_path]:
+            for root, dirs, files in os.walk(scope_root):
+                ignore_matcher.prune(root, dirs)
+                for f in files:
+                    fpath = os.path.join(root, f)
+                    if os.path.splitext(f)[-1] == ".py" and not self.should_ignore_source_file(fpath):
+                        contents, linecount = self.read_file(fpath)
+                        all_files[fpath] = ChangedFile(
+                            change_type='A',
+                            old_filepath=None,
+                            current_filepath=fpath,
+                            changed_lines=[range(1, linecount)]
+                        )
 
         return all_files
 
+    @staticmethod
+    def parse_hunks(diff_text: str) -> ListOfHunk:
+        # (preimage start, preimage count, postimage start, postimage count) for every hunk header in a unified diff
+        hunks = []
+
+        for m in HUNK_HEADER.finditer(diff_text):
+            preimage_start, preimage_count, postimage_start, postimage_count = m.groups()
+            hunks.append((
+                int(preimage_start),
+                1 if preimage_count is None else int(preimage_count),
+                int(postimage_start),
+                1 if postimage_count is None else int(postimage_count)
+            ))
+
+        return hunks
+
+    @staticmethod
+    def find_changed_lines(diff_text: str) -> typing.List[range]:
+        # the lines of the new file that were actually added or changed -- unlike the hunk ranges, this excludes context lines
+        changed = set()
+        postimage_line = 0
+
+        for line in diff_text.split('\n'):
+            if line.startswith('@@'):
+                postimage_line = int(HUNK_HEADER.match(line).group(3))
+
+            elif line.startswith('+'):
+                changed.add(postimage_line)
+                postimage_line += 1
+
+            elif line.startswith('-'):  # removed lines are attributed to the lines on either side of them, either of which may be blank
+                changed.update((max(postimage_line - 1, 1), postimage_line))
+
+            elif line.startswith(' '):
+                postimage_line += 1
+
+        return [range(start, end + 1) for start, end in lines_to_intervals(changed)]
+
+    @staticmethod
+    def find_changes_between(old_contents: str, new_contents: str) -> (typing.List[range], ListOfHunk):
+        # the changed lines and hunks that find_changed_lines and parse_hunks would find in a diff between the two versions
+        changed = set()
+        hunks = []
+        new_lines = new_contents.splitlines()
+        matcher = difflib.SequenceMatcher(None, old_contents.splitlines(), new_lines, autojunk=False)
+
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+
+            hunks.append((i1 + 1 if i2 > i1 else i1, i2 - i1, j1 + 1 if j2 > j1 else j1, j2 - j1))
+            if j2 > j1:
+                changed.update(range(j1 + 1, j2 + 1))
+
+            else:  # removed lines are attributed to the lines on either side of them
+                changed.update(line for line in (max(j1, 1), j1 + 1) if line <= len(new_lines))
+
+        return [range(start, end + 1) for start, end in lines_to_intervals(changed)], hunks
+
+    @staticmethod
+    def find_definition_fingerprints(contents: str) -> DictOfString:
+        try:
+            module_ast = ast.parse(contents)
+
+        except SyntaxError:
+            return {}
+
+        # a name can be defined more than once (e.g. a fallback under `except ImportError:`), so every definition of it counts,
+        # in source order
+        parts = OrderedDict()
+        for name, node in QualifiedDefinitionExtractor().extract(module_ast):
+            parts.setdefault(name, []).append(DefinitionFingerprinter().fingerprint(node, without_members=isinstance(node, ast.ClassDef)))
+
+        return dict(
+            (name, fingerprints[0] if len(fingerprints) == 1 else hashlib.sha1(' '.join(fingerprints).encode('utf-8')).hexdigest())
+            for name, fingerprints in parts.items()
+        )
+
+    @staticmethod
+    def find_unchanged_members(fingerprints: DictOfString, old_fingerprints: typing.Dict[str, typing.Set[str]]) -> typing.Set[str]:
+        return set(name for name, fingerprint in fingerprints.items() if fingerprint in old_fingerprints.get(name, ()))
+
+    @staticmethod
+    def find_removed_members(old_fingerprints: DictOfString, fingerprints: DictOfString) -> typing.Set[str]:
+        # the definitions that are gone, along with the classes they were in
+        removed = set()
+        for name in set(old_fingerprints) - set(fingerprints):
+            parts = name.split('.')
+            removed.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+
+        return removed
+
+    def get_blob_reader(self, repo_path: str) -> BlobReader:
+        if self._blob_reader is None or self._blob_reader.repo_path != repo_path:
+            self.close()
+            self._blob_reader = BlobReader(repo_path)
+
+        return self._blob_reader
+
+    def close(self):
+        if self._blob_reader is not None:
+            self._blob_reader.close()
+            self._blob_reader = None
+
+    def find_blob_fingerprints(self, repo_path: str, hexshas: ListOfString) -> typing.Dict[str, DictOfString]:
+        # blobs never change, so their fingerprints are cached by hash across runs
+        # (the AST differs between python versions, and so do the fingerprints)
+        cached = self.cache.get(FINGERPRINTS_CACHE_KEY, {}) if self.cache is not None else {}
+        cached = cached.get('blobs', {}) if cached.get('python') == sys.version and cached.get('version') == DefinitionFingerprinter.VERSION else {}
+        fingerprints = {sha: cached[sha] for sha in hexshas if sha in cached}
+
+        missing = [sha for sha in hexshas if sha not in fingerprints]
+        blob_reader = self.get_blob_reader(repo_path)
+        for sha in missing:
+            contents = blob_reader.read(sha)
+            if contents is not None:
+                fingerprints[sha] = self.find_definition_fingerprints(contents)
+
+        if self.cache is not None and missing:
+            self.cache.set(FINGERPRINTS_CACHE_KEY, {'python': sys.version, 'version': DefinitionFingerprinter.VERSION, 'blobs': fingerprints})
+
+        return fingerprints
+
     def find_changed_files(self, repo: Repo, repo_path: str) -> (DictOfChangedFile, DictOfChangedFile, DictOfChangedFile, DictOfChangedFile, DictOfChangedFile):
         changed_files = {
             'A': {},
@@ -201,17 +952,62 @@ class SmartCollector(object):
         }
 
         current_head = repo.head.commit
-        previous_commits = repo.commit("%s~%d" % (self.diff_current_head_with_branch, self.commit_range))
-        diffs = previous_commits.diff(current_head)
-        diffs_with_patch = previous_commits.diff(current_head, create_patch=True)
+        previous_commits = None
+
+        if len(list(repo.iter_commits(self.diff_current_head_with_branch, first_parent=True, max_count=self.commit_range + 1))) > self.commit_range:
+            previous_commits = repo.commit("%s~%d" % (self.diff_current_head_with_branch, self.commit_range))
+
+        # a range that reaches back past the first commit, or a new repository that only has its first commit to diff with, is
+        # diffed against the empty tree, so that everything in the first commit is a change, wherever it is in the repository
+        if previous_commits is None or (previous_commits == current_head and not current_head.parents):
+            self.base_commit = None
+            empty_tree = repo.tree(EMPTY_TREE)
+            diffs = list(empty_tree.diff(current_head))
+            diffs_with_patch = empty_tree.diff(current_head, create_patch=True)
+
+        else:
+            self.base_commit = previous_commits.hexsha
+            diffs = list(previous_commits.diff(current_head))
+            diffs_with_patch = previous_commits.diff(current_head, create_patch=True)
+
+        # type changes can produce more than one patch, so patches are matched to diffs by path rather than by position
+        patches_by_old_path = {p.a_path: p for p in diffs_with_patch if p.a_path is not None}
+        patches_by_new_path = {p.b_path: p for p in diffs_with_patch if p.b_path is not None}
+
+        # definitions that disappeared from deleted, renamed or modified files, so that they can be recognised if they reappear
+        # elsewhere, and the definitions of every changed file that aren't in its base version, which they might have moved to
+        removed_fingerprints = {}
+        new_definitions = []
+        self.changed_data_files = []
+        self.changed_dependencies = {}
+
+        # the base versions of python files are needed to tell real changes from cosmetic ones and from moved code
+        blob_fingerprints = self.find_blob_fingerprints(repo_path, [
+            d.a_blob.hexsha for d in diffs if d.change_type in ('M', 'D', 'R') and os.path.splitext(d.a_path)[-1] == '.py' and d.a_blob is not None
+        ])
+
+        for d in diffs:
+            patch = patches_by_old_path.get(d.a_path) if d.change_type == 'D' else patches_by_new_path.get(d.b_path)
+            diff_text = patch.diff.decode('utf-8').replace('\r', '') if patch is not None else ''
+
+            old_fingerprints = blob_fingerprints.get(d.a_blob.hexsha, {}) if d.a_blob is not None else {}
+            if d.change_type in ('D', 'R'):
+                for name, fingerprint in old_fingerprints.items():
+                    removed_fingerprints.setdefault(name, set()).add(fingerprint)
+
+            # changes to anything else (binary files included) can only select tests through the data map or data file literals
+            for path in set(p for p in (d.a_path, d.b_path) if p is not None):
+                if os.path.splitext(path)[-1] != '.py':
+                    self.changed_data_files.append(os.path.join(repo_path, path).replace('/', os.sep))
+
+            if is_dependency_file(d.b_path or d.a_path):
+                self.changed_dependencies[os.path.join(repo_path, d.b_path or d.a_path).replace('/', os.sep)] = self.find_changed_distributions(repo_path, d)
 
-        for idx, d in enumerate(diffs):
-            diff_text = diffs_with_patch[idx].diff.decode('utf-8').replace('\r', '')
             if re.match('^Binary files.*', diff_text) or len(diff_text) == 0:  # TODO: figure out if there are any other special cases where the diff information is non-standard
                 continue
-            diff_lines_spec = diff_text.split('\n')[0].split('@@')[1].strip().replace('+', '').replace('-', '')
             changed_lines = None
             old_filepath = None
+            hunks = None
 
             if d.change_type == 'A':  # added paths
                 filepath = os.path.join(repo_path, d.a_path)
@@ -225,31 +1021,8 @@ class SmartCollector(object):
                 filepath = os.path.join(repo_path, d.a_path)
                 if os.path.splitext(filepath)[-1] != '.py':
                     continue
-                ranges = diff_lines_spec.split(' ')
-                if len(ranges) < 2:
-                    start, count = ranges[0].split(',')
-                    changed_lines = [range(start, start + count)]
-
-                else:
-                    preimage = [int(x) for x in ranges[0].split(',')]
-                    preimage_start = preimage[0]
-                    if len(preimage) > 1:
-                        preimage_count = preimage[1]
-                    else:
-                        preimage_count = 0
-
-                    postimage = [int(x) for x in ranges[1].split(',')]
-                    postimage_start = postimage[0]
-                    if len(postimage) > 1:
-                        postimage_count = postimage[1]
-
-                    else:
-                        postimage_count = 0
-
-                    changed_lines = [
-                        range(preimage_start, preimage_start + preimage_count),
-                        range(postimage_start, postimage_start + postimage_count)
-                    ]
+                hunks = self.parse_hunks(diff_text)
+                changed_lines = self.find_changed_lines(diff_text)
 
             elif d.change_type == 'D':  # deleted paths
                 filepath = os.path.join(repo_path, d.a_path)
@@ -257,20 +1030,25 @@ class SmartCollector(object):
                     continue
 
             elif d.change_type == 'R':  # renamed paths
+                # git only reports renames onto paths that didn't exist before. a file moved over an existing one (e.g. `git mv -f
+                # a.py b.py`) shows up as a deletion of a.py and a modification of b.py, whose hunks are against the old b.py, so
+                # it is analysed as an edit of b.py and the tests of a.py are not followed to it
                 filepath = os.path.join(repo_path, d.b_path)
                 if os.path.splitext(filepath)[-1] != '.py':
                     continue
                 old_filepath = os.path.join(repo_path, d.a_path)
-                _, linecount = self.read_file(filepath)
-                changed_lines = [range(1, linecount)]
+
+                # only the hunks of a renamed file are changed -- definitions that were just carried along with the rename are not
+                hunks = self.parse_hunks(diff_text)
+                changed_lines = self.find_changed_lines(diff_text)
 
             elif d.change_type == 'T':  # changed file types
-                filepath = os.path.join(repo_path, d.b_rawpath)
+                filepath = os.path.join(repo_path, d.b_path)
                 if os.path.splitext(filepath)[-1] != '.py':
                     continue
                 old_filepath = os.path.join(repo_path, d.a_path)
-                _, linecount = self.read_file(filepath)
-                changed_lines = [range(1, linecount)]
+                hunks = self.parse_hunks(diff_text)
+                changed_lines = self.find_changed_lines(diff_text)
 
             else:  # something is seriously wrong...
                 raise Exception("Unknown change type '%s'" % d.change_type)
@@ -287,51 +1065,162 @@ class SmartCollector(object):
                     d.change_type,
                     filepath,
                     old_filepath=old_filepath,
-                    changed_lines=changed_lines
+                    changed_lines=changed_lines,
+                    hunks=hunks
                 )
 
+                changed_file = changed_files[d.change_type][filepath]
+
+                # definitions that look the same as in the base version (e.g. only comments, docstrings or formatting changed, or they
+                # were carried along with a rename) are unchanged, even if the hunks make them look touched. definitions that are gone
+                # are changed, even though no line of the new version points at them
+                if d.change_type in ('M', 'R'):
+                    contents, _ = self.read_file(filepath)
+                    fingerprints = self.find_definition_fingerprints(contents)
+                    new_definitions.append((changed_file, dict((k, v) for k, v in fingerprints.items() if k not in old_fingerprints)))
+                    changed_file.unchanged_members = self.find_unchanged_members(
+                        fingerprints, {name: {fingerprint} for name, fingerprint in old_fingerprints.items()}
+                    )
+                    changed_file.removed_members = self.find_removed_members(old_fingerprints, fingerprints)
+
+                elif d.change_type == 'A':
+                    new_definitions.append((changed_file, None))  # only read if anything was removed
+
+                if d.change_type == 'M':
+                    for name in set(old_fingerprints) - set(fingerprints):
+                        removed_fingerprints.setdefault(name, set()).add(old_fingerprints[name])
+
+        # definitions that were moved out of one file into another without being changed are not changes. the file they left
+        # still reports them as removed
+        if removed_fingerprints:
+            for changed_file, fingerprints in new_definitions:
+                if fingerprints is None:
+                    fingerprints = self.find_definition_fingerprints(self.read_file(changed_file.current_filepath)[0])
+
+                changed_file.unchanged_members |= self.find_unchanged_members(fingerprints, removed_fingerprints)
+
         return changed_files['A'], changed_files['M'], changed_files['D'], changed_files['R'], changed_files['T']
 
-    def should_ignore_source_file(self, source_file: str) -> bool:
-        if self.ignore_source is not None:
-            for ign in self.ignore_source:
-                if os.path.commonpath([source_file, ign]) == ign:
-                    return True
+    def get_ignore_matcher(self) -> IgnoreMatcher:
+        # the --ignore-source flags and smart_collect_ignore ini lines (relative to the rootdir), and the ignore files
+        if self._ignore_matcher is None:
+            ignore_files = [os.path.join(self.rootdir, IGNORE_FILE_NAME)]
+            try:
+                git_repo_root = self.find_git_repo_root(self.rootdir)
+                if os.path.abspath(git_repo_root) != os.path.abspath(self.rootdir):
+                    ignore_files.insert(0, os.path.join(git_repo_root, IGNORE_FILE_NAME))
 
-        return False
+            except Exception:  # not in a git repository, which is reported elsewhere
+                pass
+
+            self._ignore_matcher = IgnoreMatcher.from_rules(self.ignore_source or [], self.rootdir, ignore_files)
+
+        return self._ignore_matcher
+
+    def should_ignore_source_file(self, source_file: str) -> bool:
+        return self.get_ignore_matcher().matches(source_file)
 
     def find_changed_members(self, changed_module: ChangedFile, repo_path: str) -> ListOfString:
         # find all changed members of changed_module
-        changed_members = []
-        name_extractor = ObjectNameExtractor()
-
         contents, total_lines = self.read_file(os.path.join(repo_path, changed_module.current_filepath))
         module_ast = ast.parse(contents)
-        direct_children = list(ast.iter_child_nodes(module_ast))
 
         # get a set of all changed lines in changed_module
         changed_lines = set()
         for ch in changed_module.changed_lines:
             changed_lines.update(set(ch))
 
-        # the direct children of the module correspond to the imported names in test files
-        for idx, node in enumerate(direct_children):
-            if isinstance(node, ast.Assign) or isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
-                try:
-                    r = range(node.lineno, direct_children[idx + 1].lineno)
+        # the members of the module correspond to the imported names in test files
+        changed_members = self.find_changed_statements(module_ast.body, total_lines, changed_lines)
+        changed_members = [m for m in changed_members if m not in changed_module.unchanged_members]
+        return changed_members + sorted(m for m in changed_module.removed_members if m not in changed_members)
 
-                except IndexError:
-                    r = range(node.lineno, total_lines)
+    @staticmethod
+    def find_statement_spans(body: list, last_line: int) -> typing.List[typing.Tuple[ast.AST, range]]:
+        # the lines of each statement in body, from its first decorator to its last line (or, before python 3.8, to the line before
+        # the next statement)
+        starts = [min([node.lineno] + [dec.lineno for dec in getattr(node, 'decorator_list', [])]) for node in body]
+        spans = []
 
-                if set(changed_lines).intersection(set(r)):
-                    if isinstance(node, ast.Assign):
-                        changed_members.extend(name_extractor.extract(node))
+        for idx, node in enumerate(body):
+            end = getattr(node, 'end_lineno', None)
+            if end is None:
+                end = starts[idx + 1] - 1 if idx + 1 < len(starts) else last_line
 
-                    elif isinstance(node, ast.FunctionDef):
-                        changed_members.append(node.name)
+            spans.append((node, range(starts[idx], end + 1)))
 
-                    else:
-                        changed_members.append(node.name)
+        return spans
+
+    @staticmethod
+    def find_assigned_names(node) -> ListOfString:
+        names = []
+        targets = list(node.targets) if isinstance(node, ast.Assign) else [node.target]
+
+        while targets:
+            target = targets.pop(0)
+            if isinstance(target, ast.Name):
+                names.append(target.id)
+
+            elif isinstance(target, (ast.Tuple, ast.List)):
+                targets.extend(target.elts)
+
+            elif isinstance(target, (ast.Starred, ast.Attribute, ast.Subscript)):  # e.g. `*rest`, `CONFIG.debug` and `REGISTRY[key]`
+                targets.append(target.value)
+
+        return names
+
+    def find_module_assignments(self, body: list) -> typing.Set[str]:
+        # the names assigned at module level, including in module level blocks, which find_changed_statements reports changes to
+        names = set()
+        for node in body:
+            if isinstance(node, ASSIGNMENTS):
+                names.update(self.find_assigned_names(node))
+
+            elif not isinstance(node, DEFINITIONS):
+                for field in ('body', 'orelse', 'finalbody', 'handlers'):
+                    statements = getattr(node, field, None)
+                    if isinstance(statements, list):
+                        names.update(self.find_module_assignments(statements))
+
+        return names
+
+    def find_changed_statements(self, body: list, last_line: int, changed_lines: typing.Set[int], class_name: StrOrNone=None) -> ListOfString:
+        changed_members = []
+
+        for node, r in self.find_statement_spans(body, last_line):
+            if not changed_lines.intersection(r):
+                continue
+
+            if isinstance(node, FUNCTION_DEFINITIONS):
+                changed_members.append(node.name if class_name is None else class_name + '.' + node.name)
+
+            elif isinstance(node, ast.ClassDef):
+                changed_members.extend(self.find_changed_class_members(node, r[-1], changed_lines, '' if class_name is None else class_name + '.'))
+
+            elif class_name is not None:  # anything else in a class body belongs to the class itself
+                if class_name not in changed_members:
+                    changed_members.insert(0, class_name)
+
+            elif isinstance(node, ASSIGNMENTS):
+                changed_members.extend(self.find_assigned_names(node))
+
+            else:  # the definitions and assignments in module level blocks, e.g. `if sys.platform == 'win32':` or `try: ... except ImportError:`
+                for field in ('body', 'orelse', 'finalbody', 'handlers'):
+                    statements = getattr(node, field, None)
+                    if isinstance(statements, list) and statements:
+                        changed_members.extend(self.find_changed_statements(statements, r[-1], changed_lines))
+
+        return changed_members
+
+    def find_changed_class_members(self, node: ast.ClassDef, last_line: int, changed_lines: typing.Set[int], prefix: str='') -> ListOfString:
+        # methods and nested classes are members of their own ('Class.method'), while everything else in the class (bases,
+        # decorators, class attributes...) belongs to the class itself
+        class_name = prefix + node.name
+        changed_members = self.find_changed_statements(node.body, last_line, changed_lines, class_name)
+
+        header = range(min([node.lineno] + [dec.lineno for dec in node.decorator_list]), self.find_statement_spans(node.body, last_line)[0][1][0])
+        if changed_lines.intersection(header) and class_name not in changed_members:
+            changed_members.insert(0, class_name)
 
         return changed_members
 
@@ -352,163 +1241,414 @@ class SmartCollector(object):
 
         return True
 
-    def dependencies_changed(self, path: str, object_name: str, change_map: DictOfListOfString, chain: ListOfString) -> bool:
+    def resolve_module_name(self, path: str, module_name: StrOrNone, import_level: int) -> str:
+        if import_level == 0:
+            return module_name
+
+        # package relative imports are qualified with the fully qualified name of the package path is in, so that they are
+        # classified (and found) the same as absolute imports of the same module
+        parts = self.project_index.module_name(os.path.dirname(path)).split('.')
+        parts = parts[:len(parts) - (import_level - 1)]
+        if module_name is not None:
+            parts.append(module_name)
+
+        return '.'.join(parts)
+
+    @staticmethod
+    def find_module_path_on(module_name: str, search_path: ListOfString) -> StrOrNone:
+        # PathFinder only searches the filesystem, so nothing gets imported here
+        locations = search_path
+        spec = None
+
+        for part in module_name.split('.'):
+            if locations is None:  # a module that isn't a package has no submodules
+                return None
+
+            spec = PathFinder.find_spec(part, list(locations))
+            if spec is None:
+                return None
+
+            locations = spec.submodule_search_locations
+
+        return spec.origin if spec.origin not in (None, 'namespace', 'built-in', 'frozen') else None
+
+    def find_module_path(self, module_name: str) -> StrOrNone:
+        # modules are looked up in the project index first. anything it doesn't know of (e.g. another subproject of a monorepo)
+        # is looked for on the search path, without importing anything or adding the packages of the project to sys.path
+        try:
+            return self._module_paths[module_name]
+
+        except KeyError:
+            pass
+
+        path = None
+        if self.project_index is not None:
+            path = self.project_index.find_module_path(module_name)
+
+        if path is None and (self.project_index is None or not self.project_index.has_top_level_name(module_name)):
+            path = self.find_module_path_on(module_name, self.search_path if self.search_path is not None else sys.path)
+
+        self._module_paths[module_name] = path
+        return path
+
+    @staticmethod
+    def find_dunder_all(module_ast: ast.Module) -> typing.Union[ListOfString, None]:
+        # the names in __all__, if they are all string literals
+        names = None
+        for node in module_ast.body:
+            if isinstance(node, (ast.Assign, ast.AugAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                if not any(isinstance(t, ast.Name) and t.id == '__all__' for t in targets):
+                    continue
+
+                if not isinstance(node.value, (ast.List, ast.Tuple)):
+                    return None
+
+                values = [getattr(e, 'value', getattr(e, 's', None)) for e in node.value.elts]
+                if not all(isinstance(v, str) for v in values):
+                    return None
+
+                names = values if isinstance(node, ast.Assign) or names is None else names + values
+
+        return names
+
+    def get_module_ast(self, path: str) -> ast.Module:
+        try:
+            return self._module_asts[path]
+
+        except KeyError:
+            contents, _ = self.read_file(path)
+            module_ast = self._module_asts[path] = ast.parse(contents)
+            return module_ast
+
+    def find_exported_names(self, path: str, visited: typing.Optional[typing.Set[str]]=None) -> ListOfString:
+        # the names that `from module import *` binds: __all__ if it can be read statically, otherwise every public name that is
+        # bound at the top level of the module (including by its own star imports)
+        if path in self._exported_names:
+            return self._exported_names[path]
+
+        visited = visited if visited is not None else set()
+        visited.add(path)
         git_repo_root = self.find_git_repo_root(self.rootdir)
+        module_ast = self.get_module_ast(path)
+        names = self.find_dunder_all(module_ast)
 
-        if path in change_map.keys() and object_name in change_map[path]: # if we've seen this file before and already know it to be changed, just return True
-            chain.insert(0, "%s::%s" % (path, object_name))
-            return True
+        if names is None:
+            names = set()
+            statements = list(module_ast.body)
 
-        if not self.file_in_project(git_repo_root, path):  # if the file is outside of the project, don't bother checking it or any of its dependencies
-            return False
+            while statements:
+                node = statements.pop(0)
+                if isinstance(node, DEFINITIONS):
+                    names.add(node.name)
 
-        # otherwise, recursively check the dependencies of this file for other known changes
-        contents, _ = self.read_file(path)
-        module_ast = ast.parse(contents)
+                elif isinstance(node, ASSIGNMENTS):
+                    names.update(self.find_assigned_names(node))
 
-        # find locally changed members
-        locally_changed = []
-        if path in change_map.keys():
-            locally_changed = change_map[path]
+                elif isinstance(node, ast.Import):
+                    names.update(alias.asname or alias.name.split('.')[0] for alias in node.names)
 
-        # find the object of interest in the ast
-        obj = None
-        definition_extractor = DefinitionNodeExtractor()
-        definition_nodes = definition_extractor.extract(module_ast)
+                elif isinstance(node, ast.ImportFrom):
+                    for alias in node.names:
+                        if alias.name != '*':
+                            names.add(alias.asname or alias.name)
+                            continue
 
-        for child in definition_nodes:
-            if child.name == object_name:
-                obj = child
-                break
+                        if node.level == 0 and not self.module_classifier.is_project_module(node.module):
+                            continue
 
-            else:
-                continue
+                        module_path = self.find_module_path(self.resolve_module_name(path, node.module, node.level))
+                        if module_path is not None and module_path not in visited and self.file_in_project(git_repo_root, module_path):
+                            names.update(self.find_exported_names(module_path, visited))
 
-        if obj is None:  # if the object wasn't a definition and is unchanged, assume that there are no further dependencies in the chain
-            return False
+                else:  # module level blocks, e.g. `try: ... except ImportError:`
+                    for field in ('body', 'orelse', 'finalbody', 'handlers'):
+                        statements.extend(getattr(node, field, None) or [])
 
-        # extract imports
+            names = sorted(n for n in names if not n.startswith('_'))
+
+        self._exported_names[path] = names
+        return names
+
+    def resolve_imports(self, path: str, module_ast: ast.Module) -> typing.Tuple[DictOfListOfString, DictOfString]:
+        # the project files each imported name can be found in, and the project modules bound by plain imports. modules are only
+        # located, never imported -- star imports are resolved statically, and the attributes used of a module are resolved as
+        # they are needed
+        git_repo_root = self.find_git_repo_root(self.rootdir)
         imported_names_and_modules = {}
-        imne = ImportModuleNameExtractor()
-        extracted_imports = imne.extract(module_ast)
+        imported_modules = {}
+
+        def add(name, f):
+            if f is not None and self.file_in_project(git_repo_root, f) and f not in imported_names_and_modules.get(name, []):
+                imported_names_and_modules.setdefault(name, []).append(f)
 
-        for (module_name, imported_names, import_level) in extracted_imports:
-            if module_name in sys.builtin_module_names: # we can safely assume that builtin module changes aren't relevant
+        for binding, module_name in ModuleBindingExtractor().extract(module_ast):
+            if self.module_classifier.is_project_module(module_name):
+                module_path = self.find_module_path(module_name)
+                if module_path is not None and self.file_in_project(git_repo_root, module_path):
+                    imported_modules[binding] = module_path
+
+        for (module_name, imported_names, import_level) in ImportModuleNameExtractor().extract(module_ast):
+            if len(imported_names) == 0:  # plain imports bind modules (see above)
                 continue
 
-            if module_name is None:  # here we need to find the fully qualified module name for a package relative import
-                assert import_level > 0
-                module_name = self.find_fully_qualified_module_name(os.path.dirname(path))
+            if import_level == 0 and not self.module_classifier.is_project_module(module_name): # builtin, stdlib and third party modules can't contain changes
+                continue
 
-            else:
-                if import_level > 0: # another package relative import situation
-                    module_name = [module_name]
-                    src_path = path
-                    while import_level > 0:
-                        src_path = os.path.dirname(src_path)
-                        module_name.insert(0, os.path.basename(src_path))
-                        import_level -= 1
+            module_name = self.resolve_module_name(path, module_name, import_level)
 
-                    module_name = '.'.join(module_name)
+            if '*' in imported_names:
+                module_path = self.find_module_path(module_name)
+                if module_path is not None and self.file_in_project(git_repo_root, module_path):
+                    self._star_importers.setdefault(module_path, set()).add(path)
+                    for imported_name in self.find_exported_names(module_path):
+                        add(imported_name, module_path)
 
-            if len(imported_names) == 0 or '*' in imported_names:
-                imp = import_module(module_name)
-                imported_names = dir(imp)
+                continue
 
-            i = import_module(module_name)
+            module_path = self.find_module_path(module_name)
 
             for imported_name in imported_names:
-                o = getattr(i, imported_name)
+                submodule_path = self.find_module_path(module_name + '.' + imported_name)
+                if submodule_path is not None:  # e.g. `from package import module`
+                    if self.file_in_project(git_repo_root, submodule_path):
+                        imported_modules[imported_name] = submodule_path
 
-                if hasattr(o, '__module__') and o.__module__ not in sys.builtin_module_names and o.__module__ is not None:
-                    f = import_module(o.__module__).__file__
+                    continue
 
-                else:
-                    f = None
+                # a name that the module imports from elsewhere is followed there when it is used
+                add(imported_name, module_path)
 
-                if imported_name in imported_names_and_modules.keys():
-                    if hasattr(i, '__file__') and i.__file__ not in imported_names_and_modules[imported_name] and self.file_in_project(git_repo_root, i.__file__):
-                        imported_names_and_modules[imported_name].append(i.__file__)
+        return imported_names_and_modules, imported_modules
 
-                    if f is not None and f not in imported_names_and_modules[imported_name] and self.file_in_project(git_repo_root, f):
-                        imported_names_and_modules[imported_name].append(f)
+    def get_module_info(self, path: str) -> ModuleInfo:
+        try:
+            return self._module_infos[path]
 
-                else:
-                    if hasattr(i, '__file__') and self.file_in_project(git_repo_root, i.__file__):
-                        imported_names_and_modules[imported_name] = [i.__file__]
+        except KeyError:
+            pass
+
+        module_ast = self.get_module_ast(path)
+
+        definitions = {}
+        qualified_names = {}
+        for name, node in QualifiedDefinitionExtractor().extract(module_ast):
+            definitions.setdefault(name, node)
+            qualified_names.setdefault(node.name, name)  # for lookups by plain name the first definition wins, as it always has
 
-                    if f is not None and self.file_in_project(git_repo_root, f):
-                        imported_names_and_modules[imported_name].append(f)
+        info = ModuleInfo(module_ast, definitions, qualified_names, self.find_module_assignments(module_ast.body), *self.resolve_imports(path, module_ast))
+        self._module_infos[path] = info
+        return info
+
+    @staticmethod
+    def member_changed(changed_members: ListOfString, qualified_name: str) -> bool:
+        # a member is changed if it is, if what it is defined in is (e.g. the class of a method), or if anything defined in it is
+        # (e.g. a method of a class that is used as a whole)
+        for member in changed_members:
+            if member == qualified_name or member.startswith(qualified_name + '.') or qualified_name.startswith(member + '.'):
+                return True
+
+        return False
+
+    @staticmethod
+    def find_definition_paths(info: ModuleInfo, path: str, name: str) -> ListOfString:
+        paths = list(info.imported_names_and_modules.get(name, []))
+        if (name in info.definitions or name in info.assigned_names) and path not in paths:
+            paths.append(path)
+
+        return paths
+
+    @staticmethod
+    def find_submodule_path(path: str, name: str) -> StrOrNone:
+        # e.g. the module that `a.b` refers to after `import a.b`, when path is a/__init__.py
+        if os.path.basename(path) != '__init__.py':
+            return None
+
+        for candidate in (os.path.join(os.path.dirname(path), name + '.py'), os.path.join(os.path.dirname(path), name, '__init__.py')):
+            if os.path.isfile(candidate):
+                return candidate
+
+        return None
+
+    def find_module_dependencies(self, module_path: str) -> typing.List[typing.Tuple[str, str]]:
+        # a module that is used as a whole depends on everything it exports
+        return [(module_path, name) for name in self.find_exported_names(module_path)]
+
+    def find_name_dependencies(self, info: ModuleInfo, path: str, name: str) -> typing.List[typing.Tuple[str, str]]:
+        if name in info.imported_modules and name not in info.definitions:
+            return self.find_module_dependencies(info.imported_modules[name])
+
+        return [(module_path, name) for module_path in self.find_definition_paths(info, path, name)]
+
+    def find_base_classes(self, info: ModuleInfo, path: str, class_node: ast.ClassDef) -> typing.List[typing.Tuple[str, str]]:
+        return [dependency for base_name in BaseClassNameExtractor().extract(class_node) for dependency in self.find_name_dependencies(info, path, base_name)]
+
+    def find_dependencies(self, path: str, object_name: str) -> typing.Tuple[typing.List[typing.Tuple[str, str]], bool]:
+        # the (path, qualified name) of everything object_name depends on, and whether object_name is a class
+        info = self.get_module_info(path)
+        qualified_name = object_name if object_name in info.definitions else info.qualified_names.get(object_name)
+        dependencies = []
+
+        if qualified_name is None:
+            head, _, rest = object_name.partition('.')
+
+            # a name that the module only imports (e.g. a package that re-exports it, or an attribute of an imported module) is
+            # wherever it was imported from
+            if head not in info.definitions:
+                if head in info.imported_modules:
+                    module_path = info.imported_modules[head]
+                    return [(module_path, rest)] if rest else self.find_module_dependencies(module_path), False
+
+                if head in info.imported_names_and_modules:
+                    return [(module_path, object_name) for module_path in info.imported_names_and_modules[head] if module_path != path], False
+
+                submodule_path = self.find_submodule_path(path, head)
+                if submodule_path is not None:
+                    return [(submodule_path, rest)] if rest else self.find_module_dependencies(submodule_path), False
+
+            owner_name = object_name.rsplit('.', 1)[0] if '.' in object_name else None
+            owner = info.definitions.get(owner_name)
+
+            # an attribute that isn't defined in its class is either a class attribute, which belongs to the class itself, or an
+            # inherited one -- base classes are always used as a whole, there's no telling what the method resolution ends up with
+            if isinstance(owner, ast.ClassDef):
+                dependencies.extend(self.find_base_classes(info, path, owner))
+
+            elif owner is not None:
+                dependencies.append((path, owner_name))
+
+            return dependencies, False
+
+        obj = info.definitions[qualified_name]
+        usage = UsageExtractor().extract(obj)
 
-        # check base classes recursively
-        base_class_name_extractor = BaseClassNameExtractor()
         if isinstance(obj, ast.ClassDef):
-            for base_name in base_class_name_extractor.extract(obj):
-                if base_name in imported_names_and_modules.keys():
-                    base_class_module_paths = imported_names_and_modules[base_name]
-                    for path in base_class_module_paths:
-                        if self.dependencies_changed(path, base_name, change_map, chain):
-                            if path in change_map.keys():
-                                change_map[path].append(base_name)
+            dependencies.extend(self.find_base_classes(info, path, obj))
+
+        elif '.' in qualified_name:
+            class_name = qualified_name.rsplit('.', 1)[0]
+            class_node = info.definitions.get(class_name)
 
-                            else:
-                                change_map[path] = [base_name]
+            if isinstance(class_node, ast.ClassDef):  # a method
+                dependencies.extend(self.find_base_classes(info, path, class_node))
 
-                            return True
+                if usage.self_escapes:
+                    dependencies.append((path, class_name))
 
-        # extract call objects from obj
-        object_name_extractor = ObjectNameExtractor()
-        used_names = object_name_extractor.extract(obj)
+                for attribute in sorted(usage.self_attributes):
+                    dependencies.append((path, class_name + '.' + attribute))
 
-        for name in used_names:
-            if name == object_name:  # to avoid infinite recursion when a class invokes it's own class methods or if a recursive function calls itself
+        for name in sorted(usage.names):
+            if name != qualified_name:  # to avoid needless revisits when a recursive function calls itself
+                dependencies.extend(self.find_name_dependencies(info, path, name))
+
+        for name, attributes in sorted(usage.attributes.items()):
+            if name in info.imported_modules and name not in info.definitions:  # `module.attr`
+                dependencies.extend((info.imported_modules[name], attribute) for attribute in sorted(attributes))
                 continue
 
-            if name in locally_changed:
-                if path in change_map.keys() and name in change_map[path]:
-                    return True
+            for module_path in self.find_definition_paths(info, path, name):
+                dependencies.extend((module_path, name + '.' + attribute) for attribute in sorted(attributes))
 
-            if name in imported_names_and_modules.keys():
-                for module_path in imported_names_and_modules[name]:
-                    if self.dependencies_changed(module_path, name, change_map, chain):
-                        if module_path in change_map.keys():
-                            change_map[module_path].append(name)
-                        else:
-                            change_map[module_path] = [name]
+        return dependencies, isinstance(obj, ast.ClassDef)
 
-                        return True
+    def dependencies_changed(self, path: str, object_name: str, change_map: DictOfListOfString, chain: typing.List[typing.Tuple[str, str]]) -> bool:
+        git_repo_root = self.find_git_repo_root(self.rootdir)
 
-                    else:
-                        continue
+        # objects that were fully explored without finding a change stay unchanged for as long as the change map is the same
+        if self._unchanged_objects[0] is not change_map:
+            self._unchanged_objects = (change_map, set())
 
-        return False
+        unchanged_objects = self._unchanged_objects[1]
+        if (path, object_name) in unchanged_objects:
+            return False
 
-    def run(self, items):
-        log_records = []
+        # breadth first traversal of the dependency graph -- parents doubles as the visited set, and is used to rebuild the chain
+        start = (path, object_name)
+        parents = {start: None}
+        worklist = deque([(start, 0)])
+        classes = set()
+        changed = None
+
+        while worklist:
+            current, depth = worklist.popleft()
+            path, object_name = current
+
+            if self.member_changed(change_map.get(path, []), object_name):  # already known to be changed
+                changed = current
+                break
+
+            if not self.file_in_project(git_repo_root, path):  # if the file is outside of the project, don't bother checking it or any of its dependencies
+                continue
+
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+
+            dependencies, is_class = self.find_dependencies(path, object_name)
+            if is_class:
+                classes.add(current)
+
+            for dependency in dependencies:
+                if dependency not in parents and dependency not in unchanged_objects:
+                    parents[dependency] = current
+                    worklist.append((dependency, depth + 1))
+
+        if changed is None:
+            if self.max_depth is None:  # with a depth limit, some of the dependencies might not have been explored
+                unchanged_objects.update(parents.keys())
+
+            return False
+
+        # everything on the path from the changed object back to the starting object is changed too -- except for classes, which
+        # would make every one of their methods look changed when only some of them are
+        node = changed
+        while node is not None:
+            chain.insert(0, node)
+            if node != start and node not in classes:
+                node_path, node_name = node
+                if node_name not in change_map.setdefault(node_path, []):
+                    change_map[node_path].append(node_name)
+
+            node = parents[node]
+
+        return True
+
+    def load_project(self, items: ListOfTestItem) -> typing.Tuple[str, Repo, ListOfString]:
+        # the project index and module classification that the analysis needs. the worktree key only identifies a clean
+        # checkout, so a long running collector keeps its index instead, and relies on forget() to keep it up to date
         git_repo_root = self.find_git_repo_root(self.rootdir)
-        self.packages = self.find_packages(git_repo_root)
+        repo = Repo(git_repo_root)
+        scope_roots = self.find_scope_roots(items, git_repo_root)
 
-        for p in self.packages:
-            sys.path.insert(0, p)
+        if not self.keep_project_index or self.project_index is None or self._scope_roots != scope_roots:
+            self.project_index = self.load_project_index(repo, git_repo_root, scope_roots)
+            self.packages = self.project_index.packages
+            self.module_classifier = None
+            self._scope_roots = scope_roots
+            self._module_paths = {}
 
-        try:
-            repo = Repo(git_repo_root)
+        # the daemon looks for modules where each client would, which can change from one selection to the next
+        if self.module_classifier is None or self.module_classifier.search_path != self.search_path:
+            if self.module_classifier is not None:
+                self.module_classifier.save()
+
+            self.module_classifier = ModuleClassifier(self.project_index.importable_names, self.cache, git_repo_root, self.search_path)
+            self._module_paths = {}
 
-            total_commits_on_head = len(list(repo.iter_commits("HEAD")))
+        return git_repo_root, repo, scope_roots
 
-            if self.diff_current_head_with_branch == repo.active_branch.name and total_commits_on_head < 2:
-                added_files = self.find_all_files(git_repo_root)
-                modified_files = {}
-                deleted_files = {}
-                renamed_files = {}
-                changed_filetype_files = {}
+    def select(self, items: ListOfTestItem) -> ListOfLogRecord:
+        log_records = []
+        git_repo_root, repo, _ = self.load_project(items)
 
-            else:  # inspect the diff
-                added_files, modified_files, deleted_files, renamed_files, changed_filetype_files = self.find_changed_files(repo, git_repo_root)
+        try:
+            self.head_commit = repo.head.commit.hexsha
+            self.head_tree = repo.head.commit.tree.hexsha
+            added_files, modified_files, deleted_files, renamed_files, changed_filetype_files = self.find_changed_files(repo, git_repo_root)
 
             changed_to_py = {}
             for changed_filetype in changed_filetype_files.values():
-                if os.path.splitext(changed_filetype.current_filepath) == ".py":
+                if os.path.splitext(changed_filetype.current_filepath)[-1] == ".py":
                     changed_to_py[changed_filetype.current_filepath] = changed_filetype
 
             changed_files = {}
@@ -520,137 +1660,575 @@ class SmartCollector(object):
             # ignore anything explicitly set in --ignore-source flags
             changed_files = {k: v for k, v in changed_files.items() if not self.should_ignore_source_file(k)}
 
-            # determine all changed members of each of the changed files (if applicable)
-            changed_members_and_modules = {
-                path: self.find_changed_members(ch, git_repo_root) for path, ch in changed_files.items()
-            }
+            changed_data_files = [f for f in self.changed_data_files if not self.should_ignore_source_file(f)]
+            changed_distributions = set()
+            locked_distributions = set()
+            for path, distributions in self.changed_dependencies.items():
+                if not self.should_ignore_source_file(path):
+                    changed_distributions.update(distributions)
+                    if is_lock_file(path):
+                        locked_distributions.update(distributions)
 
-            test_count = 0
-            fixture_map = {}
-            ast_map = {}
+            log_records = self.select_changed(
+                items, changed_files, deleted_files, git_repo_root, changed_data_files, changed_distributions, locked_distributions
+            )
 
-            for test in items:
-                test_name = test.name.split('[')[0]  # TODO: figure out a better way to handle test names of parameterized tests
+        except Exception as e:
+            self._handle_exception(str(e))
 
-                # if the test is new, run it anyway
-                if str(test.fspath) in changed_files.keys() and changed_files[str(test.fspath)].change_type == 'A':
-                    log_records.append(
-                        ('RUN', test.nodeid, "New test")
-                    )
-                    self.logger.info("Test '%s' is new, so will be run regardless of changes to the code it tests" % test.nodeid)
-                    test_count += 1
-                    continue
+        return log_records
 
-                # if the test failed in the last run, run it anyway
-                if test.nodeid in self.lastfailed:
-                    log_records.append(
-                        ('RUN', test.nodeid, "Failed on last run")
-                    )
-                    self.logger.info(
-                        "Test '%s' failed on the last run, so will be run regardless of changes" % test.nodeid)
-                    test_count += 1
-                    continue
+    def select_changed(self, items: ListOfTestItem, changed_files: DictOfChangedFile, deleted_files: DictOfChangedFile, git_repo_root: str, changed_data_files: ListOfString=(), changed_distributions: typing.Set[str]=frozenset(), locked_distributions: typing.Set[str]=frozenset()) -> ListOfLogRecord:
+        log_records = []
+        self._chains = {}  # chains are only shared within a selection, so that a long running collector doesn't keep them all
+        data_tests = self.find_data_tests(items, changed_data_files, git_repo_root)
+        for nodeid, reason in self.find_distribution_tests(items, changed_distributions, locked_distributions).items():
+            data_tests.setdefault(nodeid, reason)
+
+        if self.coverage_index is not None:  # the recorded coverage replaces the static analysis entirely
+            return self.select_by_coverage(items, changed_files, deleted_files, git_repo_root, data_tests)
+
+        # the changed members of each of the changed files, determined as they are needed
+        changed_members_and_modules = ChangedMembers(lambda ch: self.find_changed_members(ch, git_repo_root), changed_files)
+
+        test_count = 0
+        fixture_map = {}
+        ast_map = {}
+
+        for test in items:
+            started = time.perf_counter()
+            test_name = test.name.split('[')[0]  # TODO: figure out a better way to handle test names of parameterized tests
+
+            # if the test is new, run it anyway
+            if str(test.fspath) in changed_files.keys() and changed_files[str(test.fspath)].change_type == 'A':
+                self.record(log_records, ('RUN', test.nodeid, Reason.NEW_TEST), started)
+                self.logger.info("Test '%s' is new, so will be run regardless of changes to the code it tests", test.nodeid)
+                test_count += 1
+                continue
 
-                # if the test is already skipped, just ignore it
-                if test.get_marker('skip'):
-                    log_records.append(
-                        ('SKIP', test.nodeid, "Found skip marker")
-                    )
-                    self.logger.info("Found skip marker on test '%s' -- ignoring" % test.nodeid)
-                    continue
+            # if the test failed in the last run, run it anyway
+            if test.nodeid in self.lastfailed:
+                self.record(log_records, ('RUN', test.nodeid, Reason.FAILED_ON_LAST_RUN), started)
+                self.logger.info("Test '%s' failed on the last run, so will be run regardless of changes", test.nodeid)
+                test_count += 1
+                continue
 
-                # check dependencies within any defined fixtures
-                if str(test.fspath) in ast_map.keys():
-                    test_file_ast = ast_map[str(test.fspath)]
+            # if the test is already skipped, just ignore it
+            if self.has_skip_marker(test):
+                self.record(log_records, ('SKIP', test.nodeid, Reason.SKIP_MARKER), started)
+                self.logger.info("Found skip marker on test '%s' -- ignoring", test.nodeid)
+                continue
 
-                else:
-                    contents, _ = self.read_file(str(test.fspath))
-                    test_file_ast = ast.parse(contents)
-                    ast_map[str(test.fspath)] = test_file_ast
-
-                test_node = None
-                for child in ast.iter_child_nodes(test_file_ast):
-                    if isinstance(child, ast.ClassDef):
-                        for subchild in ast.iter_child_nodes(child):
-                            if isinstance(subchild, ast.FunctionDef) and subchild.name == test_name:
-                                test_node = subchild
-                                break
-
-                        if test_node is not None:
+            # if the test uses a changed data file, is mapped to one, or imports a distribution whose requirement changed, run it
+            if test.nodeid in data_tests:
+                self.record(log_records, ('RUN', test.nodeid, data_tests[test.nodeid]), started)
+                self.logger.info("Test '%s' will run because of a change outside of the python sources (%s)", test.nodeid, data_tests[test.nodeid])
+                test_count += 1
+                continue
+
+            # check dependencies within any defined fixtures
+            if str(test.fspath) in ast_map.keys():
+                test_file_ast = ast_map[str(test.fspath)]
+
+            else:
+                contents, _ = self.read_file(str(test.fspath))
+                test_file_ast = ast.parse(contents)
+                ast_map[str(test.fspath)] = test_file_ast
+
+            test_node = None
+            for child in ast.iter_child_nodes(test_file_ast):
+                if isinstance(child, ast.ClassDef):
+                    for subchild in ast.iter_child_nodes(child):
+                        if isinstance(subchild, FUNCTION_DEFINITIONS) and subchild.name == test_name:
+                            test_node = subchild
+                            test_name = child.name + '.' + test_name
                             break
 
-                    elif isinstance(child, ast.FunctionDef) and child.name == test_name:
-                        test_node = child
+                    if test_node is not None:
                         break
 
-                assert test_node is not None
-
-                if str(test.fspath) not in fixture_map.keys():
-                    fixture_extractor = FixtureExtractor()
-                    fixtures = fixture_extractor.extract(test_file_ast)
-
-                    fixture_map[str(test.fspath)] = fixtures
-
-                found_changed_fixture = False
-                for fixture in fixture_map[str(test.fspath)]:
-                    for arg in test_node.args.args:
-                        if arg.arg == fixture.name and self.dependencies_changed(str(test.fspath), fixture.name, changed_members_and_modules, []):
-                            log_records.append(
-                                ('RUN', test.nodeid, "Uses changed fixture")
-                            )
-                            self.logger.info("Test '%s' will run because it uses a changed fixture (%s)" % (
-                            test.nodeid, fixture.name))
-                            test_count += 1
-                            found_changed_fixture = True
-                            break
+                elif isinstance(child, FUNCTION_DEFINITIONS) and child.name == test_name:
+                    test_node = child
+                    break
+
+            assert test_node is not None
+
+            if str(test.fspath) not in fixture_map.keys():
+                fixture_extractor = FixtureExtractor()
+                fixtures = fixture_extractor.extract(test_file_ast)
 
-                    if found_changed_fixture:
+                fixture_map[str(test.fspath)] = fixtures
+
+            found_changed_fixture = False
+            for fixture in fixture_map[str(test.fspath)]:
+                for arg in test_node.args.args:
+                    if arg.arg == fixture.name and self.dependencies_changed(str(test.fspath), fixture.name, changed_members_and_modules, []):
+                        self.record(log_records, ('RUN', test.nodeid, Reason.CHANGED_FIXTURE), started)
+                        self.logger.info("Test '%s' will run because it uses a changed fixture (%s)", test.nodeid, fixture.name)
+                        test_count += 1
+                        found_changed_fixture = True
                         break
 
                 if found_changed_fixture:
-                    continue
+                    break
 
-                # otherwise, check the dependency chain from inside the test function
-                chain = []
-                if self.dependencies_changed(str(test.fspath), test_name, changed_members_and_modules, chain):
-                    log_records.append(
-                        ('RUN', test.nodeid, "Dependency changed: " + ' -> '.join(chain))
-                    )
-                    self.logger.info(
-                        "Test '%s' will run because one of it's dependencies changed (%s)" % (
-                        test.nodeid, ' -> '.join(chain)))
-                    test_count += 1
-                    continue
+            if found_changed_fixture:
+                continue
 
-                else:
-                    log_records.append(
-                        ('SKIP', test.nodeid, "Unchanged")
-                    )
-                    self.logger.info("Test '%s' doesn't touch new or modified code -- SKIPPING" % test.nodeid)
-                    skip = pytest.mark.skip(reason="This test doesn't touch new or modified code")
+            # otherwise, check the dependency chain from inside the test function
+            chain = []
+            if self.dependencies_changed(str(test.fspath), test_name, changed_members_and_modules, chain):
+                reason = DependencyChain(self.intern_chain(chain))
+                self.record(log_records, ('RUN', test.nodeid, reason), started)
+                self.logger.info("Test '%s' will run because one of its dependencies changed (%s)", test.nodeid, reason)
+                test_count += 1
+                continue
+
+            else:
+                self.record(log_records, ('SKIP', test.nodeid, Reason.UNCHANGED), started)
+                self.logger.info("Test '%s' doesn't touch new or modified code -- SKIPPING", test.nodeid)
+
+        self.module_classifier.save()
+        self.logger.warning("Total tests selected to run: %d", test_count)
+        return log_records
+
+    def intern_chain(self, chain: typing.List[typing.Tuple[str, str]]) -> typing.Tuple[typing.Tuple[str, str], ...]:
+        # many tests reach a change through the same objects, so equal chains (and the nodes in them) are only kept once
+        return self._chains.setdefault(tuple(chain), tuple(self._chains.setdefault(node, node) for node in chain))
+
+    def record(self, log_records: ListOfLogRecord, log_record: LogRecord, started: typing.Optional[float]=None):
+        # started is when the analysis of the test began, for the report
+        log_records.append(log_record)
+        if self.report is not None:
+            self.report.write(log_record, time.perf_counter() - started if started is not None else None)
+
+    def forget(self, paths: typing.Iterable[str]):
+        # drop whatever was analysed about paths, after they changed on disk
+        paths = list(paths)
+        self._exported_names.clear()
+        self._third_party_imports = {}  # the import closures that went through paths
+        self._module_paths = {}  # files may have been added or deleted
+
+        while paths:
+            path = paths.pop()
+            self._module_infos.pop(path, None)
+            self._module_asts.pop(path, None)
+            self._data_references.pop(path, None)
+            self._module_imports.pop(path, None)
+
+            # what the modules that star import path bind depends on what path exports
+            paths.extend(self._star_importers.pop(path, set()))
+
+            if self.project_index is None:
+                continue
+
+            if os.path.basename(path) == '__init__.py' and os.path.isfile(path) != (path in self.project_index.module_names):
+                self.project_index = None  # a package appeared or disappeared, which renames every module in it
+
+            elif path not in self.project_index.module_names and os.path.isfile(path):
+                self.project_index.add(path)
+
+            elif path in self.project_index.module_names and not os.path.isfile(path):
+                self.project_index.remove(path)
+
+    def reselect(self, items: ListOfTestItem, changed_files: DictOfChangedFile, deleted_files: DictOfChangedFile) -> ListOfLogRecord:
+        # the selection for changes made since an earlier select(), which reuses everything that was analysed then and is unaffected
+        self.forget(list(changed_files.keys()) + list(deleted_files.keys()))
+        git_repo_root, _, _ = self.load_project(items)
+
+        changed_files = {k: v for k, v in changed_files.items() if not self.should_ignore_source_file(k)}
+        return self.select_changed(items, changed_files, deleted_files, git_repo_root)
+
+    def find_covering_tests(self, changed_files: DictOfChangedFile, git_repo_root: str) -> typing.Set[str]:
+        covering_tests = set()
+
+        for ch in changed_files.values():
+            # the index was recorded against the old contents, so renamed files are looked up by their old path
+            relpath = self.coverage_index.relpath(os.path.join(git_repo_root, ch.old_filepath or ch.current_filepath))
+
+            if ch.hunks is None:  # the whole file changed
+                covering_tests.update(self.coverage_index.tests_for_file(relpath))
+                continue
+
+            for preimage_start, preimage_count, _, _ in ch.hunks:
+                # a pure insertion touches the lines on either side of it
+                last_line = preimage_start + preimage_count - 1 if preimage_count > 0 else preimage_start + 1
+                touching = self.coverage_index.tests_touching(relpath, preimage_start, last_line)
+
+                if not touching:  # lines that never ran in a test (e.g. module level code or signatures) affect every test using the file
+                    touching = self.coverage_index.tests_for_file(relpath)
+
+                covering_tests.update(touching)
+
+        return covering_tests
+
+    def select_by_coverage(self, items: ListOfTestItem, changed_files: DictOfChangedFile, deleted_files: DictOfChangedFile, git_repo_root: str, data_tests: typing.Dict[str, Reason]) -> ListOfLogRecord:
+        log_records = []
+        test_count = 0
+
+        all_changed_files = dict(changed_files)
+        all_changed_files.update(deleted_files)
+        covering_tests = self.find_covering_tests(all_changed_files, git_repo_root)
+
+        if self.coverage_index.commit is not None and self.base_commit is not None and self.coverage_index.commit != self.base_commit:
+            self.logger.warning("The coverage index was recorded at commit %s, but the diff is calculated from %s -- line numbers may have shifted", self.coverage_index.commit, self.base_commit)
+
+        for test in items:
+            started = time.perf_counter()
+            if str(test.fspath) in changed_files.keys() and changed_files[str(test.fspath)].change_type == 'A':
+                self.record(log_records, ('RUN', test.nodeid, Reason.NEW_TEST), started)
+                self.logger.info("Test '%s' is new, so will be run regardless of changes to the code it tests", test.nodeid)
+                test_count += 1
+
+            elif test.nodeid in self.lastfailed:
+                self.record(log_records, ('RUN', test.nodeid, Reason.FAILED_ON_LAST_RUN), started)
+                self.logger.info("Test '%s' failed on the last run, so will be run regardless of changes", test.nodeid)
+                test_count += 1
+
+            elif self.has_skip_marker(test):
+                self.record(log_records, ('SKIP', test.nodeid, Reason.SKIP_MARKER), started)
+                self.logger.info("Found skip marker on test '%s' -- ignoring", test.nodeid)
+
+            elif test.nodeid in data_tests:  # coverage is only recorded for the project's python sources
+                self.record(log_records, ('RUN', test.nodeid, data_tests[test.nodeid]), started)
+                self.logger.info("Test '%s' will run because of a change outside of the python sources (%s)", test.nodeid, data_tests[test.nodeid])
+                test_count += 1
+
+            elif test.nodeid not in self.coverage_index:
+                self.record(log_records, ('RUN', test.nodeid, Reason.NOT_IN_COVERAGE_INDEX), started)
+                self.logger.info("Test '%s' has no recorded coverage, so will be run", test.nodeid)
+                test_count += 1
+
+            elif test.nodeid in covering_tests:
+                self.record(log_records, ('RUN', test.nodeid, Reason.COVERS_CHANGED_LINES), started)
+                self.logger.info("Test '%s' will run because it executed changed lines", test.nodeid)
+                test_count += 1
+
+            else:
+                self.record(log_records, ('SKIP', test.nodeid, Reason.UNCHANGED), started)
+                self.logger.info("Test '%s' doesn't touch new or modified code -- SKIPPING", test.nodeid)
+
+        self.logger.warning("Total tests selected to run: %d", test_count)
+        return log_records
+
+    def get_data_map(self) -> DataMap:
+        if self._data_map is None:
+            self._data_map = DataMap.parse(self.data_map or [], self.rootdir)
+
+        return self._data_map
+
+    def get_data_references(self, path: str) -> DataReferenceIndex:
+        if path not in self._data_references:
+            contents, _ = self.read_file(path)
+            self._data_references[path] = DataReferenceIndex(ast.parse(contents))
+
+        return self._data_references[path]
+
+    def find_data_tests(self, items: ListOfTestItem, changed_data_files: ListOfString, git_repo_root: str) -> typing.Dict[str, Reason]:
+        # the tests that a change to a data file selects: those that the data map maps the file to, and those that refer to
+        # the file with a string literal (e.g. open('data/users.json')), matched by the trailing components of its path
+        data_tests = {}
+        if not changed_data_files:
+            return data_tests
+
+        data_map = self.get_data_map()
+        mapped_paths = set()
+        mapped_markers = set()
+        suffixes = set()
+
+        for path in changed_data_files:
+            paths, markers = data_map.find_targets(path)
+            mapped_paths.update(paths)
+            mapped_markers.update(markers)
+            suffixes.update(find_path_suffixes(os.path.relpath(path, git_repo_root)))
+
+        for test in items:
+            if any(DataMap.matches_path(test.nodeid, target) for target in mapped_paths) or any(test.get_marker(marker) for marker in mapped_markers):
+                data_tests[test.nodeid] = Reason.DATA_MAP_CHANGED
+                continue
+
+            # the name of the test function, qualified by its class (pytest 3 adds a "()" for the instance)
+            names = [name for name in test.nodeid.split('::')[1:] if name != '()']
+            test_name = '.'.join(names[-2:] if len(names) > 1 else names).split('[')[0]
+
+            if not self.get_data_references(str(test.fspath)).find_literals(test_name).isdisjoint(suffixes):
+                data_tests[test.nodeid] = Reason.DATA_FILE_CHANGED
+
+        return data_tests
+
+    def find_changed_distributions(self, repo_path: str, d) -> typing.Set[str]:
+        blob_reader = self.get_blob_reader(repo_path)
+        old_contents = blob_reader.read(d.a_blob.hexsha) if d.a_blob is not None else None
+        new_contents = blob_reader.read(d.b_blob.hexsha) if d.b_blob is not None else None
+        return find_changed_distributions(d.b_path or d.a_path, old_contents or '', new_contents or '')
+
+    def find_module_imports(self, path: str) -> typing.Tuple[typing.Set[str], ListOfString]:
+        # the top level names of the third party modules that path imports, and the project modules it imports (including the
+        # packages they are in, whose __init__ runs first)
+        try:
+            return self._module_imports[path]
+
+        except KeyError:
+            pass
+
+        git_repo_root = self.find_git_repo_root(self.rootdir)
+        module_ast = self.get_module_ast(path)
+        module_names = [module_name for _, module_name in ModuleBindingExtractor().extract(module_ast)]
+
+        for module_name, imported_names, import_level in ImportModuleNameExtractor().extract(module_ast):
+            if len(imported_names) == 0:
+                continue
+
+            module_name = self.resolve_module_name(path, module_name, import_level)
+            module_names.append(module_name)
+            module_names.extend(module_name + '.' + imported_name for imported_name in imported_names if imported_name != '*')
+
+        third_party_names = set()
+        module_paths = []
+        for module_name in module_names:
+            module_class = self.module_classifier.classify(module_name)
+            if module_class == ModuleClassifier.SITE_PACKAGES:
+                third_party_names.add(module_name.split('.')[0])
+
+            elif module_class == ModuleClassifier.PROJECT:
+                parts = module_name.split('.')
+                for i in range(1, len(parts) + 1):
+                    module_path = self.find_module_path('.'.join(parts[:i]))
+                    if module_path is not None and self.file_in_project(git_repo_root, module_path) and module_path not in module_paths:
+                        module_paths.append(module_path)
+
+        self._module_imports[path] = (third_party_names, module_paths)
+        return self._module_imports[path]
+
+    def find_third_party_imports(self, path: str) -> typing.Set[str]:
+        # the top level names of the third party modules that a test file imports, directly or through the project modules and
+        # conftest files it (transitively) imports
+        try:
+            return self._third_party_imports[path]
+
+        except KeyError:
+            pass
+
+        paths = [path]
+        directory = os.path.dirname(path)
+        while os.path.commonpath([directory, self.rootdir]) == self.rootdir:
+            paths.append(os.path.join(directory, 'conftest.py'))
+            if directory == os.path.dirname(directory):
+                break
+
+            directory = os.path.dirname(directory)
+
+        third_party_names = set()
+        visited = set()
+        while paths:
+            module_path = paths.pop()
+            if module_path in visited or not os.path.isfile(module_path):
+                continue
+
+            visited.add(module_path)
+            try:
+                names, module_paths = self.find_module_imports(module_path)
+
+            except (SyntaxError, ValueError) as e:
+                self.logger.warning("Couldn't read the imports of '%s' -- %s", module_path, e)
+                continue
+
+            third_party_names.update(names)
+            paths.extend(module_paths)
+
+        self._third_party_imports[path] = third_party_names
+        return third_party_names
+
+    def find_distribution_tests(self, items: ListOfTestItem, changed_distributions: typing.Set[str], locked_distributions: typing.Set[str]=frozenset()) -> typing.Dict[str, Reason]:
+        # the tests that import (through the project) any of the top level modules of the distributions whose requirement
+        # changed. a change that can't be put down to a distribution (e.g. a new index url) selects every test importing
+        # anything third party, and so does a changed lock file pin (locked_distributions) of a distribution that no test
+        # imports, which is most likely required by one that they do
+        distribution_tests = {}
+        if not changed_distributions:
+            return distribution_tests
+
+        third_party_imports = dict((test.nodeid, self.find_third_party_imports(str(test.fspath))) for test in items)
+        imported_names = set(name for names in third_party_imports.values() for name in names)
+
+        import_names = find_distribution_import_names(self.search_path if self.search_path is not None else sys.path)
+        changed_names = set()
+        any_changed = ALL_DISTRIBUTIONS in changed_distributions
+        for distribution in changed_distributions:
+            names = import_names.get(distribution) or guess_import_names(distribution)
+            if distribution in locked_distributions and names.isdisjoint(imported_names):
+                any_changed = True
+
+            changed_names.update(names)
+
+        self.logger.info("Distributions changed: %s (imported as %s)", ', '.join(sorted(changed_distributions)), ', '.join(sorted(changed_names)))
+
+        for test in items:
+            third_party_names = third_party_imports[test.nodeid]
+            if (any_changed and third_party_names) or not third_party_names.isdisjoint(changed_names):
+                distribution_tests[test.nodeid] = Reason.DISTRIBUTION_CHANGED
+
+        return distribution_tests
+
+    @staticmethod
+    def has_skip_marker(test: pytest.Item) -> bool:
+        # skip markers added by an earlier selection (see apply_selection and prioritise) don't count
+        marker = test.get_marker('skip')
+        return bool(marker) and marker.kwargs.get('reason') not in (SKIP_REASON, BUDGET_SKIP_REASON)
+
+    @staticmethod
+    def apply_selection(items: ListOfTestItem, log_records: ListOfLogRecord):
+        unchanged = set(nodeid for action, nodeid, reason in log_records if action == 'SKIP' and reason == Reason.UNCHANGED)
+        skip = pytest.mark.skip(reason=SKIP_REASON)
+
+        for test in items:
+            if test.nodeid in unchanged:
+                test.add_marker(skip)
+
+    @staticmethod
+    def find_failure_likelihood(reason: typing.Union[Reason, DependencyChain, str], failure_rate: float) -> float:
+        # how likely a selected test is to fail, from why it was selected and how often it failed before
+        if reason == Reason.FAILED_ON_LAST_RUN:
+            prior = 1.0
+
+        elif reason == Reason.NEW_TEST:
+            prior = 0.5
+
+        elif isinstance(reason, DependencyChain):  # the closer the change is to the test, the more likely it is to break it
+            prior = 0.5 / max(1, reason.hops)
+
+        else:
+            prior = 0.25
+
+        return 1.0 - (1.0 - prior) * (1.0 - failure_rate)
+
+    def prioritise(self, items: ListOfTestItem, log_records: ListOfLogRecord, history: RunHistory, budget: typing.Optional[float]=None) -> ListOfLogRecord:
+        # runs the selected tests that are most likely to fail for the least time first. with a budget (in seconds), only the
+        # tests that fit into it in that order are run. the order only depends on the selection and the history, so that every
+        # xdist worker comes up with the same one. tests are only reordered within their module and class, which are ordered by
+        # their most valuable test, so that module and class scoped fixtures are still set up once
+        reasons = dict((nodeid, reason) for action, nodeid, reason in log_records if action == 'RUN')
+        default_duration = history.mean_duration()
+        selected = []
+        skipped = []
+
+        for idx, test in enumerate(items):
+            if test.nodeid not in reasons:
+                skipped.append(test)
+                continue
+
+            duration = max(history.duration(test.nodeid, default_duration), 0.001)
+            likelihood = self.find_failure_likelihood(reasons[test.nodeid], history.failure_rate(test.nodeid))
+            selected.append((-likelihood / duration, idx, duration, test))
+
+        # the best score and first position of every module and class, by node id prefix
+        groups = {}
+        for score, idx, _, test in selected:
+            parts = test.nodeid.split('::')
+            for i in range(1, len(parts)):
+                best_score, first_idx = groups.get('::'.join(parts[:i]), (score, idx))
+                groups['::'.join(parts[:i])] = (min(best_score, score), min(first_idx, idx))
+
+        def sort_key(entry):
+            parts = entry[3].nodeid.split('::')
+            return tuple(groups['::'.join(parts[:i])] for i in range(1, len(parts))) + ((entry[0], entry[1]),)
+
+        selected.sort(key=sort_key)
+        budget_records = []
+
+        if budget is not None:
+            total = 0.0
+            skip = pytest.mark.skip(reason=BUDGET_SKIP_REASON)
+
+            for _, _, duration, test in selected:
+                if total + duration > budget and total > 0:  # the most valuable test runs even if it doesn't fit by itself
                     test.add_marker(skip)
+                    budget_records.append(('SKIP', test.nodeid, Reason.OVER_BUDGET))
+
+                else:
+                    total += duration
 
-            # TODO: add option to write to csv
-            import csv
-            with open("results.csv", "w") as csvfile:
-                csvwriter = csv.writer(csvfile)
-                for row in log_records:
-                    csvwriter.writerow(list(row))
+            if budget_records:
+                self.logger.warning("%d selected tests don't fit into the time budget of %s seconds", len(budget_records), budget)
 
-            self.logger.warning("Total tests selected to run: " + str(test_count))
-            self._revert_syspath()
+            # only the process that reported the selection reports what the budget left out of it
+            if self.report is not None and self.report.count:
+                for log_record in budget_records:
+                    self.report.write(log_record)
 
-        except Exception as e:
-            self._handle_exception(str(e))
+        items[:] = [test for _, _, _, test in selected] + skipped
+        return budget_records
+
+    def export_selection(self, path: str, log_records: ListOfLogRecord):
+        SelectionArtifact(self.head_commit, self.base_commit, self.head_tree, log_records).write(path)
+        self.logger.info("Exported the smart collection selection to '%s'", path)
+
+    def import_selection(self, path: str) -> ListOfLogRecord:
+        artifact = SelectionArtifact.read(path)
+
+        # the selection is only valid for the commit it was computed on
+        repo = Repo(self.find_git_repo_root(self.rootdir))
+        head = repo.head.commit
+
+        if artifact.head != head.hexsha or artifact.tree != head.tree.hexsha:
+            raise Exception("The smart collection selection in '%s' was computed for commit %s, but the current HEAD is %s" % (path, artifact.head, head.hexsha))
+
+        return artifact.log_records
+
+    def query_or_select(self, items: ListOfTestItem) -> ListOfLogRecord:
+        # a running selection daemon (see pytest_smartcollect.daemon) already has the repository analysed, so it is asked first
+        if self.daemon is not None:
+            response = self.daemon.select(self, items)
+            if response is not None:
+                self.head_commit, self.base_commit, self.head_tree = response['head'], response['base'], response['tree']
+                return load_records(response['records'])
+
+        return self.select(items)
+
+    def run(self, items: ListOfTestItem, shared_selection: typing.Optional[SharedSelection]=None, export_path: StrOrNone=None, apply: bool=True) -> ListOfLogRecord:
+        # without apply, the selection is only computed (and reported and exported), e.g. for a shadow run of every test
+        if shared_selection is None:
+            log_records = self.query_or_select(items)
+            computed = True
+
+        else:  # another process of the same run (e.g. an xdist worker) may have already done the analysis
+            log_records, computed = shared_selection.get(lambda: self.query_or_select(items))
+            if not computed:
+                self.logger.info("Reusing the selection computed by another process of this run")
+
+        if apply:
+            self.apply_selection(items, log_records)
+
+        if computed:
+            # a selection computed by the daemon is reported without analysis times
+            if self.report is not None and self.report.count == 0:
+                for log_record in log_records:
+                    self.report.write(log_record)
+
+            if export_path is not None:
+                self.export_selection(export_path, log_records)
+
+        return log_records
+
+    def run_imported(self, items: ListOfTestItem, import_path: str) -> ListOfLogRecord:
+        log_records = self.import_selection(import_path)
+        self.apply_selection(items, log_records)
+
+        if self.report is not None:
+            for log_record in log_records:
+                self.report.write(log_record)
+
+        # anything that wasn't collected when the selection was computed is run, since there is nothing known about it
+        known = set(nodeid for _, nodeid, _ in log_records)
+        unknown = [test.nodeid for test in items if test.nodeid not in known]
+        if unknown:
+            self.logger.warning("%d collected tests aren't in the imported selection and will be run", len(unknown))
+
+        return log_records
 
     def _handle_exception(self, msg):
-        self._revert_syspath()
         raise Exception(msg)
 
-    def _revert_syspath(self):
-        for _ in range(0, len(self.packages)):
-            sys.path.pop(0)
-
 
 
 
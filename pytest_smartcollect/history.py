@@ -0,0 +1,76 @@
+import typing
+
+
+class RunHistory(object):
+    # per test: exponentially weighted moving averages of its duration and of how often it failed, over the runs it ran in
+    CACHE_KEY = 'smartcollect/history'
+    WEIGHT = 0.3
+
+    # tests that haven't run for this many runs (e.g. because they were deleted or renamed) are forgotten
+    MAX_AGE = 200
+
+    def __init__(self, run: int=0, tests: typing.Optional[typing.Dict[str, list]]=None):
+        self.run = run
+        self.tests = tests if tests is not None else {}  # node id -> [duration, failure rate, last run]
+
+    @classmethod
+    def load(cls, cache) -> 'RunHistory':
+        d = cache.get(cls.CACHE_KEY, {})
+        return cls(d.get('run', 0), d.get('tests', {}))
+
+    def save(self, cache):
+        cache.set(self.CACHE_KEY, {'run': self.run, 'tests': self.tests})
+
+    def record(self, results: typing.Dict[str, typing.Tuple[float, bool]]):
+        # results is node id -> (duration, failed) for every test that ran
+        self.run += 1
+
+        for nodeid, (duration, failed) in results.items():
+            failure = 1.0 if failed else 0.0
+
+            if nodeid in self.tests:
+                old_duration, old_failure_rate, _ = self.tests[nodeid]
+                self.tests[nodeid] = [
+                    old_duration + self.WEIGHT * (duration - old_duration),
+                    old_failure_rate + self.WEIGHT * (failure - old_failure_rate),
+                    self.run
+                ]
+
+            else:
+                self.tests[nodeid] = [duration, failure, self.run]
+
+        self.tests = {nodeid: v for nodeid, v in self.tests.items() if self.run - v[2] < self.MAX_AGE}
+
+    def duration(self, nodeid: str, default: float) -> float:
+        return self.tests[nodeid][0] if nodeid in self.tests else default
+
+    def failure_rate(self, nodeid: str) -> float:
+        return self.tests[nodeid][1] if nodeid in self.tests else 0.0
+
+    def mean_duration(self, default: float=1.0) -> float:
+        if not self.tests:
+            return default
+
+        return sum(v[0] for v in self.tests.values()) / len(self.tests)
+
+
+class HistoryRecorder(object):
+    # a pytest plugin that adds the durations and outcomes of the tests that ran to the history at the end of the session
+    def __init__(self, config):
+        self.config = config
+        self.results = {}
+        self.ran = set()
+
+    def pytest_runtest_logreport(self, report):
+        duration, failed = self.results.get(report.nodeid, (0.0, False))
+        self.results[report.nodeid] = (duration + report.duration, failed or report.failed)
+
+        # tests that were skipped before they got to run say nothing about how long they take or how likely they are to fail
+        if report.when == 'call' or report.failed:
+            self.ran.add(report.nodeid)
+
+    def pytest_sessionfinish(self, session):
+        if self.ran:
+            history = RunHistory.load(self.config.cache)
+            history.record({nodeid: self.results[nodeid] for nodeid in self.ran})
+            history.save(self.config.cache)
@@ -0,0 +1,184 @@
+import os
+import re
+import typing
+import hashlib
+
+ListOfString = typing.List[str]
+
+# gitignore style patterns, one per line, relative to the directory of the file. read from the root of the git repository
+# and from the pytest rootdir
+IGNORE_FILE_NAME = '.smartcollectignore'
+
+GLOB_CHARACTERS = re.compile(r'[*?\[]')
+
+
+def translate_glob(pattern: str) -> str:
+    # like fnmatch.translate, except that wildcards don't cross directories and "**" matches any number of them
+    i = 0
+    regex = ''
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+
+        elif c == '*':
+            regex += '[^/]*'
+
+        elif c == '?':
+            regex += '[^/]'
+
+        elif c == '[':
+            end = pattern.find(']', i + 2 if pattern.startswith('[!', i) else i + 1)
+            if end < 0:
+                regex += re.escape(c)
+
+            else:
+                chars = pattern[i + 1:end].replace('\\', '\\\\')
+                regex += '[^%s]' % chars[1:] if chars.startswith('!') else '[%s]' % chars
+                i = end
+
+        else:
+            regex += re.escape(c)
+
+        i += 1
+
+    return regex
+
+
+class IgnoreMatcher(object):
+    # compiles the ignore rules once, so that a path is matched in O(depth of the path): plain paths go into a trie of path
+    # components, and the glob patterns of every base directory are combined into a single regular expression
+    def __init__(self):
+        self._trie = {}
+        self._globs = {}  # base directory -> ([patterns matching anything], [patterns matching directories only])
+        self._compiled = None
+        self.rules = []
+
+    @classmethod
+    def from_rules(cls, rules: typing.Iterable, base: str, ignore_files: typing.Iterable[str]=()) -> 'IgnoreMatcher':
+        matcher = cls()
+        for rule in rules:
+            if isinstance(rule, str):  # a bare --ignore-source has no path
+                matcher.add(rule, base)
+
+        for path in ignore_files:
+            matcher.add_file(path)
+
+        return matcher
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @property
+    def key(self) -> str:
+        # identifies the rules, e.g. for caches of anything that was built with them applied
+        return hashlib.sha1('\n'.join(self.rules).encode('utf-8')).hexdigest()
+
+    def add_file(self, path: str):
+        try:
+            with open(path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+
+        except (IOError, OSError):
+            return
+
+        base = os.path.dirname(os.path.abspath(path))
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                self.add_pattern(line, base)
+
+    def add(self, rule: str, base: str):
+        # a source file or folder, as given to --ignore-source: relative paths are relative to base, and globs are matched
+        # against whole paths
+        path = os.path.join(base, rule)
+        if GLOB_CHARACTERS.search(rule) is None:
+            self.add_path(path)
+
+        else:
+            root = os.path.splitdrive(os.path.abspath(path))[0] + os.sep
+            self.add_pattern('/' + os.path.relpath(path, root), root)
+
+    def add_path(self, path: str):
+        node = self._trie
+        for part in self._split(os.path.abspath(path)):
+            node = node.setdefault(part, {})
+
+        node[None] = True
+        self.rules.append(os.path.abspath(path))
+
+    def add_pattern(self, pattern: str, base: str):
+        # gitignore semantics: a pattern containing a slash is relative to base, any other pattern matches a name anywhere
+        # below base, and a trailing slash only matches directories
+        pattern = pattern.replace(os.sep, '/')
+        directories_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        if anchored and not directories_only and GLOB_CHARACTERS.search(pattern) is None:
+            self.add_path(os.path.join(base, pattern))
+            return
+
+        regex = translate_glob(pattern) if anchored else '(?:.*/)?' + translate_glob(pattern)
+        patterns = self._globs.setdefault(os.path.abspath(base), ([], []))
+        patterns[1 if directories_only else 0].append(regex)
+        self.rules.append("%s:%s%s" % (os.path.abspath(base), pattern, '/' if directories_only else ''))
+        self._compiled = None
+
+    @staticmethod
+    def _split(path: str) -> ListOfString:
+        return [p for p in path.replace(os.sep, '/').split('/') if p]
+
+    def _compile(self):
+        combine = lambda regexes: re.compile('(?:%s)\\Z' % '|'.join(regexes)) if regexes else None
+        self._compiled = [(base, combine(anything), combine(directories)) for base, (anything, directories) in self._globs.items()]
+
+    def matches(self, path: str, is_dir: bool=False) -> bool:
+        if not self.rules:
+            return False
+
+        path = os.path.abspath(path)
+
+        node = self._trie
+        for part in self._split(path):
+            node = node.get(part)
+            if node is None:
+                break
+
+            if None in node:
+                return True
+
+        if self._compiled is None:
+            self._compile()
+
+        for base, anything, directories in self._compiled:
+            relpath = os.path.relpath(path, base) if os.path.splitdrive(path)[0] == os.path.splitdrive(base)[0] else os.pardir
+            if relpath in (os.curdir, os.pardir) or relpath.startswith(os.pardir + os.sep):
+                continue
+
+            # a path is ignored if it, or any of the directories it is in, matches
+            parts = self._split(relpath)
+            for i in range(1, len(parts) + 1):
+                prefix = '/'.join(parts[:i])
+                if anything is not None and anything.match(prefix):
+                    return True
+
+                if directories is not None and (i < len(parts) or is_dir) and directories.match(prefix):
+                    return True
+
+        return False
+
+    def prune(self, root: str, dirnames: ListOfString):
+        # removes the ignored directories from the dirnames of an os.walk, so that they aren't walked at all
+        if self.rules:
+            dirnames[:] = [d for d in dirnames if not self.matches(os.path.join(root, d), is_dir=True)]
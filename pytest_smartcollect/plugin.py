@@ -1,6 +1,20 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
+import glob
+import uuid
+import shlex
+import subprocess
 import pytest
+from git import Repo
 from pytest_smartcollect.helpers import SmartCollector
+from pytest_smartcollect.selection import SharedSelection
+from pytest_smartcollect.coverage_index import CoverageIndex, CoverageIndexShards, make_line_tracer
+from pytest_smartcollect.watch import SelectionWatcher, make_watcher
+from pytest_smartcollect.daemon import DaemonClient, get_socket_path
+from pytest_smartcollect.history import RunHistory, HistoryRecorder
+from pytest_smartcollect.report import SelectionReport
+from pytest_smartcollect.shadow import ShadowRecorder
 
 
 def pytest_addoption(parser):
@@ -19,7 +33,7 @@ def pytest_addoption(parser):
         const=True,
         metavar='path',
         dest='ignore_source',
-        help='Source code file or folder to ignore during smart collection.  Multiple instances of this flag are supported.'
+        help='Source code file or folder to ignore during smart collection.  Relative paths are relative to the rootdir, and glob patterns are supported.  Multiple instances of this flag are supported.'
     )
     group.addoption(
         '--commit-range',
@@ -43,6 +57,248 @@ def pytest_addoption(parser):
         dest='allow_preemptive_failures',
         help="If any deleted or renamed files are found to be imported in any files under test, collection will fail when using smart collection. Default is False."
     )
+    group.addoption(
+        '--smart-collect-max-depth',
+        action='store',
+        default=None,
+        type=int,
+        dest='smart_collect_max_depth',
+        help='The maximum number of dependency hops to follow from each test when looking for changes.  Dependencies beyond this depth are not inspected.  Default is unlimited.'
+    )
+    group.addoption(
+        '--smart-collect-export',
+        action='store',
+        default=None,
+        metavar='path',
+        dest='smart_collect_export',
+        help='Write the computed smart collection selection to a file, so that it can be applied elsewhere with --smart-collect-import.  Paths ending in .gz are compressed.'
+    )
+    group.addoption(
+        '--smart-collect-import',
+        action='store',
+        default=None,
+        metavar='path',
+        dest='smart_collect_import',
+        help='Apply a selection written by --smart-collect-export instead of analysing the repository.  The selection must have been computed on the current HEAD commit.'
+    )
+    group.addoption(
+        '--smart-collect-record',
+        action='store_true',
+        default=False,
+        dest='smart_collect_record',
+        help='Record the lines executed by each test into a coverage index in the pytest cache, for use with --smart-collect-engine=coverage.  This should be done on a full run.'
+    )
+    group.addoption(
+        '--smart-collect-engine',
+        action='store',
+        default='static',
+        choices=['static', 'coverage'],
+        dest='smart_collect_engine',
+        help='How to decide which tests touch changed code: "static" analyses imports and names in the source, "coverage" intersects the diff with the index recorded by --smart-collect-record.  Default is "static".'
+    )
+    group.addoption(
+        '--smart-collect-budget',
+        action='store',
+        default=None,
+        type=float,
+        metavar='SECONDS',
+        dest='smart_collect_budget',
+        help='Only run the selected tests that are most likely to fail for the time they take, up to an expected total of this many seconds (based on the durations of earlier runs).'
+    )
+    group.addoption(
+        '--smart-collect-watch',
+        action='store_true',
+        default=False,
+        dest='smart_collect_watch',
+        help='With --smart-collect, keep watching the repository after the run, and re-run the tests affected by every change that is saved.  Stop with Ctrl+C.'
+    )
+    group.addoption(
+        '--smart-collect-shadow',
+        action='store_true',
+        default=False,
+        dest='smart_collect_shadow',
+        help='Run every test, and compare the selection that --smart-collect would have made to the outcomes: tests that failed but would have been skipped, the share of tests selected and the time saved.  The statistics accumulate in the pytest cache.'
+    )
+    group.addoption(
+        '--smart-collect-report',
+        action='store',
+        default=None,
+        metavar='path',
+        dest='smart_collect_report',
+        help='Write the decision made for every test, with the reason for it and how long the analysis of the test took, to a file as the selection is computed.  Paths ending in .jsonl or .json are written as JSON lines, anything else as CSV.'
+    )
+    parser.addini(
+        'smart_collect_ignore',
+        type='linelist',
+        default=[],
+        help='Source code files or folders to ignore during smart collection, one per line, in addition to any --ignore-source flags.  Relative paths are relative to the rootdir, and glob patterns are supported.'
+    )
+    parser.addini(
+        'smart_collect_data_map',
+        type='linelist',
+        default=[],
+        help='Tests to run when non-python files change, one "glob = target [target ...]" per line.  Globs are relative to the rootdir, and targets are test files, folders or node ids relative to the rootdir, or "marker:name" for the tests with a marker.'
+    )
+
+
+def _get_worker_input(config):
+    # older versions of pytest-xdist use the name 'slaveinput'
+    return getattr(config, 'workerinput', None) or getattr(config, 'slaveinput', None)
+
+
+def _get_shared_selection(config, run_id):
+    return SharedSelection(str(config.cache.makedir('smartcollect')), run_id)
+
+
+class SmartCollectXdistHooks(object):
+    # registered on the xdist controller only, so that every worker of a run shares a single selection
+    def __init__(self, run_id):
+        self.run_id = run_id
+
+    def pytest_configure_node(self, node):
+        worker_input = getattr(node, 'workerinput', None)
+        if worker_input is None:
+            worker_input = node.slaveinput
+
+        worker_input['smart_collect_run_id'] = self.run_id
+
+    def pytest_unconfigure(self, config):
+        _get_shared_selection(config, self.run_id).remove()
+
+
+def _get_invocation(config):
+    # the directory pytest was run from and the arguments it was given, without the paths and node ids to test and the options
+    # that start watching
+    invocation_params = getattr(config, 'invocation_params', None)
+    if invocation_params is not None:
+        invocation_dir, args = str(invocation_params.dir), list(invocation_params.args)
+
+    else:  # pytest < 5.1 only keeps the arguments with the addopts of the ini file and PYTEST_ADDOPTS in front of them
+        addopts = config.getini('addopts') + shlex.split(os.environ.get('PYTEST_ADDOPTS', ''))
+        invocation_dir, args = str(config.invocation_dir), config._origargs[len(addopts):]
+
+    paths = set(str(arg) for arg in config.args)
+    return invocation_dir, [str(arg) for arg in args if str(arg) not in paths and str(arg) not in ('--smart-collect', '--smart-collect-watch')]
+
+
+def _get_coverage_index_dir(config):
+    return str(config.cache.makedir('smartcollect'))
+
+
+def load_coverage_index(config, root):
+    # xdist workers each record their own shard of the index
+    shards = [CoverageIndex.read(root, path) for path in sorted(glob.glob(os.path.join(_get_coverage_index_dir(config), 'coverage-index*.bin')))]
+
+    if not shards:
+        return None
+
+    elif len(shards) == 1:
+        return shards[0]
+
+    return CoverageIndexShards(shards)
+
+
+class CoverageRecorder(object):
+    def __init__(self, config):
+        repo = Repo(str(config.rootdir), search_parent_directories=True)
+        worker_input = _get_worker_input(config)
+
+        if worker_input is None:
+            for path in glob.glob(os.path.join(_get_coverage_index_dir(config), 'coverage-index*.bin')):
+                os.remove(path)
+
+            filename = 'coverage-index.bin'
+
+        else:
+            filename = 'coverage-index-%s.bin' % worker_input.get('workerid', worker_input.get('slaveid'))
+
+        self.path = os.path.join(_get_coverage_index_dir(config), filename)
+        self.index = CoverageIndex(repo.working_tree_dir, repo.head.commit.hexsha)
+        self.tracer = make_line_tracer(repo.working_tree_dir)
+        self.warned = False
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        # setup and teardown are included, since fixtures are part of what a test depends on. tests that can't be recorded
+        # are left out of the index, so that they are always selected
+        if not self.tracer.start():
+            if not self.warned:
+                from logging import getLogger
+                getLogger('pytest_smartcollect').warning("Another tracer (e.g. pytest-cov) is active, so no coverage index is recorded")
+                self.warned = True
+
+            yield
+            return
+
+        try:
+            yield
+
+        finally:
+            self.index.add(item.nodeid, self.tracer.stop())
+
+    def pytest_sessionfinish(self, session):
+        if self.index.tests:
+            self.index.write(self.path)
+
+
+class SmartCollectWatch(object):
+    # takes over the smart collector of the run, so that everything it analysed stays warm while watching
+    def __init__(self):
+        self.smart_collector = None
+        self.items = None
+
+    def pytest_unconfigure(self, config):
+        if self.smart_collector is None:  # e.g. the tests were distributed with xdist, so there was nothing collected here
+            return
+
+        invocation_dir, args = _get_invocation(config)
+
+        def rerun(nodeids):
+            # the tests run in a fresh process, since the modules they import can't reliably be reloaded in this one. node ids
+            # are relative to the rootdir, and the options to where pytest was run from
+            nodeids = [os.path.join(str(config.rootdir), nodeid) for nodeid in nodeids]
+            returncode = subprocess.call([sys.executable, '-m', 'pytest'] + args + nodeids, cwd=invocation_dir)
+            self.smart_collector.lastfailed = config.cache.get("cache/lastfailed", {})
+            return returncode
+
+        capture_manager = config.pluginmanager.getplugin('capturemanager')
+        if capture_manager is not None:
+            capture_manager.suspend_global_capture()
+
+        try:
+            watcher = make_watcher(self.smart_collector.find_git_repo_root(self.smart_collector.rootdir), self.smart_collector.get_ignore_matcher())
+            try:
+                SelectionWatcher(self.smart_collector, self.items, watcher, self.smart_collector.logger).watch(rerun)
+
+            finally:
+                watcher.close()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.smart_collector.close()
+
+
+def pytest_configure(config):
+    smart_collect = config.option.smart_collect or config.option.smart_collect_shadow
+    if smart_collect and _get_worker_input(config) is None and config.pluginmanager.hasplugin('xdist'):
+        config.pluginmanager.register(SmartCollectXdistHooks(uuid.uuid4().hex), 'smartcollect-xdist')
+
+    if config.option.smart_collect_shadow and _get_worker_input(config) is None:
+        xdist_hooks = config.pluginmanager.getplugin('smartcollect-xdist')
+        read_selection = (lambda: _get_shared_selection(config, xdist_hooks.run_id).read()) if xdist_hooks is not None else (lambda: None)
+        config.pluginmanager.register(ShadowRecorder(config, read_selection), 'smartcollect-shadow')
+
+    if config.option.smart_collect_record:
+        config.pluginmanager.register(CoverageRecorder(config), 'smartcollect-recorder')
+
+    # the durations and failures of every run are kept, to prioritise the tests of later runs (only the controller sees all of them)
+    if (smart_collect or config.option.smart_collect_import or config.option.smart_collect_record) and _get_worker_input(config) is None:
+        config.pluginmanager.register(HistoryRecorder(config), 'smartcollect-history')
+
+    if config.option.smart_collect and config.option.smart_collect_watch and not config.option.smart_collect_shadow and _get_worker_input(config) is None:
+        config.pluginmanager.register(SmartCollectWatch(), 'smartcollect-watch')
 
 
 @pytest.fixture
@@ -52,20 +308,37 @@ def smart_collect(request):
 
 @pytest.hookimpl(trylast=True) # I don't want to interfere with the functionality of other plugins that might implement this hook
 def pytest_collection_modifyitems(config, items):
-    smart_collect = config.option.smart_collect
-    ignore_source = config.option.ignore_source
+    shadow = config.option.smart_collect_shadow
+    smart_collect = config.option.smart_collect or shadow
+    ignore_source = config.option.ignore_source + config.getini('smart_collect_ignore')
     commit_range = config.option.commit_range
     diff_current_head_with_branch = config.option.diff_current_head_with_branch
     allow_preemptive_failures = config.option.allow_preemptive_failures
+    max_depth = config.option.smart_collect_max_depth
+    export_path = config.option.smart_collect_export
+    import_path = config.option.smart_collect_import
+    engine = config.option.smart_collect_engine
     log_level = config.option.log_level or 'WARNING'
 
+    # only the plugin's own logger is configured, so that the logging of everything else costs what it always does
     from logging import getLogger
-    logger = getLogger()
+    logger = getLogger('pytest_smartcollect')
     logger.setLevel(log_level)
 
     # TODO: review compatibility with other plugins; fail if a plugin is found to be both active and incompatible
 
-    if smart_collect:
+    if smart_collect or (import_path is not None and not shadow):
+        coverage_index = None
+        if smart_collect and engine == 'coverage':
+            coverage_index = load_coverage_index(config, str(Repo(str(config.rootdir), search_parent_directories=True).working_tree_dir))
+            if coverage_index is None:
+                logger.warning("No coverage index has been recorded yet (see --smart-collect-record) -- falling back to static analysis")
+
+        # a selection daemon (python -m pytest_smartcollect.daemon) is used whenever one is running for the repository
+        daemon = None
+        if smart_collect and coverage_index is None:
+            daemon = DaemonClient(get_socket_path(Repo(str(config.rootdir), search_parent_directories=True).working_tree_dir), logger)
+
         smart_collector = SmartCollector(
             str(config.rootdir),
             config.cache.get("cache/lastfailed", {}),
@@ -73,6 +346,53 @@ def pytest_collection_modifyitems(config, items):
             commit_range,
             diff_current_head_with_branch,
             allow_preemptive_failures,
-            logger
+            logger,
+            cache=config.cache,
+            max_depth=max_depth,
+            coverage_index=coverage_index,
+            daemon=daemon,
+            report=SelectionReport(config.option.smart_collect_report) if config.option.smart_collect_report is not None else None,
+            data_map=config.getini('smart_collect_data_map')
         )
-        smart_collector.run(items)
\ No newline at end of file
+
+        worker_input = _get_worker_input(config)
+        run_id = worker_input.get('smart_collect_run_id') if worker_input is not None else None
+
+        try:
+            if shadow:
+                # the selection is only computed -- the failures of a shadow run mustn't be hidden by the selection failing
+                try:
+                    log_records = smart_collector.run(items, shared_selection=_get_shared_selection(config, run_id) if run_id is not None else None, apply=False)
+
+                except Exception as e:
+                    logger.warning("Couldn't compute the smart collection selection for the shadow run -- %s", e)
+                    log_records = None
+
+                recorder = config.pluginmanager.getplugin('smartcollect-shadow')
+                if recorder is not None:
+                    recorder.log_records = log_records
+
+            elif import_path is not None:
+                log_records = smart_collector.run_imported(items, import_path)
+
+            elif run_id is not None:
+                log_records = smart_collector.run(items, shared_selection=_get_shared_selection(config, run_id), export_path=export_path)
+
+            else:
+                log_records = smart_collector.run(items, export_path=export_path)
+
+            if not shadow:
+                smart_collector.prioritise(items, log_records, RunHistory.load(config.cache), config.option.smart_collect_budget)
+
+        finally:
+            if smart_collector.report is not None:
+                smart_collector.report.close()
+                smart_collector.report = None  # the selections made in watch mode aren't reported
+
+            watch = config.pluginmanager.getplugin('smartcollect-watch')
+            if watch is not None and import_path is None and not shadow:
+                watch.smart_collector = smart_collector
+                watch.items = list(items)
+
+            else:
+                smart_collector.close()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import enum
+import typing
+from collections import namedtuple
+
+
+class Reason(str, enum.Enum):
+    # why a test was selected or skipped. the members are the strings they stand for, so they compare equal to them and
+    # serialize as them
+    NEW_TEST = "New test"
+    FAILED_ON_LAST_RUN = "Failed on last run"
+    SKIP_MARKER = "Found skip marker"
+    CHANGED_FIXTURE = "Uses changed fixture"
+    DEPENDENCY_CHANGED = "Dependency changed"
+    UNCHANGED = "Unchanged"
+    NOT_IN_COVERAGE_INDEX = "Not in coverage index"
+    COVERS_CHANGED_LINES = "Covers changed lines"
+    OVER_BUDGET = "Over budget"
+    DATA_FILE_CHANGED = "Uses changed data file"
+    DATA_MAP_CHANGED = "Mapped to changed data file"
+    DISTRIBUTION_CHANGED = "Imports changed distribution"
+
+    def __str__(self):
+        return self.value
+
+
+class DependencyChain(namedtuple('DependencyChain', ['chain'])):
+    # the reason a test whose dependency changed was selected: the chain of (path, name) from the test to the change. it is
+    # only turned into text when it is logged, reported or written out
+    reason = Reason.DEPENDENCY_CHANGED
+
+    def __str__(self):
+        return "%s: %s" % (self.reason.value, ' -> '.join("%s::%s" % node for node in self.chain))
+
+    @property
+    def hops(self) -> int:
+        return len(self.chain) - 1
+
+
+LogRecord = typing.Tuple[str, str, typing.Union[Reason, DependencyChain, str]]
+ListOfLogRecord = typing.List[LogRecord]
+
+_REASONS = dict((reason.value, reason) for reason in Reason)
+
+
+def parse_reason(text: str) -> typing.Union[Reason, DependencyChain, str]:
+    # the inverse of str() on a reason. text that isn't a known reason (e.g. from a newer version) is kept as it is
+    if text in _REASONS:
+        return _REASONS[text]
+
+    prefix = Reason.DEPENDENCY_CHANGED.value + ": "
+    if text.startswith(prefix):
+        return DependencyChain(tuple(tuple(node.rsplit('::', 1)) for node in text[len(prefix):].split(' -> ')))
+
+    return text
+
+
+def dump_records(log_records: ListOfLogRecord) -> typing.List[typing.List[str]]:
+    return [[action, nodeid, str(reason)] for action, nodeid, reason in log_records]
+
+
+def load_records(rows: typing.List[typing.List[str]]) -> ListOfLogRecord:
+    return [(action, nodeid, parse_reason(reason)) for action, nodeid, reason in rows]
@@ -0,0 +1,52 @@
+import os
+import csv
+import json
+import typing
+from pytest_smartcollect.records import LogRecord
+
+REPORT_FIELDS = ['action', 'nodeid', 'reason', 'analysis_seconds']
+
+
+class SelectionReport(object):
+    # the decision made for every test, written out as it is made -- JSON lines for paths ending in .jsonl or .json, CSV for
+    # anything else. the file is only created by the first write, so that of the processes of an xdist run, only the one that
+    # computes the selection writes it
+    def __init__(self, path: str):
+        self.path = path
+        self.format = 'jsonl' if os.path.splitext(path)[-1].lower() in ('.jsonl', '.json') else 'csv'
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        if self.format == 'jsonl':
+            self._file = open(self.path, 'w', encoding='utf-8')
+
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(REPORT_FIELDS)
+
+    def write(self, record: LogRecord, seconds: typing.Optional[float]=None):
+        # seconds is how long the analysis of the test took, if it was analysed in this process
+        if self._file is None:
+            self._open()
+
+        action, nodeid, reason = record
+        if self.format == 'jsonl':
+            self._file.write(json.dumps({
+                'action': action,
+                'nodeid': nodeid,
+                'reason': str(reason),
+                'analysis_seconds': round(seconds, 6) if seconds is not None else None
+            }) + '\n')
+
+        else:
+            self._writer.writerow([action, nodeid, str(reason), '%.6f' % seconds if seconds is not None else ''])
+
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
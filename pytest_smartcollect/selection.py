@@ -0,0 +1,147 @@
+import os
+import gzip
+import json
+import time
+import typing
+from pytest_smartcollect.records import ListOfLogRecord, dump_records, load_records
+
+try:
+    import fcntl
+    msvcrt = None
+
+except ImportError:  # windows
+    import msvcrt
+    fcntl = None
+
+ComputeSelection = typing.Callable[[], ListOfLogRecord]
+
+
+class FileLock(object):
+    # an exclusive lock on a file, which the OS releases automatically if the process holding it dies
+    def __init__(self, path: str):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self.path, 'a+')
+
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+
+        else:
+            self._f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+
+                except OSError:  # LK_LOCK gives up after ~10 seconds, but another process might still be analysing
+                    time.sleep(0.1)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+
+        finally:
+            self._f.close()
+            self._f = None
+
+
+class SharedSelection(object):
+    # a selection that is computed by whichever process gets to it first, and then reused by every other process of the same run
+    def __init__(self, directory: str, run_id: str):
+        self.directory = directory
+        self.run_id = run_id
+        self.path = os.path.join(directory, "selection-%s.json" % run_id)
+        self.lock_path = self.path + ".lock"
+
+    def get(self, compute: ComputeSelection) -> (ListOfLogRecord, bool):
+        with FileLock(self.lock_path):
+            log_records = self._read()
+            if log_records is not None:
+                return log_records, False
+
+            log_records = compute()
+            self._write(log_records)
+            return log_records, True
+
+    def read(self) -> typing.Union[ListOfLogRecord, None]:
+        # the selection, if a process of the run has computed it
+        with FileLock(self.lock_path):
+            return self._read()
+
+    def remove(self):
+        for path in (self.path, self.lock_path):
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+    def _read(self) -> typing.Union[ListOfLogRecord, None]:
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        if d.get('run_id') != self.run_id:
+            return None
+
+        return load_records(d['records'])
+
+    def _write(self, log_records: ListOfLogRecord):
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'run_id': self.run_id, 'records': dump_records(log_records)}, f)
+
+        os.replace(tmp_path, self.path)
+
+
+class SelectionArtifact(object):
+    # a selection computed once and exported, so that it can be applied elsewhere (e.g. on CI shards) without any analysis
+    VERSION = 1
+
+    def __init__(self, head: str, base: typing.Union[str, None], tree: str, log_records: ListOfLogRecord):
+        self.head = head
+        self.base = base
+        self.tree = tree
+        self.log_records = log_records
+
+    def write(self, path: str):
+        d = {
+            'version': self.VERSION,
+            'head': self.head,
+            'base': self.base,
+            'tree': self.tree,
+            'records': dump_records(self.log_records)
+        }
+        data = json.dumps(d, separators=(',', ':')).encode('utf-8')
+
+        if path.endswith('.gz'):
+            data = gzip.compress(data)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @classmethod
+    def read(cls, path: str) -> 'SelectionArtifact':
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if path.endswith('.gz'):
+            data = gzip.decompress(data)
+
+        d = json.loads(data.decode('utf-8'))
+        if d.get('version') != cls.VERSION:
+            raise Exception("Unsupported smart collection selection file '%s' (version %s)" % (path, d.get('version')))
+
+        return cls(d['head'], d['base'], d['tree'], load_records(d['records']))
@@ -0,0 +1,117 @@
+import typing
+from pytest_smartcollect.records import ListOfLogRecord
+
+
+class ShadowRun(object):
+    # how the selection of one shadow run compares to what actually happened when every test ran
+    def __init__(self, results: typing.Dict[str, typing.Tuple[float, bool]], log_records: ListOfLogRecord):
+        # results is node id -> (duration, failed) for every test that ran. tests that aren't in the selection (e.g. because they
+        # were only collected after it was computed) would have run
+        unselected = set(nodeid for action, nodeid, _ in log_records if action == 'SKIP')
+
+        self.tests = len(results)
+        self.selected = sum(1 for nodeid in results if nodeid not in unselected)
+        self.failed = sum(1 for _, failed in results.values() if failed)
+        self.caught = sum(1 for nodeid, (_, failed) in results.items() if failed and nodeid not in unselected)
+        self.missed = sorted(nodeid for nodeid, (_, failed) in results.items() if failed and nodeid in unselected)
+        self.duration = sum(duration for duration, _ in results.values())
+        self.saved = sum(duration for nodeid, (duration, _) in results.items() if nodeid in unselected)
+
+
+class ShadowStats(object):
+    # the totals of every shadow run so far, and the most recent misses, kept in the pytest cache
+    CACHE_KEY = 'smartcollect/shadow'
+
+    # misses are kept for this many runs, so that the same ones showing up again can be spotted
+    MAX_MISSES = 50
+
+    FIELDS = ('runs', 'tests', 'selected', 'failed', 'caught', 'duration', 'saved')
+
+    def __init__(self, d: typing.Optional[dict]=None):
+        d = d or {}
+        for field in self.FIELDS:
+            setattr(self, field, d.get(field, 0))
+
+        self.misses = d.get('misses', [])  # [run, node id]
+
+    @classmethod
+    def load(cls, cache) -> 'ShadowStats':
+        return cls(cache.get(cls.CACHE_KEY, {}))
+
+    def save(self, cache):
+        d = dict((field, getattr(self, field)) for field in self.FIELDS)
+        d['misses'] = self.misses
+        cache.set(self.CACHE_KEY, d)
+
+    def add(self, run: ShadowRun):
+        self.runs += 1
+        for field in self.FIELDS[1:]:
+            setattr(self, field, getattr(self, field) + getattr(run, field))
+
+        self.misses = [miss for miss in self.misses if self.runs - miss[0] < self.MAX_MISSES] + [[self.runs, nodeid] for nodeid in run.missed]
+
+    @staticmethod
+    def ratio(part: float, whole: float) -> typing.Union[float, None]:
+        return float(part) / whole if whole else None
+
+
+def format_percentage(ratio: typing.Union[float, None]) -> str:
+    return '%.1f%%' % (ratio * 100) if ratio is not None else 'n/a'
+
+
+class ShadowRecorder(object):
+    # a pytest plugin for shadow runs: every test runs, and the selection that would have been made is compared to the outcomes.
+    # with xdist it runs on the controller, which reads the selection that the workers shared
+    def __init__(self, config, read_selection: typing.Callable[[], typing.Union[ListOfLogRecord, None]]):
+        self.config = config
+        self.read_selection = read_selection
+        self.log_records = None  # set by the collection of this process, if it computed the selection
+        self.results = {}
+        self.ran = set()
+        self.run = None
+        self.stats = None
+
+    def pytest_runtest_logreport(self, report):
+        duration, failed = self.results.get(report.nodeid, (0.0, False))
+        self.results[report.nodeid] = (duration + report.duration, failed or report.failed)
+
+        if report.when == 'call' or report.failed:
+            self.ran.add(report.nodeid)
+
+    def pytest_sessionfinish(self, session):
+        if self.log_records is None:
+            self.log_records = self.read_selection()
+
+        if self.log_records is None or not self.ran:
+            return
+
+        self.run = ShadowRun(dict((nodeid, self.results[nodeid]) for nodeid in self.ran), self.log_records)
+        self.stats = ShadowStats.load(self.config.cache)
+        self.stats.add(self.run)
+        self.stats.save(self.config.cache)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep('-', 'smart collection shadow run')
+        if self.run is None:
+            terminalreporter.write_line("No selection was computed for this run, so it wasn't compared to the outcomes")
+            return
+
+        run = self.run
+        stats = self.stats
+        terminalreporter.write_line("Would have run %d of %d tests (%s), saving %.2f of %.2f seconds (%s)" % (
+            run.selected, run.tests, format_percentage(ShadowStats.ratio(run.selected, run.tests)),
+            run.saved, run.duration, format_percentage(ShadowStats.ratio(run.saved, run.duration))
+        ))
+        terminalreporter.write_line("Would have caught %d of %d failures" % (run.caught, run.failed))
+        for nodeid in run.missed:
+            terminalreporter.write_line("MISSED %s" % nodeid)
+
+        # recall is how many of the failures the selection would have caught, precision how many of the selected tests failed
+        terminalreporter.write_line("Over %d shadow runs: selected %s of the tests and saved %s of the time, with %s recall (%d failures missed) and %s precision" % (
+            stats.runs,
+            format_percentage(ShadowStats.ratio(stats.selected, stats.tests)),
+            format_percentage(ShadowStats.ratio(stats.saved, stats.duration)),
+            format_percentage(ShadowStats.ratio(stats.caught, stats.failed)),
+            stats.failed - stats.caught,
+            format_percentage(ShadowStats.ratio(stats.caught, stats.selected))
+        ))
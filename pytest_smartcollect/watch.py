@@ -0,0 +1,287 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import typing
+import ctypes
+import ctypes.util
+import logging
+from pytest_smartcollect.helpers import SmartCollector, ChangedFile, ListOfTestItem
+from pytest_smartcollect.ignore import IgnoreMatcher
+
+SetOfString = typing.Set[str]
+RerunTests = typing.Callable[[typing.List[str]], int]
+
+
+def iter_directories(root: str, ignore_matcher: typing.Optional[IgnoreMatcher]=None) -> typing.Iterator[str]:
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != '__pycache__']
+        if ignore_matcher is not None:
+            ignore_matcher.prune(dirpath, dirnames)
+
+        yield dirpath
+
+
+def iter_python_files(root: str, ignore_matcher: typing.Optional[IgnoreMatcher]=None) -> typing.Iterator[str]:
+    for dirpath in iter_directories(root, ignore_matcher):
+        try:
+            filenames = os.listdir(dirpath)
+
+        except OSError:
+            continue
+
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.py') and (ignore_matcher is None or not ignore_matcher.matches(path)):
+                yield path
+
+
+class PollingWatcher(object):
+    # compares the modification times of every python file under root, for wherever inotify isn't available
+    def __init__(self, root: str, interval: float=0.5, ignore_matcher: typing.Optional[IgnoreMatcher]=None):
+        self.root = root
+        self.interval = interval
+        self.ignore_matcher = ignore_matcher
+        self._mtimes = self._scan()
+
+    def _scan(self) -> typing.Dict[str, float]:
+        mtimes = {}
+        for path in iter_python_files(self.root, self.ignore_matcher):
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+
+            except OSError:
+                pass
+
+        return mtimes
+
+    def wait(self, timeout: typing.Optional[float]=None) -> SetOfString:
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            mtimes = self._scan()
+            changed = set(path for path in set(mtimes) | set(self._mtimes) if mtimes.get(path) != self._mtimes.get(path))
+            self._mtimes = mtimes
+
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    # linux only -- raises OSError wherever inotify can't be used, so that the caller can fall back to polling
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    # struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, root: str, debounce: float=0.1, ignore_matcher: typing.Optional[IgnoreMatcher]=None):
+        self.root = root
+        self.debounce = debounce
+        self.ignore_matcher = ignore_matcher
+        self._dirs = {}
+
+        libc_path = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_path is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+
+        self._libc = ctypes.CDLL(libc_path, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available in this C library")
+
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't initialise inotify")
+
+        try:
+            for directory in iter_directories(root, ignore_matcher):
+                self._add_watch(directory)
+
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, directory: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+        if wd < 0:  # typically ENOSPC, when the repository has more directories than fs.inotify.max_user_watches
+            raise OSError(ctypes.get_errno(), "Couldn't watch '%s'" % directory)
+
+        self._dirs[wd] = directory
+
+    def wait(self, timeout: typing.Optional[float]=None) -> SetOfString:
+        changed = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+
+        while ready:
+            data = os.read(self._fd, 65536)
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                offset += self.EVENT.size + length
+
+                if mask & self.IN_Q_OVERFLOW:  # events were lost, so anything might have changed
+                    changed.update(iter_python_files(self.root, self.ignore_matcher))
+                    continue
+
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name))
+                if self.ignore_matcher is not None and self.ignore_matcher.matches(path, is_dir=bool(mask & self.IN_ISDIR)):
+                    continue
+
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        for new_directory in iter_directories(path, self.ignore_matcher):
+                            try:
+                                self._add_watch(new_directory)
+
+                            except OSError:
+                                pass
+
+                        changed.update(iter_python_files(path, self.ignore_matcher))
+
+                elif path.endswith('.py'):
+                    changed.add(path)
+
+            # editors often save in several steps (e.g. write to a temporary file and then move it), so give them a moment to finish
+            ready, _, _ = select.select([self._fd], [], [], self.debounce)
+
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def make_watcher(root: str, ignore_matcher: typing.Optional[IgnoreMatcher]=None):
+    try:
+        return InotifyWatcher(root, ignore_matcher=ignore_matcher)
+
+    except OSError:
+        return PollingWatcher(root, ignore_matcher=ignore_matcher)
+
+
+class SelectionWatcher(object):
+    # keeps a SmartCollector (and everything it has analysed) alive, and reselects for every change saved to the working tree
+    def __init__(self, smart_collector: SmartCollector, items: ListOfTestItem, watcher, logger: logging.Logger):
+        self.smart_collector = smart_collector
+        self.items = items
+        self.watcher = watcher
+        self.logger = logger
+        self.root = smart_collector.find_git_repo_root(smart_collector.rootdir)
+
+        # the selection may have come from the daemon, in which case nothing was analysed in this process yet
+        smart_collector.keep_project_index = True
+        smart_collector.load_project(items)
+
+        self._test_files = set(str(item.fspath) for item in items)
+        self._contents = {}
+
+        for path in iter_python_files(self.root, smart_collector.get_ignore_matcher()):
+            self._contents[path] = self._read(path)
+
+    @staticmethod
+    def _read(path: str) -> typing.Union[str, None]:
+        try:
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8', 'replace')
+
+        except (IOError, OSError):
+            return None
+
+    def find_changed_files(self, paths: SetOfString) -> (typing.Dict[str, ChangedFile], typing.Dict[str, ChangedFile]):
+        # what changed in paths since they were last seen
+        changed_files = {}
+        deleted_files = {}
+
+        for path in sorted(paths):
+            old_contents = self._contents.get(path)
+            new_contents = self._read(path)
+            if new_contents == old_contents:
+                continue
+
+            if new_contents is None:
+                deleted_files[path] = ChangedFile('D', path)
+
+            elif old_contents is None:
+                changed_files[path] = ChangedFile('A', path, changed_lines=[range(1, new_contents.count('\n') + 2)])
+
+            else:
+                changed_lines, hunks = SmartCollector.find_changes_between(old_contents, new_contents)
+                old_fingerprints = SmartCollector.find_definition_fingerprints(old_contents)
+                fingerprints = SmartCollector.find_definition_fingerprints(new_contents)
+                changed_files[path] = ChangedFile(
+                    'M', path, changed_lines=changed_lines, hunks=hunks,
+                    unchanged_members=SmartCollector.find_unchanged_members(fingerprints, dict((k, {v}) for k, v in old_fingerprints.items())),
+                    removed_members=SmartCollector.find_removed_members(old_fingerprints, fingerprints)
+                )
+
+            self._contents[path] = new_contents
+
+        return changed_files, deleted_files
+
+    def find_new_tests(self, changed_files: typing.Dict[str, ChangedFile]) -> typing.List[str]:
+        # tests added to a test file after it was collected have no item, so they are passed on to pytest by node id
+        known = set(item.nodeid for item in self.items)
+        new_tests = []
+
+        for path, changed_file in changed_files.items():
+            relpath = os.path.relpath(path, self.smart_collector.rootdir).replace(os.sep, '/')
+
+            if path not in self._test_files:
+                if changed_file.change_type == 'A' and os.path.basename(path).startswith('test'):  # a new test file
+                    new_tests.append(relpath)
+
+                continue
+
+            for member in self.smart_collector.find_changed_members(changed_file, self.root):
+                if member.split('.')[-1].startswith('test'):
+                    nodeid = "%s::%s" % (relpath, member.replace('.', '::'))
+                    if nodeid not in known:
+                        new_tests.append(nodeid)
+
+        return new_tests
+
+    def update(self, paths: SetOfString) -> typing.List[str]:
+        # the node ids of the tests affected by the changes to paths
+        changed_files, deleted_files = self.find_changed_files(paths)
+        if not changed_files and not deleted_files:
+            return []
+
+        log_records = self.smart_collector.reselect(self.items, changed_files, deleted_files)
+        return [nodeid for action, nodeid, _ in log_records if action == 'RUN'] + self.find_new_tests(changed_files)
+
+    def watch(self, rerun: RerunTests):
+        self.logger.warning("Watching '%s' for changes...", self.root)
+
+        while True:
+            paths = self.watcher.wait()
+
+            try:
+                nodeids = self.update(paths)
+
+            except Exception as e:  # most likely a file that is only half edited
+                self.logger.warning("Couldn't update the smart collection selection -- %s", e)
+                continue
+
+            if nodeids:
+                rerun(nodeids)
+                self.logger.warning("Watching '%s' for changes...", self.root)
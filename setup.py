@@ -47,5 +47,8 @@ setup(
         'pytest11': [
             'smartcollect = pytest_smartcollect.plugin',
         ],
+        'console_scripts': [
+            'pytest-smartcollect = pytest_smartcollect.cli:main',
+        ],
     },
 )
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
+import csv
+import json
+import sys
+import time
 import typing
 import pytest
+import logging
+import subprocess
 from importlib import import_module
 from _pytest.pytester import Testdir
-from shutil import move
+from shutil import copyfile, move
 from git import Repo
 from pip._internal import main as pip
 import coverage
@@ -193,6 +199,38 @@ def test_DefinitionNodeExtractor(testdir):
     )
 
 
+def test_ModuleClassifier(testdir):
+    testdir.makepyfile("""
+        import os
+        import json
+        from pytest_smartcollect.helpers import ModuleClassifier
+        def test_ModuleClassifier_classify():
+            mc = ModuleClassifier({'foo'})
+            assert mc.classify('foo.bar') == ModuleClassifier.PROJECT
+            assert mc.classify('sys') == ModuleClassifier.BUILTIN
+            assert mc.classify('json.decoder') == ModuleClassifier.STDLIB
+            assert mc.classify('pytest') == ModuleClassifier.SITE_PACKAGES
+            assert not mc.is_project_module('os')
+            assert 'os' in mc.classes
+        def test_ModuleClassifier_search_path():
+            root = os.path.abspath('.')
+            vendor = os.path.join(root, 'vendor')
+            assert ModuleClassifier(set(), project_root=root).classify('vendored') == ModuleClassifier.SITE_PACKAGES
+            assert ModuleClassifier(set(), project_root=root, search_path=[vendor]).classify('vendored') == ModuleClassifier.PROJECT
+            assert ModuleClassifier(set(), project_root=root, search_path=[vendor]).classify('json') == ModuleClassifier.SITE_PACKAGES
+            assert ModuleClassifier(set(), project_root=root, search_path=[vendor]).environment == ModuleClassifier(set(), project_root=root, search_path=[vendor, root]).environment
+            assert ModuleClassifier(set(), project_root=root, search_path=[vendor]).environment != ModuleClassifier(set(), project_root=root, search_path=[vendor, os.path.dirname(json.__file__)]).environment
+    """)
+    testdir.mkdir('vendor').join('vendored.py').write('')
+
+    _check_result(
+        testdir,
+        [],
+        ['*2 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_find_git_repo_root(testdir):
     Repo.init(".")
     testdir.mkpydir("foo")
@@ -366,6 +404,81 @@ def test_find_changed_members(testdir):
     )
 
 
+def test_find_changed_statements(testdir):
+    testdir.makepyfile("""
+        import ast
+        import logging
+        from pytest_smartcollect.helpers import SmartCollector
+        SOURCE = [
+            "import asyncio",
+            "",
+            "TIMEOUT: int = 10",
+            "RETRIES = 1",
+            "RETRIES += 2",
+            "",
+            "@decorate",
+            "async def fetch():",
+            "    await asyncio.sleep(0)",
+            "",
+            "class Client(object):",
+            "    @property",
+            "    def name(self):",
+            "        return 'client'",
+            "",
+            "    async def close(self):",
+            "        pass",
+            "",
+            "try:",
+            "    import ujson as json",
+            "except ImportError:",
+            "    json = None",
+        ]
+        def test_find_changed_statements_spans():
+            smart_collector = SmartCollector(".", [], [], 1, 'master', False, logging.getLogger())
+            body = ast.parse("\\n".join(SOURCE)).body
+            changed = smart_collector.find_changed_statements(body, len(SOURCE), {3, 5, 7, 12, 16, 22})
+            assert changed == ['TIMEOUT', 'RETRIES', 'fetch', 'Client.name', 'Client.close', 'json']
+            assert smart_collector.find_changed_statements(body, len(SOURCE), {11}) == ['Client']
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_BlobReader(testdir):
+    r = Repo.init(".")
+
+    testdir.makepyfile(foo="""
+        foo = 42
+    """)
+
+    r.index.add(["foo.py"])
+    r.index.commit("initial commit")
+    blob = r.head.commit.tree["foo.py"].hexsha
+
+    testdir.makepyfile("""
+        from pytest_smartcollect.helpers import BlobReader
+        def test_BlobReader_read():
+            with BlobReader(r"%s", cache_size=1) as reader:
+                assert reader.read("%s") == "foo = 42"
+                assert reader.read("HEAD:foo.py") == "foo = 42"
+                assert list(reader._contents.keys()) == ["HEAD:foo.py"]
+                assert reader.read("HEAD:bar.py") is None
+                assert reader.read("%s") == "foo = 42"
+    """ % (os.path.abspath("."), blob, blob))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_find_fully_qualified_module_name(testdir):
     testdir.mkpydir("foo")
     testdir.makepyfile(bar="""
@@ -405,6 +518,162 @@ def test_find_fully_qualified_module_name(testdir):
     )
 
 
+def test_ProjectIndex(testdir):
+    testdir.mkpydir("foo")
+    testdir.mkpydir(os.path.join("foo", "baz"))
+    testdir.makepyfile(bar="""
+        def hello():
+            pass
+    """)
+
+    move("bar.py", os.path.join("foo", "baz", "bar.py"))
+
+    # a module name that two packages share is only found by the names that tell them apart
+    testdir.makepyfile(utils="")
+    copyfile("utils.py", os.path.join("foo", "baz", "utils.py"))
+    move("utils.py", os.path.join("foo", "utils.py"))
+
+    # folders that aren't packages, and the modules in them, can't be imported by their names
+    testdir.mkdir("yaml")
+    testdir.makepyfile(load="")
+    move("load.py", os.path.join("yaml", "load.py"))
+
+    testdir.makepyfile("""
+        import os
+        from pytest_smartcollect.helpers import ProjectIndex
+        def test_ProjectIndex_build():
+            index = ProjectIndex(r"%s")
+            index.build()
+            assert sorted(index.packages) == [r"%s", r"%s"]
+            assert index.module_name(r"%s") == "foo.baz.bar"
+            assert index.module_name(r"%s") == "foo.baz"
+            assert index.importable_names == {'foo', 'test_ProjectIndex'}
+            assert index.find_module_path("foo.baz.bar") == r"%s"
+            assert index.find_module_path("baz.bar") == r"%s"
+            assert index.find_module_path("foo") == os.path.join(r"%s", "__init__.py")
+            assert index.find_module_path("foo.bar") is None
+            assert index.find_module_path("foo.utils") == os.path.join(r"%s", "utils.py")
+            assert index.find_module_path("baz.utils") == os.path.join(r"%s", "baz", "utils.py")
+            assert index.find_module_path("utils") is None
+
+            restored = ProjectIndex.from_dict(index.to_dict('tree'))
+            assert restored.module_names == index.module_names
+    """ % (
+        os.path.abspath("."),
+        os.path.join(os.path.abspath("."), "foo"),
+        os.path.join(os.path.abspath("."), "foo", "baz"),
+        os.path.join(os.path.abspath("."), "foo", "baz", "bar.py"),
+        os.path.join(os.path.abspath("."), "foo", "baz"),
+        os.path.join(os.path.abspath("."), "foo", "baz", "bar.py"),
+        os.path.join(os.path.abspath("."), "foo", "baz", "bar.py"),
+        os.path.join(os.path.abspath("."), "foo"),
+        os.path.join(os.path.abspath("."), "foo"),
+        os.path.join(os.path.abspath("."), "foo")
+    ))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_IgnoreMatcher(testdir):
+    testdir.makepyfile("""
+        import os
+        from pytest_smartcollect.ignore import IgnoreMatcher
+        def test_IgnoreMatcher_matches():
+            root = os.path.abspath(os.sep + os.path.join("repo"))
+            matcher = IgnoreMatcher.from_rules(["vendor", os.path.join(root, "tools", "gen.py"), "docs/*.py", True], root)
+            matcher.add_pattern("*_pb2.py", root)
+            matcher.add_pattern("build/", root)
+            matcher.add_pattern("/scripts/**/old_*.py", root)
+
+            assert matcher.matches(os.path.join(root, "vendor", "six.py"))
+            assert matcher.matches(os.path.join(root, "tools", "gen.py"))
+            assert not matcher.matches(os.path.join(root, "tools", "gen.pyc"))
+            assert not matcher.matches(os.path.join(root, "tools", "other.py"))
+            assert matcher.matches(os.path.join(root, "docs", "conf.py"))
+            assert not matcher.matches(os.path.join(root, "docs", "api", "conf.py"))
+            assert matcher.matches(os.path.join(root, "foo", "bar", "api_pb2.py"))
+            assert matcher.matches(os.path.join(root, "foo", "build", "lib.py"))
+            assert matcher.matches(os.path.join(root, "foo", "build"), is_dir=True)
+            assert not matcher.matches(os.path.join(root, "foo", "build"))
+            assert matcher.matches(os.path.join(root, "scripts", "old_run.py"))
+            assert matcher.matches(os.path.join(root, "scripts", "a", "b", "old_run.py"))
+            assert not matcher.matches(os.path.join(root, "foo", "scripts", "old_run.py"))
+            assert not matcher.matches(os.path.join(os.sep + "elsewhere", "api_pb2.py"))
+
+            dirnames = ["vendor", "build", "src", ".git"]
+            matcher.prune(root, dirnames)
+            assert dirnames == ["src", ".git"]
+
+            assert not IgnoreMatcher.from_rules([], root)
+            assert IgnoreMatcher.from_rules(["vendor"], root).key != matcher.key
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_SharedSelection(testdir):
+    testdir.makepyfile("""
+        from pytest_smartcollect.selection import SharedSelection
+        def test_SharedSelection_get(tmpdir):
+            calls = []
+            def compute():
+                calls.append(1)
+                return [('RUN', 'test_foo.py::test_foo', 'New test')]
+
+            first = SharedSelection(str(tmpdir), 'abc')
+            second = SharedSelection(str(tmpdir), 'abc')
+            assert first.get(compute) == ([('RUN', 'test_foo.py::test_foo', 'New test')], True)
+            assert second.get(compute) == ([('RUN', 'test_foo.py::test_foo', 'New test')], False)
+            assert len(calls) == 1
+
+            first.remove()
+            assert tmpdir.listdir() == []
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_decision_records(testdir):
+    testdir.makepyfile("""
+        import json
+        from pytest_smartcollect.records import Reason, DependencyChain, dump_records, load_records
+        def test_decision_records_round_trip():
+            chain = DependencyChain((('/repo/test_foo.py', 'test_foo'), ('/repo/foo.py', 'Foo.bar')))
+            log_records = [('RUN', 'test_foo.py::test_foo', chain), ('SKIP', 'test_bar.py::test_bar', Reason.UNCHANGED)]
+
+            assert str(chain) == "Dependency changed: /repo/test_foo.py::test_foo -> /repo/foo.py::Foo.bar"
+            assert chain.hops == 1
+            assert Reason.UNCHANGED == "Unchanged"
+
+            rows = json.loads(json.dumps(dump_records(log_records)))
+            assert rows[1] == ['SKIP', 'test_bar.py::test_bar', 'Unchanged']
+            assert load_records(rows) == log_records
+            assert load_records([['RUN', 'test_baz.py::test_baz', 'Something else']]) == [('RUN', 'test_baz.py::test_baz', 'Something else')]
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_filter_ignore_sources(testdir):
     Repo.init(".")
 
@@ -434,6 +703,67 @@ def test_filter_ignore_sources(testdir):
     )
 
 
+def test_filter_ignore_file(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_foo="""
+        def test_foo():
+            from generated.foo_pb2 import foo
+            from foo import bar
+    """)
+    testdir.mkpydir("generated")
+    testdir.makepyfile(foo_pb2="""
+        def foo():
+            pass
+    """)
+    move("foo_pb2.py", os.path.join("generated", "foo_pb2.py"))
+    testdir.makepyfile(foo="""
+        def bar():
+            pass
+    """)
+    with open(".smartcollectignore", "w") as f:
+        f.write("# generated code\n*_pb2.py\n")
+
+    r = Repo(".")
+    r.index.add(["test_foo.py", "foo.py", os.path.join("generated", "__init__.py"), os.path.join("generated", "foo_pb2.py"), ".smartcollectignore"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(foo_pb2="""
+        def foo():
+            return 1
+    """)
+    move("foo_pb2.py", os.path.join("generated", "foo_pb2.py"))
+    r.index.add([os.path.join("generated", "foo_pb2.py")])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    testdir.makepyfile(foo="""
+        def bar():
+            return 1
+    """)
+    r.index.add(["foo.py"])
+    r.index.commit("third commit")
+
+    testdir.makeini("""
+        [pytest]
+        smart_collect_ignore =
+            foo.py
+    """)
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
 def test_run_smart_collection(testdir):
     Repo.init(".")
 
@@ -605,6 +935,1477 @@ def test_recursive_base_dependencies(testdir):
     )
 
 
+def test_export_import_selection(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_foo="""
+        def test_foo():
+            assert 1 == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["test_foo.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(test_bar="""
+        def test_bar():
+            assert 1 == 1
+    """)
+
+    r.index.add(["test_bar.py"])
+    r.index.commit("second commit")
+
+    export_path = os.path.join(os.path.abspath("."), "selection.json.gz")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-export", export_path],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    assert os.path.exists(export_path)
+
+    # the imported selection is applied without --smart-collect
+    _check_result(
+        testdir,
+        ["--smart-collect-import", export_path],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # the selection is no longer valid once HEAD moves
+    r.index.commit("third commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect-import", export_path],
+        [],
+        lambda x: x != 0,
+        cover_sources=False
+    )
+
+
+def test_selection_report(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_foo="""
+        def test_foo():
+            assert 1 == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["test_foo.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(test_bar="""
+        def test_bar():
+            assert 1 == 1
+    """)
+
+    r.index.add(["test_bar.py"])
+    r.index.commit("second commit")
+
+    jsonl_path = os.path.join(os.path.abspath("."), "report.jsonl")
+    csv_path = os.path.join(os.path.abspath("."), "report.csv")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", jsonl_path],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open(jsonl_path) as f:
+        records = sorted((json.loads(line) for line in f), key=lambda x: x['nodeid'])
+
+    assert [(x['action'], x['nodeid'], x['reason']) for x in records] == [('RUN', 'test_bar.py::test_bar', 'New test'), ('SKIP', 'test_foo.py::test_foo', 'Unchanged')]
+    assert all(x['analysis_seconds'] >= 0 for x in records)
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", csv_path],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open(csv_path) as f:
+        rows = list(csv.reader(f))
+
+    assert rows[0] == ['action', 'nodeid', 'reason', 'analysis_seconds']
+    assert sorted(row[:3] for row in rows[1:]) == [['RUN', 'test_bar.py::test_bar', 'New test'], ['SKIP', 'test_foo.py::test_foo', 'Unchanged']]
+
+    # nothing is written without the option
+    assert not os.path.exists("results.csv")
+
+
+def test_CoverageIndex(testdir):
+    testdir.makepyfile("""
+        import os
+        import sys
+        import pytest
+        from pytest_smartcollect.coverage_index import BaseCoverageIndex, CoverageIndex, LineTracer, MappedCoverageIndex
+        def test_CoverageIndex_write_read(tmpdir):
+            root = str(tmpdir)
+            index = CoverageIndex(root, 'a' * 40)
+            index.add('test_foo.py::test_foo', {os.path.join(root, 'foo.py'): {1, 2, 3, 10}})
+            index.add('test_bar.py::test_bar', {os.path.join(root, 'foo.py'): {3, 4}, os.path.join(root, 'bar.py'): {1}})
+
+            path = os.path.join(root, 'index.bin')
+            index.write(path)
+            mapped = CoverageIndex.read(root, path)
+
+            assert isinstance(mapped, MappedCoverageIndex)
+            assert mapped.commit == 'a' * 40
+            assert mapped.tests == ['test_foo.py::test_foo', 'test_bar.py::test_bar']
+            assert 'test_bar.py::test_bar' in mapped
+            assert mapped.tests_touching('foo.py', 4, 9) == {'test_bar.py::test_bar'}
+            assert mapped.tests_touching('foo.py', 3, 3) == {'test_foo.py::test_foo', 'test_bar.py::test_bar'}
+            assert mapped.tests_touching('foo.py', 5, 9) == set()
+            assert mapped.tests_for_file('bar.py') == {'test_bar.py::test_bar'}
+            assert mapped.tests_for_file('baz.py') == set()
+            mapped.close()
+
+            with pytest.raises(TypeError):
+                BaseCoverageIndex(root)
+
+        def test_LineTracer_other_tracer(tmpdir):
+            def other_trace(frame, event, arg):
+                return None
+
+            tracer = LineTracer(str(tmpdir))
+            sys.settrace(other_trace)
+            try:
+                assert not tracer.start()
+                assert sys.gettrace() is other_trace
+
+            finally:
+                sys.settrace(None)
+
+            assert tracer.start()
+            assert tracer.stop() == {}
+            assert sys.gettrace() is None
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*2 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_coverage_engine(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+
+
+        def b():
+            return 2
+    """)
+
+    testdir.makepyfile(test_a="""
+        from mod import a
+        def test_a():
+            assert a() == 1
+    """)
+
+    testdir.makepyfile(test_b="""
+        from mod import b
+        def test_b():
+            assert b() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_a.py", "test_b.py"])
+    r.index.commit("initial commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect-record"],
+        ["*2 passed in * seconds*"],
+        lambda x: x == 0,
+        cover_sources=False  # the tracer of pytest-cov would stop the index from being recorded
+    )
+
+    assert os.path.exists(os.path.join(".pytest_cache", "d", "smartcollect", "coverage-index.bin"))
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 1\n\n\ndef b():\n    return 3\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    # only test_b executed the changed line
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-engine", "coverage"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_renamed_module(testdir):
+    Repo.init(".")
+
+    contents = "".join("def f%d():\n    return %d\n\n\n" % (i, i) for i in range(20))
+    with open("big.py", "w") as f:
+        f.write(contents)
+
+    testdir.makepyfile(test_f1="""
+        from big import f1
+        def test_f1():
+            assert f1() == 1
+    """)
+
+    testdir.makepyfile(test_f3="""
+        from big import f3
+        def test_f3():
+            assert f3() == 3
+    """)
+
+    r = Repo(".")
+    r.index.add(["big.py", "test_f1.py", "test_f3.py"])
+    r.index.commit("initial commit")
+
+    # rename the module, change a single function in it and update the imports
+    os.remove("big.py")
+    with open("big2.py", "w") as f:
+        f.write(contents.replace("return 3\n", "return 33\n"))
+
+    for name in ("test_f1.py", "test_f3.py"):
+        with open(name) as f:
+            test_contents = f.read()
+
+        with open(name, "w") as f:
+            f.write(test_contents.replace("from big import", "from big2 import"))
+
+    r.index.remove(["big.py"])
+    r.index.add(["big2.py", "test_f1.py", "test_f3.py"])
+    r.index.commit("second commit")
+
+    # only the test of the changed function runs
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_changed_file_type(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(bar="""
+        def a():
+            return 1
+    """)
+    os.symlink("bar.py", "foo.py")
+
+    testdir.makepyfile(test_foo="""
+        from foo import a
+        def test_foo():
+            assert a() == 2
+    """)
+
+    testdir.makepyfile(test_bar="""
+        from bar import a
+        def test_bar():
+            assert a() == 1
+    """)
+
+    r = Repo(".")
+    r.git.add(["bar.py", "foo.py", "test_foo.py", "test_bar.py"])
+    r.index.commit("initial commit")
+
+    # the symlink becomes a module of its own
+    os.remove("foo.py")
+    testdir.makepyfile(foo="""
+        def a():
+            return 2
+    """)
+
+    r.git.add(["foo.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_redefined_members(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        if False:
+            def dumps(x):
+                return 'unused'
+
+        try:
+            from missing_module import dumps
+        except ImportError:
+            def dumps(x):
+                return 'old'
+    """)
+
+    testdir.makepyfile(test_mod="""
+        from mod import dumps
+        def test_dumps():
+            assert dumps(1) == 'new'
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_mod.py"])
+    r.index.commit("initial commit")
+
+    # only the fallback changes -- the other definition of the same name doesn't hide it
+    with open("mod.py") as f:
+        contents = f.read()
+
+    with open("mod.py", "w") as f:
+        f.write(contents.replace("'old'", "'new'"))
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_cosmetic_changes(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+
+
+        def b():
+            return 2
+    """)
+
+    testdir.makepyfile(test_a="""
+        from mod import a
+        def test_a():
+            assert a() == 1
+    """)
+
+    testdir.makepyfile(test_b="""
+        from mod import b
+        def test_b():
+            assert b() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_a.py", "test_b.py"])
+    r.index.commit("initial commit")
+
+    # a docstring, a comment and different formatting for a(), and a real change to b()
+    with open("mod.py", "w") as f:
+        f.write("def a( ):\n    \"Returns one.\"\n    # one\n    return (1)\n\n\ndef b():\n    return 3\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_removed_lines(testdir):
+    Repo.init(".")
+
+    with open("mod.py", "w") as f:
+        f.write("def dec(f):\n    f.decorated = True\n    return f\n\ndef a():\n    return 1\n\n\n@dec\ndef b():\n    return 2\n")
+
+    testdir.makepyfile(test_mod="""
+        from mod import a, b
+
+        def test_a():
+            assert a() == 1
+
+        def test_b():
+            assert b.decorated
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_mod.py"])
+    r.index.commit("initial commit")
+
+    # the decorator is the first line of b(), and only blank lines come before it
+    with open("mod.py", "w") as f:
+        f.write("def dec(f):\n    f.decorated = True\n    return f\n\ndef a():\n    return 1\n\n\ndef b():\n    return 2\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_removed_members(testdir):
+    Repo.init(".")
+
+    with open("service.py", "w") as f:
+        f.write("class Service(object):\n    def ping(self):\n        return 1\n\n    def legacy(self):\n        return 2\n")
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 1\n\n\ndef gone():\n    return 2\n\n\ndef c():\n    return 3\n")
+
+    testdir.makepyfile(test_service="""
+        from service import Service
+
+        def test_ping():
+            assert Service().ping() == 1
+
+        def test_legacy():
+            assert Service().legacy() == 2
+    """)
+
+    testdir.makepyfile(test_a="""
+        from mod import a
+
+        def test_a():
+            assert a() == 1
+    """)
+
+    testdir.makepyfile(test_gone="""
+        import mod
+
+        def test_gone():
+            assert mod.gone() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["service.py", "mod.py", "test_service.py", "test_a.py", "test_gone.py"])
+    r.index.commit("initial commit")
+
+    # legacy() and gone() are removed without touching a line that is left, and ping() only gets a comment
+    with open("service.py", "w") as f:
+        f.write("class Service(object):\n    def ping(self):\n        # pong\n        return 1\n")
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 1\n\n\ndef c():\n    return 3\n")
+
+    r.index.add(["service.py", "mod.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*2 failed, 1 passed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_moved_members(testdir):
+    Repo.init(".")
+
+    with open("mod.py", "w") as f:
+        f.write("def h():\n    return 1\n\n\ndef keep():\n    return 2\n")
+
+    with open("other.py", "w") as f:
+        f.write("def o():\n    return 0\n")
+
+    with open("api.py", "w") as f:
+        f.write("from mod import h\n\n\ndef call():\n    return h()\n")
+
+    testdir.makepyfile(test_api="""
+        from api import call
+
+        def test_call():
+            assert call() == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "other.py", "api.py", "test_api.py"])
+    r.index.commit("initial commit")
+
+    # h() moves from one existing module to another without being changed
+    with open("mod.py", "w") as f:
+        f.write("def keep():\n    return 2\n")
+
+    with open("other.py", "w") as f:
+        f.write("def o():\n    return 0\n\n\ndef h():\n    return 1\n")
+
+    with open("api.py", "w") as f:
+        f.write("from other import h\n\n\ndef call():\n    return h()\n")
+
+    r.index.add(["mod.py", "other.py", "api.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_constant_changes(testdir):
+    Repo.init(".")
+
+    with open("settings.py", "w") as f:
+        f.write("TIMEOUT = 10\nRETRIES = 1\nNAME = 'settings'\n\n\ndef get_timeout():\n    return TIMEOUT\n")
+
+    testdir.makepyfile(test_settings="""
+        from settings import TIMEOUT, RETRIES, NAME, get_timeout
+
+        def test_timeout():
+            assert get_timeout() == 10
+
+        def test_retries():
+            assert RETRIES == 1
+
+        def test_bare_timeout():
+            timeout = TIMEOUT
+            assert timeout == 10
+
+        def test_name():
+            assert NAME == 'settings'
+    """)
+
+    r = Repo(".")
+    r.index.add(["settings.py", "test_settings.py"])
+    r.index.commit("initial commit")
+
+    # the constants are read, but never passed to a call
+    with open("settings.py", "w") as f:
+        f.write("TIMEOUT = 20\nRETRIES = 5\nNAME = 'settings'\n\n\ndef get_timeout():\n    return TIMEOUT\n")
+
+    r.index.add(["settings.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*3 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_method_changes(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(service="""
+        class Service(object):
+            def __init__(self):
+                self.value = 1
+
+            def a(self):
+                return self.value
+
+            def b(self):
+                return 2
+    """)
+
+    testdir.makepyfile(test_service="""
+        from service import Service
+
+        def describe(service):
+            return service.b()
+
+        def test_a():
+            assert Service().a() == 1
+
+        def test_b():
+            service = Service()
+            assert service.b() == 2
+
+        def test_escaped():
+            assert describe(Service()) == 2
+
+        class TestService(object):
+            def get(self):
+                return Service.b(Service())
+
+            def test_b(self):
+                assert self.get() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["service.py", "test_service.py"])
+    r.index.commit("initial commit")
+
+    with open("service.py", "w") as f:
+        f.write("class Service(object):\n    def __init__(self):\n        self.value = 1\n\n    def a(self):\n        return self.value + 1\n\n    def b(self):\n        return 2\n")
+
+    r.index.add(["service.py"])
+    r.index.commit("second commit")
+
+    # only Service.a changed, so only the tests that use it, or that hand a Service to something else, are run
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "-rs"],
+        ["*1 failed, 1 passed, 2 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_star_and_module_imports(testdir):
+    Repo.init(".")
+
+    testdir.mkpydir("pkg")
+    with open(os.path.join("pkg", "__init__.py"), "w") as f:
+        f.write("from .core import *\n")
+
+    with open(os.path.join("pkg", "core.py"), "w") as f:
+        f.write("__all__ = ['a']\n\n\ndef a():\n    return 1\n\n\ndef b():\n    return 2\n")
+
+    with open(os.path.join("pkg", "util.py"), "w") as f:
+        f.write("def helper():\n    return 1\n\n\ndef other():\n    return 2\n")
+
+    testdir.makepyfile(test_pkg="""
+        from pkg import *
+        from pkg import util
+        import pkg.util as u
+
+        def test_a():
+            assert a() == 1
+
+        def test_helper():
+            assert util.helper() == 1
+
+        def test_other():
+            assert u.other() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add([os.path.join("pkg", "__init__.py"), os.path.join("pkg", "core.py"), os.path.join("pkg", "util.py"), "test_pkg.py"])
+    r.index.commit("initial commit")
+
+    with open(os.path.join("pkg", "core.py"), "w") as f:
+        f.write("__all__ = ['a']\n\n\ndef a():\n    return 1\n\n\ndef b():\n    return 3\n")
+
+    with open(os.path.join("pkg", "util.py"), "w") as f:
+        f.write("def helper():\n    return 1\n\n\ndef other():\n    return 3\n")
+
+    r.index.add([os.path.join("pkg", "core.py"), os.path.join("pkg", "util.py")])
+    r.index.commit("second commit")
+
+    # b isn't in the __all__ of pkg.core, and only the other function of pkg.util is used through the module it is in
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 failed, 2 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_watch(testdir):
+    testdir.makepyfile("""
+        import os
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+        from pytest_smartcollect.watch import InotifyWatcher, PollingWatcher
+        def test_find_changes_between():
+            changed_lines, hunks = SmartCollector.find_changes_between("a\\nb\\nc\\nd\\n", "a\\nB\\nc\\n")
+            assert changed_lines == [range(2, 4)]
+            assert hunks == [(2, 1, 2, 1), (4, 1, 3, 0)]
+            # a removed line may be surrounded by a blank line on one side and its statement on the other
+            assert SmartCollector.find_changes_between("\\n@dec\\ndef b():\\n", "\\ndef b():\\n")[0] == [range(1, 3)]
+            assert SmartCollector.find_removed_members({'S': '1', 'S.a': '2', 'S.b': '3'}, {'S': '1', 'S.a': '2'}) == {'S', 'S.b'}
+        @pytest.mark.parametrize('watcher_class', [InotifyWatcher, PollingWatcher])
+        def test_watcher(tmpdir, watcher_class):
+            tmpdir.mkdir('pkg').join('mod.py').write('x = 1')
+            try:
+                watcher = watcher_class(str(tmpdir))
+            except OSError:
+                pytest.skip('inotify is not available')
+            try:
+                tmpdir.join('pkg', 'mod.py').write('x = 2')
+                tmpdir.join('pkg', 'notes.txt').write('not python')
+                assert watcher.wait(timeout=5) == {str(tmpdir.join('pkg', 'mod.py'))}
+            finally:
+                watcher.close()
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*3 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_watch_rerun_args(testdir):
+    testdir.makeini("""
+        [pytest]
+        addopts = -rs
+    """)
+
+    testdir.makepyfile(test_rerun="""
+        import os
+        from pytest_smartcollect.plugin import _get_invocation
+        def test_rerun_args(pytestconfig):
+            invocation_dir, args = _get_invocation(pytestconfig)
+            assert invocation_dir == os.getcwd()
+            assert [arg for arg in args if not arg.startswith('--basetemp')] == ['-k', 'rerun', '--commit-range', '2']
+    """)
+
+    # the tests to rerun replace the paths, and watching doesn't start again
+    _check_result(
+        testdir,
+        ["-k", "rerun", "test_rerun.py", "--smart-collect-watch", "--commit-range", "2"],
+        ["*1 passed in * seconds*"],
+        lambda x: x == 0,
+        cover_sources=False
+    )
+
+
+def test_selection_daemon(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+
+        def b():
+            return 2
+    """)
+
+    testdir.makepyfile(test_mod="""
+        from mod import a, b
+
+        def test_a():
+            assert a() == 1
+
+        def test_b():
+            assert b() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_mod.py"])
+    r.index.commit("initial commit")
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 3\n\ndef b():\n    return 2\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    from pytest_smartcollect.daemon import DaemonClient, get_socket_path
+    socket_path = get_socket_path(str(testdir.tmpdir))
+    client = DaemonClient(socket_path, logging.getLogger())
+    daemon = subprocess.Popen([sys.executable, '-m', 'pytest_smartcollect.daemon', '--rootdir', str(testdir.tmpdir)])
+
+    try:
+        for _ in range(100):
+            if client.request({'command': 'ping'}) is not None:
+                break
+
+            time.sleep(0.1)
+
+        for requests in (1, 2):
+            _check_result(
+                testdir,
+                ["--smart-collect", "--commit-range", "1"],
+                ["*1 failed, 1 skipped in * seconds*"],
+                lambda x: x != 0
+            )
+            assert client.request({'command': 'ping'})['requests'] == requests
+
+    finally:
+        client.request({'command': 'shutdown'})
+        daemon.wait(10)
+
+    assert not os.path.exists(socket_path)
+
+    # without a daemon, the selection is computed in process
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_long_running_collector(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(test_collector="""
+        import os
+        import logging
+        from pytest_smartcollect.daemon import ItemDescriptor
+        from pytest_smartcollect.helpers import SmartCollector
+        from pytest_smartcollect.watch import SelectionWatcher
+        def test_keep_project_index():
+            root = os.path.abspath('.')
+            items = [ItemDescriptor('test_collector.py::test_keep_project_index', os.path.join(root, 'test_collector.py'), 'test_keep_project_index', False)]
+            smart_collector = SmartCollector(root, [], [], 0, 'master', False, logging.getLogger())
+
+            # e.g. when the selection came from the daemon, and nothing was analysed in process
+            SelectionWatcher(smart_collector, items, None, logging.getLogger())
+            assert smart_collector.module_classifier is not None
+            project_index = smart_collector.project_index
+
+            # the worktree is dirty, so the index is only kept because the collector forgets every change
+            smart_collector.load_project(items)
+            assert smart_collector.project_index is project_index
+
+            with open('other.py', 'w') as f:
+                f.write('b = 2')
+            smart_collector.forget([os.path.join(root, 'other.py')])
+            assert smart_collector.project_index.module_name(os.path.join(root, 'other.py')) == 'other'
+
+            os.remove('other.py')
+            smart_collector.forget([os.path.join(root, 'other.py')])
+            assert os.path.join(root, 'other.py') not in smart_collector.project_index.module_names
+
+            os.mkdir('pkg')
+            for name in ('__init__.py', 'sub.py'):
+                with open(os.path.join('pkg', name), 'w') as f:
+                    f.write('')
+            smart_collector.forget([os.path.join(root, 'pkg', '__init__.py'), os.path.join(root, 'pkg', 'sub.py')])
+            smart_collector.load_project(items)
+            assert smart_collector.project_index is not project_index
+            assert smart_collector.project_index.find_module_path('pkg.sub') == os.path.join(root, 'pkg', 'sub.py')
+    """)
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_data_map(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_foo="""
+        import os
+
+        def test_users():
+            with open(os.path.join(os.path.dirname(__file__), 'data/users.json')) as f:
+                assert f.read()
+
+        def test_page():
+            assert 1 == 1
+
+        def test_other():
+            assert 1 == 1
+    """)
+    testdir.makeini("""
+        [pytest]
+        smart_collect_data_map =
+            templates/*.html = test_foo.py::test_page
+    """)
+    os.mkdir("data")
+    os.mkdir("templates")
+    for path in (os.path.join("data", "users.json"), os.path.join("templates", "page.html")):
+        with open(path, "w") as f:
+            f.write("[]\n")
+
+    r = Repo(".")
+    r.index.add(["test_foo.py", os.path.join("data", "users.json"), os.path.join("templates", "page.html")])
+    r.index.commit("initial commit")
+
+    with open(os.path.join("data", "users.json"), "w") as f:
+        f.write("[{}]\n")
+
+    r.index.add([os.path.join("data", "users.json")])
+    r.index.commit("second commit")
+
+    report_path = os.path.join(os.path.abspath("."), "report.jsonl")
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", report_path],
+        ["*1 passed, 2 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open(report_path) as f:
+        records = [json.loads(line) for line in f]
+
+    assert [(x['action'], x['nodeid'], x['reason']) for x in records if x['action'] == 'RUN'] == [('RUN', 'test_foo.py::test_users', 'Uses changed data file')]
+
+    with open(os.path.join("templates", "page.html"), "w") as f:
+        f.write("<html></html>\n")
+
+    r.index.add([os.path.join("templates", "page.html")])
+    r.index.commit("third commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "2", "--smart-collect-report", report_path],
+        ["*2 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open(report_path) as f:
+        records = [json.loads(line) for line in f]
+
+    assert sorted((x['nodeid'], x['reason']) for x in records if x['action'] == 'RUN') == [
+        ('test_foo.py::test_page', 'Mapped to changed data file'), ('test_foo.py::test_users', 'Uses changed data file')
+    ]
+
+
+def test_dependency_changes(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(helper="""
+        import chardet
+
+        def detect(data):
+            return chardet.detect(data)
+    """)
+    testdir.makepyfile(test_a="""
+        from helper import detect
+
+        def test_a():
+            assert detect(b'abc')
+    """)
+    testdir.makepyfile(test_b="""
+        import git
+
+        def test_b():
+            assert git.Repo
+    """)
+    testdir.makepyfile(test_c="""
+        def test_c():
+            assert 1 == 1
+    """)
+    with open("requirements.txt", "w") as f:
+        f.write("chardet==3.0.4\nGitPython==2.1.11\n")
+
+    r = Repo(".")
+    r.index.add(["helper.py", "test_a.py", "test_b.py", "test_c.py", "requirements.txt"])
+    r.index.commit("initial commit")
+
+    with open("requirements.txt", "w") as f:
+        f.write("chardet==3.0.5  # a comment\nGitPython==2.1.11\n")
+
+    r.index.add(["requirements.txt"])
+    r.index.commit("second commit")
+
+    report_path = os.path.join(os.path.abspath("."), "report.jsonl")
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", report_path],
+        ["*1 passed, 2 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open(report_path) as f:
+        records = [json.loads(line) for line in f]
+
+    assert [(x['nodeid'], x['reason']) for x in records if x['action'] == 'RUN'] == [('test_a.py::test_a', 'Imports changed distribution')]
+
+    with open("requirements.txt", "w") as f:
+        f.write("--index-url https://example.com/simple\nchardet==3.0.5\nGitPython==2.1.11\n")
+
+    r.index.add(["requirements.txt"])
+    r.index.commit("third commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*2 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # the hashes of a requirement belong to it, and only the requirement whose hash changed is
+    hashed = "--index-url https://example.com/simple\nchardet==3.0.5 \\\n    --hash=sha256:aaaa\nGitPython==2.1.11 \\\n    --hash=sha256:%s \\\n    --hash=sha256:cccc\n"
+    for commit, digest in (("fourth commit", "bbbb"), ("fifth commit", "dddd")):
+        with open("requirements.txt", "w") as f:
+            f.write(hashed % digest)
+
+        r.index.add(["requirements.txt"])
+        r.index.commit(commit)
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 passed, 2 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_dependency_imports(testdir):
+    Repo.init(".")
+
+    testdir.mkpydir("myapp")
+    testdir.mkpydir(os.path.join("myapp", "sub"))
+    with open(os.path.join("myapp", "sub", "a.py"), "w") as f:
+        f.write("from .mod import detect\n")
+
+    with open(os.path.join("myapp", "sub", "mod.py"), "w") as f:
+        f.write("import chardet\n\n\ndef detect(data):\n    return chardet.detect(data)\n")
+
+    testdir.makepyfile(test_app="""
+        from myapp.sub.a import detect
+
+        def test_detect():
+            assert detect(b'abc')
+    """)
+    testdir.makepyfile(test_other="""
+        def test_other():
+            assert 1 == 1
+    """)
+    with open("requirements.txt", "w") as f:
+        f.write("chardet==3.0.4\n")
+
+    lock = '[[package]]\nname = "chardet"\nversion = "3.0.4"\n\n[[package]]\nname = "urllib3"\nversion = "%s"\n'
+    with open("poetry.lock", "w") as f:
+        f.write(lock % "1.24.0")
+
+    r = Repo(".")
+    r.index.add([
+        os.path.join("myapp", "__init__.py"), os.path.join("myapp", "sub", "__init__.py"), os.path.join("myapp", "sub", "a.py"),
+        os.path.join("myapp", "sub", "mod.py"), "test_app.py", "test_other.py", "requirements.txt", "poetry.lock"
+    ])
+    r.index.commit("initial commit")
+
+    # chardet is only reached through a package relative import in a nested package
+    with open("requirements.txt", "w") as f:
+        f.write("chardet==3.0.5\n")
+
+    r.index.add(["requirements.txt"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # no test imports urllib3, so it is most likely pinned for a distribution that they do import
+    with open("poetry.lock", "w") as f:
+        f.write(lock % "1.24.1")
+
+    r.index.add(["poetry.lock"])
+    r.index.commit("third commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # a # in a string isn't a comment, e.g. the fragment of a url
+    from pytest_smartcollect.dependencies import parse_toml_requirements
+    requirements = parse_toml_requirements('[project]\ndependencies = [\n    "pkg @ https://example.com/pkg.zip#sha256=%s",  # pinned\n]\n')
+    assert requirements == {'*': 'pkg @ https://example.com/pkg.zip#sha256=%s\n'}
+
+
+def test_shadow(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_a="""
+        def test_a():
+            assert 1 == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["test_a.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(test_b="""
+        def test_b():
+            assert 1 == 1
+    """)
+
+    r.index.add(["test_b.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect-shadow", "--commit-range", "1"],
+        [
+            "*smart collection shadow run*",
+            "Would have run 1 of 2 tests (50.0%), saving * seconds*",
+            "Would have caught 0 of 1 failures",
+            "MISSED test_a.py::test_a",
+            "Over 1 shadow runs: selected 50.0% of the tests *, with 0.0% recall (1 failures missed) and 0.0% precision",
+            "*1 failed, 1 passed in * seconds*"
+        ],
+        lambda x: x != 0
+    )
+
+    # the failure is selected the next time, since it failed on the last run
+    _check_result(
+        testdir,
+        ["--smart-collect-shadow", "--commit-range", "1"],
+        [
+            "Would have run 2 of 2 tests (100.0%), saving * seconds*",
+            "Would have caught 1 of 1 failures",
+            "Over 2 shadow runs: selected 75.0% of the tests *, with 50.0% recall (1 failures missed) and 33.3% precision",
+            "*1 failed, 1 passed in * seconds*"
+        ],
+        lambda x: x != 0
+    )
+
+
+def test_cli(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+
+        def b():
+            return 2
+    """)
+
+    testdir.makepyfile(test_mod="""
+        import pytest
+        from mod import a, b
+
+        def test_a():
+            assert a() == 1
+
+        class TestB(object):
+            def test_b(self):
+                assert b() == 2
+
+            @pytest.mark.skip
+            def test_skipped(self):
+                assert a() == 1
+
+        # importing the tests would fail, but they are only parsed
+        raise ImportError("not importable")
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_mod.py"])
+    r.index.commit("initial commit")
+
+    with open("README.txt", "w") as f:
+        f.write("docs only")
+
+    r.index.add(["README.txt"])
+    r.index.commit("second commit")
+
+    def cli(*args):
+        p = subprocess.Popen([sys.executable, '-m', 'pytest_smartcollect.cli', '--commit-range', '1', '--no-daemon'] + list(args), stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        return p.returncode, out.decode('utf-8').split()
+
+    # nothing that the tests use changed
+    assert cli() == (1, [])
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 1\n\ndef b():\n    return 3\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("third commit")
+
+    assert cli() == (0, ['test_mod.py::TestB::test_b'])
+    assert cli('--files') == (0, ['test_mod.py'])
+    assert cli('--ignore-source', 'mod.py') == (1, [])
+
+    # the naming rules, test paths and ignored sources of the ini file that pytest would read
+    testdir.mkdir("checks")
+    with open(os.path.join("checks", "check_mod.py"), "w") as f:
+        f.write("from mod import b\n\ndef check_b():\n    assert b() == 3\n")
+
+    with open("setup.cfg", "w") as f:
+        f.write("[tool:pytest]\npython_files = check_*.py\npython_functions = check\ntestpaths = checks\n")
+
+    assert cli() == (0, ['checks/check_mod.py::check_b'])
+
+    with open("pyproject.toml", "w") as f:
+        f.write('[tool.pytest.ini_options]\npython_files = ["check_*.py"]\npython_functions = ["check", "test"]\ntestpaths = [\n    "checks",\n]\nsmart_collect_ignore = ["mod.py"]\nsmart_collect_data_map = ["*.txt = checks"]\n')
+
+    assert cli() == (1, [])
+
+    # the data map of the ini file and --data-map are merged
+    assert cli('--commit-range', '2', 'checks', 'test_mod.py') == (0, ['checks/check_mod.py::check_b'])
+    assert cli('--commit-range', '2', '--data-map', 'README.txt = test_mod.py', 'checks', 'test_mod.py') == (0, ['checks/check_mod.py::check_b', 'test_mod.py::test_a', 'test_mod.py::TestB::test_b'])
+
+
+def test_cli_constants_and_removals(testdir):
+    Repo.init(".")
+
+    with open("settings.py", "w") as f:
+        f.write("TIMEOUT = 10\n\n\ndef get_timeout():\n    return TIMEOUT\n\n\ndef gone():\n    return 1\n\n\ndef kept():\n    return 2\n")
+
+    testdir.makepyfile(test_settings="""
+        import settings
+
+        def test_timeout():
+            assert settings.get_timeout() == 10
+
+        def test_gone():
+            assert settings.gone() == 1
+
+        def test_kept():
+            assert settings.kept() == 2
+    """)
+
+    r = Repo(".")
+    r.index.add(["settings.py", "test_settings.py"])
+    r.index.commit("initial commit")
+
+    def cli():
+        p = subprocess.Popen([sys.executable, '-m', 'pytest_smartcollect.cli', '--commit-range', '1', '--no-daemon'], stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        return p.returncode, out.decode('utf-8').split()
+
+    # only a constant changes
+    with open("settings.py", "w") as f:
+        f.write("TIMEOUT = 20\n\n\ndef get_timeout():\n    return TIMEOUT\n\n\ndef gone():\n    return 1\n\n\ndef kept():\n    return 2\n")
+
+    r.index.add(["settings.py"])
+    r.index.commit("second commit")
+
+    assert cli() == (0, ['test_settings.py::test_timeout'])
+
+    # only a function is deleted
+    with open("settings.py", "w") as f:
+        f.write("TIMEOUT = 20\n\n\ndef get_timeout():\n    return TIMEOUT\n\n\ndef kept():\n    return 2\n")
+
+    r.index.add(["settings.py"])
+    r.index.commit("third commit")
+
+    assert cli() == (0, ['test_settings.py::test_gone'])
+
+
+def test_prioritise(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(mod="""
+        def a():
+            return 1
+
+        def b():
+            return 2
+    """)
+
+    testdir.makepyfile(test_mod="""
+        import time
+        from mod import a, b
+
+        def test_a():
+            time.sleep(0.5)
+            assert a() == 1
+
+        def test_b():
+            assert b() == 2
+    """)
+
+    testdir.makepyfile(test_fixture="""
+        import time
+        import pytest
+        from mod import a, b
+
+        @pytest.fixture(scope='module')
+        def resource():
+            with open('setups.txt', 'a') as f:
+                f.write('setup\\n')
+
+        def test_slow(resource):
+            time.sleep(0.8)
+            assert b() == 2
+
+        def test_fast(resource):
+            assert a() == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["mod.py", "test_mod.py", "test_fixture.py"])
+    r.index.commit("initial commit")
+
+    with open("mod.py", "w") as f:
+        f.write("def a():\n    return 1 + 0\n\ndef b():\n    return 2 + 0\n")
+
+    r.index.add(["mod.py"])
+    r.index.commit("second commit")
+
+    # the first run records how long each test takes
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*4 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # tests are only reordered within their module, so the module scoped fixture is set up once, even though test_a would
+    # be worth running before test_fixture.py::test_slow
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "-v"],
+        ["*test_fixture.py::test_fast PASSED*", "*test_fixture.py::test_slow PASSED*", "*4 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open("setups.txt") as f:
+        assert f.read().splitlines() == ["setup", "setup"]
+
+    # the fast tests are just as likely to fail, so they run first, and they are the only ones that fit into the budget
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-budget", "0.2", "-v"],
+        ["*test_mod.py::test_b PASSED*", "*test_mod.py::test_a SKIPPED*", "*2 passed, 2 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_subproject_scope(testdir):
+    Repo.init(".")
+
+    # two services and a library they share, each with its own setup.py
+    for subproject in ("services/billing", "services/shipping", "libs/common"):
+        os.makedirs(subproject)
+        with open(os.path.join(subproject, "setup.py"), "w") as f:
+            f.write("from setuptools import setup\nsetup()\n")
+
+    with open("libs/common/money.py", "w") as f:
+        f.write("def cents(amount):\n    return int(amount * 100)\n")
+
+    with open("services/billing/billing.py", "w") as f:
+        f.write("from money import cents\n\ndef invoice(amount):\n    return cents(amount)\n")
+
+    testdir.mkdir("services/billing/tests")
+    with open("services/billing/tests/test_billing.py", "w") as f:
+        f.write("from billing import invoice\n\ndef test_invoice():\n    assert invoice(1) == 100\n")
+
+    with open("services/shipping/shipping.py", "w") as f:
+        f.write("def ship():\n    return True\n")
+
+    testdir.makeconftest("""
+        import os
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'libs', 'common'))
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'services', 'billing'))
+    """)
+
+    r = Repo(".")
+    r.git.add(A=True)
+    r.index.commit("initial commit")
+
+    with open("libs/common/money.py", "w") as f:
+        f.write("def cents(amount):\n    return int(round(amount * 100))\n")
+
+    r.index.add(["libs/common/money.py"])
+    r.index.commit("second commit")
+
+    # the library is outside of the billing subproject, but billing imports it
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--rootdir", str(testdir.tmpdir), "services/billing/tests"],
+        ["*1 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # only the billing subproject was indexed
+    index_dir = os.path.join(str(testdir.tmpdir), ".pytest_cache", "v", "smartcollect", "project_index")
+    assert len(os.listdir(index_dir)) == 1
+
+    with open("services/shipping/shipping.py", "w") as f:
+        f.write("def ship():\n    return False\n")
+
+    r.index.add(["services/shipping/shipping.py"])
+    r.index.commit("third commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--rootdir", str(testdir.tmpdir), "services/billing/tests"],
+        ["*1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # a range that reaches back to the first commit changes everything in it, outside of the billing subproject too
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "3", "--rootdir", str(testdir.tmpdir), "services/billing/tests"],
+        ["*1 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+
+def test_max_depth(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(grandparent="""
+        class Grandparent(object):
+            def __init__(self):
+                pass
+    """)
+
+    testdir.makepyfile(parent="""
+        from grandparent import Grandparent
+        class Parent(Grandparent):
+            def __init__(self, val):
+                self.val = val
+    """)
+
+    testdir.makepyfile(test_parent="""
+        def test_parent():
+            from parent import Parent
+            p = Parent(42)
+            assert p.val == 42
+    """)
+
+    testdir.makepyfile(child="""
+        from parent import Parent
+        class Child(Parent):
+            def __init__(self, val):
+                super(Child, self).__init__(val)
+    """)
+
+    testdir.makepyfile(test_child="""
+        def test_child():
+            from child import Child
+            c = Child(42)
+            assert c.val == 42
+    """)
+
+    r = Repo(".")
+    r.index.add(["grandparent.py", "parent.py", "child.py", "test_parent.py", "test_child.py"])
+    r.index.commit("First commit")
+
+    with open("grandparent.py", "w") as f:
+        f.write("class Grandparent(object):\n\tdef __init__(self, val):\n\t\tself.val = val")
+
+    r.index.add(["grandparent.py"])
+    r.index.commit("Second commit")
+
+    # Grandparent is two hops away from test_parent and three hops away from test_child
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-max-depth", "2"],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-max-depth", "1"],
+        ["*2 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+
 def test_generate_coverage_report(coverage_report_directory):
     cov = Coverage()
     cov.combine(coverage_files)